@@ -1,23 +1,43 @@
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from flask_migrate import Migrate
 from config import Config
+from app.engine import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 login_manager = LoginManager()
-migrate = Migrate()
+
+# virtual tables (the FTS5 and R*Tree mirrors and their shadow tables) are maintained by hand
+UNMANAGED_TABLE_PREFIXES = ("book_fts", "book_geo", "buy_request_geo")
+
+
+def _include_object(obj, name, type_, reflected, compare_to):
+    return not (type_ == "table" and name.startswith(UNMANAGED_TABLE_PREFIXES))
+
 
 def create_app(config_class=Config):
     app = Flask(__name__, static_folder="static", template_folder="templates")
     app.config.from_object(config_class)
 
+    from app import engine
+    engine.configure(app)
     db.init_app(app)
+    engine.init_app(app, db)
+    from app import metrics
+    metrics.init_app(app, db)
     login_manager.init_app(app)
-    migrate.init_app(app, db)
+    # alembic is a sizeable import that only the ``flask db`` commands need, so
+    # Flask-Migrate is set up when the app is loaded by the CLI, not in web workers
+    cli = click.get_current_context(silent=True) is not None
+    if cli:
+        from flask_migrate import Migrate
+        Migrate(app, db, render_as_batch=True, include_object=_include_object)
 
     login_manager.login_view = "auth.login"
     login_manager.login_message_category = "info"
+    # API clients get a 401 instead of a redirect to the login form
+    login_manager.blueprint_login_views["api"] = None
 
     # blueprints (inside the function)
     from app.auth.routes import auth_bp
@@ -25,15 +45,51 @@ def create_app(config_class=Config):
     from app.donations.routes import donations_bp
     from app.main.routes import main_bp
     from app.account.routes import bp as account_bp
+    from app.api import api_bp
     
     app.register_blueprint(account_bp)
     app.register_blueprint(auth_bp)
     app.register_blueprint(books_bp, url_prefix="/books")
     app.register_blueprint(donations_bp, url_prefix="/donate")
     app.register_blueprint(main_bp)
+    app.register_blueprint(api_bp, url_prefix="/api/v1")
+
+    from app import search, ratings, facets, geo, matching, recommend, storage, images, jobs, uploads, startup, serving
+    from app.cache import cache
+    from app.identity import identity_cache
+    from app.ratelimit import limiter
+    from app.passwords import hasher
+    search.init_app(app)
+    ratings.init_app(app)
+    facets.init_app(app)
+    geo.init_app(app)
+    matching.init_app(app)
+    recommend.init_app(app)
+    storage.init_app(app)
+    images.init_app(app)
+    jobs.init_app(app)
+    uploads.init_app(app)
+    cache.init_app(app)
+    identity_cache.init_app(app)
+    limiter.init_app(app)
+    hasher.init_app(app)
+    serving.init_app(app)
+    # benchmarks, plan checks, load tests and the bulk import are commands only
+    if cli:
+        from app import bench, loadtest, queryplan
+        from app.books import cli as books_cli
+        queryplan.init_app(app)
+        bench.init_app(app)
+        loadtest.init_app(app)
+        books_cli.init_app(app)
+        app.cli.add_command(startup.startup_cli)
 
     # create instance folder and DB if not exists
     import os
     os.makedirs(app.instance_path, exist_ok=True)
 
+    startup.init_app(app)
+    if app.config.get("STARTUP_WARM_UP"):
+        startup.warm_up(app)
+
     return app
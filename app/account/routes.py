@@ -1,31 +1,56 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, jsonify
 from flask_login import login_required, current_user
-import os
-from werkzeug.utils import secure_filename
-from werkzeug.security import check_password_hash, generate_password_hash
-from app import db
-from app.models import Book, Wishlist  
+from app import db, identity, images, jobs, storage, wishlist as wishlists
+from app.models import Book, Wishlist, Review, Match
+from sqlalchemy import func, update
+from sqlalchemy.orm import joinedload
+from app.ratelimit import limit
 from app.forms import EditProfileForm  # FOR EDITING PROFILE
 from app.forms import ChangePasswordForm  # FOR EDITING PROFILE
 
 
 bp = Blueprint("account", __name__, url_prefix="/account")
 
-UPLOAD_FOLDER = "app/static/uploads/avatars"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
 
 @bp.route("/my_listings")
 @login_required
 def my_listings():
-    listings = current_user.listings.all()
-    requests = current_user.buy_requests  # or .all() if needed
-    return render_template("account/my_listings.html", listings=listings, requests=requests)
+    # A fixed number of queries regardless of how many listings the user has:
+    # listings, wishlist counts, reviews (+ authors) and buy requests.
+    listings = current_user.listings.order_by(Book.created_at.desc(), Book.id.desc()).all()
+
+    wish_counts = dict(
+        db.session.query(Wishlist.book_id, func.count(Wishlist.id))
+        .join(Book, Book.id == Wishlist.book_id)
+        .filter(Book.owner_id == current_user.id)
+        .group_by(Wishlist.book_id)
+        .all()
+    )
+
+    reviews_by_book = {}
+    reviews = (
+        Review.query.options(joinedload(Review.author))
+        .join(Book, Book.id == Review.book_id)
+        .filter(Book.owner_id == current_user.id)
+        .order_by(Review.created_at.desc())
+        .all()
+    )
+    for r in reviews:
+        reviews_by_book.setdefault(r.book_id, []).append(r)
+
+    requests = current_user.buy_requests
+    return render_template(
+        "account/my_listings.html",
+        listings=listings,
+        requests=requests,
+        wish_counts=wish_counts,
+        reviews_by_book=reviews_by_book,
+    )
 
 # Small API to toggle active status (used by JS)
 @bp.route("/listing/toggle-active/<int:book_id>", methods=["POST"])
@@ -67,14 +92,47 @@ def delete_listing(book_id):
     if b.owner_id != current_user.id:
         abort(403)
     db.session.delete(b)
+    if b.image_file:
+        jobs.enqueue("uploads.gc", unique=True)
     db.session.commit()
     return jsonify({"status": "ok"})
 
+NOTIFICATIONS_LIMIT = 50
+
+
 @bp.route("/notifications")
 @login_required
 def notifications():
-    # Placeholder page for now
-    return render_template("account/notifications.html")
+    """Listings matched to the user's buy requests (see app.matching), newest first."""
+    items = (
+        Match.query.filter_by(user_id=current_user.id)
+        .options(joinedload(Match.book), joinedload(Match.buy_request))
+        .order_by(Match.created_at.desc(), Match.id.desc())
+        .limit(NOTIFICATIONS_LIMIT)
+        .all()
+    )
+    # rendered with their "New" badges; the page then posts the unread ids to mark_read
+    unread = [m.id for m in items if not m.read]
+    return render_template("account/notifications.html", notifications=items, unread=unread)
+
+
+@bp.route("/notifications/read", methods=["POST"])
+@login_required
+def mark_read():
+    """Mark the notifications in ``ids`` (comma separated) as seen."""
+    try:
+        ids = {int(i) for i in request.form.get("ids", "").split(",") if i}
+    except ValueError:
+        abort(400)
+    ids = list(ids)[:NOTIFICATIONS_LIMIT]
+    if ids:
+        db.session.execute(
+            update(Match).where(Match.user_id == current_user.id, Match.id.in_(ids)).values(read=True)
+        )
+        db.session.commit()
+    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return jsonify({"read": len(ids)})
+    return redirect(url_for("account.notifications"))
 
 @bp.route("/profile")
 @login_required
@@ -88,10 +146,12 @@ def edit_profile():
     form = EditProfileForm(obj=current_user)  # prefill with current values
 
     if form.validate_on_submit():
-        current_user.name = form.name.data
-        current_user.email = form.email.data
-        current_user.phone = form.phone.data
+        user = current_user.record
+        user.name = form.name.data
+        user.email = form.email.data
+        user.phone = form.phone.data
         db.session.commit()
+        identity.invalidate(user.id)
         flash("Profile updated successfully!", "success")
         return redirect(url_for("account.profile"))
 
@@ -110,18 +170,21 @@ def upload_avatar():
         flash("No selected file", "danger")
         return redirect(url_for("account.profile"))
 
-    if file:
-        # create avatars folder inside /static if not exists
-        upload_path = os.path.join(current_app.static_folder, "avatars")
-        os.makedirs(upload_path, exist_ok=True)
-
-        filename = f"user_{current_user.id}_{file.filename}"
-        file_path = os.path.join(upload_path, filename)
-        file.save(file_path)
+    if not allowed_file(file.filename):
+        flash("Avatars must be JPG, PNG or GIF images.", "danger")
+        return redirect(url_for("account.profile"))
 
-        # save filename in DB
-        current_user.avatar_file = filename
+    if file:
+        filename, new = storage.store.save(file)
+        if new:
+            images.enqueue(filename)
+
+        # save filename in DB; a replaced avatar is left to the upload GC
+        if current_user.avatar_file and current_user.avatar_file != filename:
+            jobs.enqueue("uploads.gc", unique=True)
+        current_user.record.avatar_file = filename
         db.session.commit()
+        identity.invalidate(current_user.id)
 
         flash("Avatar uploaded successfully!", "success")
     return redirect(url_for("account.profile"))
@@ -130,14 +193,11 @@ def upload_avatar():
 @login_required
 def remove_avatar():
     if current_user.avatar_file:
-        # path to file
-        file_path = os.path.join(current_app.static_folder, "avatars", current_user.avatar_file)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
-        # clear from DB
-        current_user.avatar_file = None
+        # clear from DB; the upload GC deletes the file and its variants
+        current_user.record.avatar_file = None
+        jobs.enqueue("uploads.gc", unique=True)
         db.session.commit()
+        identity.invalidate(current_user.id)
 
         flash("Avatar removed successfully!", "success")
     else:
@@ -151,13 +211,14 @@ def change_password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
         # Check if current password matches
-        if not check_password_hash(current_user.password_hash, form.current_password.data):
+        if not current_user.record.check_password(form.current_password.data):
             flash("Current password is incorrect.", "danger")
             return redirect(url_for("account.change_password"))
 
-        current_user.password_hash = generate_password_hash(form.new_password.data)
+        current_user.record.set_password(form.new_password.data)
 
         db.session.commit()
+        identity.invalidate(current_user.id)
         flash("✅ Password updated successfully!", "success")
         return redirect(url_for('account.edit_profile'))
 
@@ -179,19 +240,15 @@ def wishlist():
 
 @bp.route("/toggle-wishlist/<int:book_id>", methods=["POST"])
 @login_required
+@limit("60/minute", scope="wishlist")
 def toggle_wishlist(book_id):
     """Add/remove a book from wishlist"""
     book = Book.query.get_or_404(book_id)
-    existing = Wishlist.query.filter_by(user_id=current_user.id, book_id=book.id).first()
-
-    if existing:
-        db.session.delete(existing)
-        db.session.commit()
-        flash(f"Removed '{book.title}' from your wishlist.", "info")
-    else:
-        new_item = Wishlist(user_id=current_user.id, book_id=book.id)
-        db.session.add(new_item)
-        db.session.commit()
+    wished = wishlists.apply(current_user.id, book.id, request.form.get("action"))
+    db.session.commit()
+    if wished:
         flash(f"Added '{book.title}' to your wishlist!", "success")
+    else:
+        flash(f"Removed '{book.title}' from your wishlist.", "info")
 
     return redirect(request.referrer or url_for("account.wishlist"))
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""Versioned read-only JSON API (``/api/v1``).
+
+Every response carries a strong ETag computed from the ``(id, updated_at)``
+pairs of the rows it was built from plus the query string. A client that
+sends the tag back in ``If-None-Match`` gets an empty ``304`` once the rows
+have been read -- nothing is serialized or sent -- unless one of them changed,
+appeared or disappeared.
+
+``?fields=id,title,price`` limits each object to the listed fields. Bodies are
+serialized without whitespace.
+"""
+import hashlib
+import json
+
+from flask import Response, abort, request
+from flask_login import current_user, login_required
+from werkzeug.exceptions import HTTPException
+
+from app import db, storage
+from app.api import api_bp
+from app.books.routes import browse_query, buy_requests_query
+from app.models import Book, Wishlist
+from app.utils import paginate_request
+
+API_VERSION = "v1"
+DEFAULT_LIMIT = 24
+MAX_LIMIT = 100
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _image_url(filename):
+    return storage.file_url("uploads", filename, external=True)
+
+
+BOOK_FIELDS = {
+    "id": lambda b: b.id,
+    "title": lambda b: b.title,
+    "author": lambda b: b.author,
+    "price": lambda b: b.price,
+    "is_free": lambda b: bool(b.is_free),
+    "condition": lambda b: b.condition,
+    "category": lambda b: b.category.name if b.category else None,
+    "location": lambda b: b.location,
+    "latitude": lambda b: b.latitude,
+    "longitude": lambda b: b.longitude,
+    "description": lambda b: b.description,
+    "image_url": lambda b: _image_url(b.image_file),
+    "owner_id": lambda b: b.owner_id,
+    "rating": lambda b: {"average": b.avg_rating(), "count": b.review_count},
+    "created_at": lambda b: _iso(b.created_at),
+    "updated_at": lambda b: _iso(b.updated_at),
+}
+BOOK_DETAIL_FIELDS = {
+    **BOOK_FIELDS,
+    "rating": lambda b: {
+        "average": b.avg_rating(),
+        "count": b.review_count,
+        "histogram": {str(k): v for k, v in b.rating_histogram().items()},
+    },
+}
+REQUEST_FIELDS = {
+    "id": lambda r: r.id,
+    "title": lambda r: r.title,
+    "author": lambda r: r.author,
+    "details": lambda r: r.details,
+    "budget": lambda r: str(r.budget) if r.budget is not None else None,
+    "is_free": lambda r: bool(r.is_free),
+    "location": lambda r: r.location,
+    "latitude": lambda r: r.latitude,
+    "longitude": lambda r: r.longitude,
+    "image_url": lambda r: _image_url(r.image_file),
+    "created_at": lambda r: _iso(r.created_at),
+    "updated_at": lambda r: _iso(r.updated_at),
+}
+
+
+def _selected(fields):
+    """The serializers picked by ``?fields=``; all of them by default."""
+    wanted = request.args.get("fields")
+    if not wanted:
+        return fields
+    names = [n.strip() for n in wanted.split(",") if n.strip()]
+    unknown = [n for n in names if n not in fields]
+    if unknown:
+        abort(400, description=f"unknown fields: {', '.join(unknown)}")
+    return {n: fields[n] for n in names}
+
+
+def _serialize(obj, fields):
+    return {name: get(obj) for name, get in fields.items()}
+
+
+def _limit():
+    try:
+        return max(1, min(int(request.args.get("limit", DEFAULT_LIMIT)), MAX_LIMIT))
+    except ValueError:
+        abort(400, description="limit must be an integer")
+
+
+def _etag(rows):
+    """Strong ETag for a response built from ``rows`` under the current query string."""
+    args = sorted(request.args.items(multi=True))
+    versions = [(row.id, _iso(row.updated_at)) for row in rows]
+    raw = json.dumps([API_VERSION, request.path, args, versions], separators=(",", ":"))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _respond(rows, build, private=False):
+    """304 when the client's ETag still matches ``rows``, else ``build()`` as compact JSON."""
+    tag = _etag(rows)
+    headers = {"Cache-Control": "private, no-cache" if private else "no-cache"}
+    if request.if_none_match.contains(tag):
+        resp = Response(status=304, headers=headers)
+    else:
+        body = json.dumps(build(), separators=(",", ":"), ensure_ascii=False)
+        resp = Response(body, mimetype="application/json", headers=headers)
+    resp.set_etag(tag)
+    if private:
+        resp.vary.add("Cookie")
+    return resp
+
+
+@api_bp.errorhandler(HTTPException)
+def _json_error(exc):
+    body = json.dumps({"error": exc.name, "message": exc.description}, separators=(",", ":"))
+    return Response(body, status=exc.code, mimetype="application/json")
+
+
+@api_bp.route("/books")
+def books():
+    """Listings, newest first, with the same filters as the browse page."""
+    fields = _selected(BOOK_FIELDS)
+    query, keys = browse_query(request.args)
+    page = paginate_request(query, keys, per_page=_limit())
+    return _respond(page.items, lambda: {
+        "data": [_serialize(b, fields) for b in page.items],
+        "next_cursor": page.next_cursor,
+    })
+
+
+@api_bp.route("/books/<int:book_id>")
+def book(book_id):
+    fields = _selected(BOOK_DETAIL_FIELDS)
+    b = db.session.get(Book, book_id) or abort(404, description="no such book")
+    return _respond([b], lambda: {"data": _serialize(b, fields)})
+
+
+@api_bp.route("/buy-requests")
+def buy_requests():
+    """Buy requests, newest first; ``near``/``radius``/``sort`` work as on the browse page."""
+    fields = _selected(REQUEST_FIELDS)
+    query, keys = buy_requests_query(request.args)
+    page = paginate_request(query, keys, per_page=_limit())
+    return _respond(page.items, lambda: {
+        "data": [_serialize(r, fields) for r in page.items],
+        "next_cursor": page.next_cursor,
+    })
+
+
+@api_bp.route("/wishlist")
+@login_required
+def wishlist():
+    """The current user's wishlisted books, most recently added first."""
+    fields = _selected(BOOK_FIELDS)
+    items = (
+        Book.query.join(Wishlist, Wishlist.book_id == Book.id)
+        .filter(Wishlist.user_id == current_user.id)
+        .order_by(Wishlist.id.desc())
+        .all()
+    )
+    return _respond(items, lambda: {"data": [_serialize(b, fields) for b in items]}, private=True)
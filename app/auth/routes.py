@@ -4,8 +4,18 @@ from app import db
 from app.models import User
 from app.forms import SignupForm, LoginForm
 from flask_login import login_user, logout_user, current_user, login_required
+from app.ratelimit import limit
+
+
+def _login_email():
+    return "email:" + (request.form.get("email") or "").lower().strip()
+
+
+def _failed_login(resp):
+    return resp.status_code != 302
 
 @auth_bp.route("/signup", methods=["GET","POST"])
+@limit("10/hour", key="ip")
 def signup():
     if current_user.is_authenticated:
         return redirect(url_for("main.index"))
@@ -26,6 +36,9 @@ def signup():
 
 
 @auth_bp.route("/login", methods=["GET","POST"])
+@limit("10/minute", key="ip", deduct_when=_failed_login, message="Too many failed logins. Try again shortly.")
+@limit("20/hour", key=_login_email, scope="login_email", deduct_when=_failed_login,
+       message="Too many failed logins for this account. Try again later.")
 def login():
     if current_user.is_authenticated:
         return redirect(url_for("main.index"))
@@ -33,6 +46,7 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data.lower().strip()).first()
         if user and user.check_password(form.password.data):
+            db.session.commit()  # persists a rehashed password, if any
             login_user(user)
             flash("Logged in successfully.", "success")
             next_page = request.args.get("next")
@@ -0,0 +1,299 @@
+"""Route benchmarks against a synthetic dataset.
+
+    flask bench seed --books 100000 --reviews 1000000 --wishlist 500000
+    flask bench run --save          # record a baseline
+    flask bench run                 # compare against it, exit 1 on regression
+
+``seed`` fills a separate SQLite file (``instance/bench.sqlite`` by default)
+with deterministic data for a given ``--seed``. Rows are bulk-inserted with
+Core statements, so the full-text index, rating aggregates, facet counts,
+spatial index, buy request token index and "also wanted" lists are rebuilt afterwards
+rather than maintained row by row.
+
+``run`` requests every route in ``ROUTES`` through the test client, logged in
+as the user with the most listings, and records p50/p95 latency and the
+number of SQL statements per request. A route regresses when it issues more
+statements than the baseline, or when its p95 exceeds the baseline by more
+than ``--tolerance`` (relative) plus ``--slack-ms`` (absolute). Latencies
+only compare meaningfully on the machine that recorded the baseline.
+"""
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+bench_cli = AppGroup("bench", help="Route benchmarks.")
+
+# (name, url template); {book} is filled in after seeding
+ROUTES = [
+    ("main.index", "/"),
+    ("books.browse", "/books/browse"),
+    ("books.browse (search)", "/books/browse?q=history"),
+    ("books.browse (filtered)", "/books/browse?condition=used&free=1"),
+    ("books.browse (near)", "/books/browse?near=Gulberg+Lahore&radius=10"),
+    ("books.browse (nearest)", "/books/browse?near=31.52,74.35&radius=25&sort=distance"),
+    ("books.buy_requests (near)", "/books/buy-requests?near=Karachi&radius=25"),
+    ("books.book_detail", "/books/{book}"),
+    ("account.my_listings", "/account/my_listings"),
+    ("account.wishlist", "/account/wishlist"),
+]
+
+PASSWORD = "benchmark"
+WORDS = (
+    "history war peace river night garden stone empire ocean silent city light "
+    "shadow winter summer code data python physics chemistry biology economics "
+    "art music poetry travel kitchen mountain island journey secret lost found"
+).split()
+CATEGORIES = ["Fiction", "Science", "History", "Textbook", "Children", "Biography", "Poetry", "Comics"]
+CONDITIONS = ["new", "like new", "used", "old"]
+CHUNK = 10000
+
+
+def _default_path():
+    return os.path.join(current_app.instance_path, "bench.sqlite")
+
+
+def _bench_app(path):
+    from app import create_app
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{path}"
+        SQLITE_READ_ENGINE = False
+        WTF_CSRF_ENABLED = False
+        CACHE_BACKEND = "null"
+        IDENTITY_CACHE_BACKEND = "memory"
+        RATELIMIT_ENABLED = False
+        IMAGE_WORKERS = 0
+        PASSWORD_HASH_WORKERS = 0
+        PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000"
+
+    return create_app(BenchConfig)
+
+
+def _words(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def _insert(conn, table, rows):
+    """Insert an iterator of dicts in chunks."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == CHUNK:
+            conn.execute(table.insert(), batch)
+            batch.clear()
+    if batch:
+        conn.execute(table.insert(), batch)
+
+
+def seed(users, books, reviews, wishlist, buy_requests, seed_value=1):
+    """Fill the current app's database with synthetic rows. Returns the counts."""
+    from app import db, facets, geo, matching, passwords, ratings, recommend, search
+    from app.models import Book, BuyRequest, Review, User, Wishlist
+
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    span = timedelta(days=365).total_seconds()
+    pwhash = passwords.hash_password(PASSWORD)
+
+    def when():
+        return now - timedelta(seconds=rng.random() * span)
+
+    places = sorted(geo.places())
+
+    def where():
+        place = rng.choice(places)
+        return dict(location=place.label, latitude=place.latitude, longitude=place.longitude)
+
+    db.drop_all()
+    db.create_all()
+    with db.engine.begin() as conn:
+        category_ids = list(facets.category_ids(conn, CATEGORIES).values())
+        _insert(conn, User.__table__, (
+            dict(id=i, name=f"User {i}", email=f"user{i}@example.com", phone=f"03{i:09d}",
+                 password_hash=pwhash, created_at=when())
+            for i in range(1, users + 1)
+        ))
+        # log-uniform owners: a few sellers with large dashboards, a long tail of small ones
+        _insert(conn, Book.__table__, (
+            dict(id=i, title=_words(rng, 3).title(), author=f"{_words(rng, 1).title()} {rng.choice(WORDS).title()}",
+                 price=round(rng.uniform(100, 5000), 0), is_free=rng.random() < 0.1,
+                 condition=rng.choice(CONDITIONS), category_id=rng.choice(category_ids),
+                 description=_words(rng, 30), created_at=when(), owner_id=int(users ** rng.random()), **where())
+            for i in range(1, books + 1)
+        ))
+        _insert(conn, Review.__table__, (
+            dict(rating=rng.randint(1, 5), comment=_words(rng, 12), created_at=when(),
+                 user_id=rng.randint(1, users), book_id=rng.randint(1, books))
+            for _ in range(reviews)
+        ))
+        pairs = rng.sample(range(users * books), min(wishlist, users * books))
+        _insert(conn, Wishlist.__table__, (
+            dict(user_id=p // books + 1, book_id=p % books + 1, created_at=when()) for p in pairs
+        ))
+        _insert(conn, BuyRequest.__table__, (
+            dict(title=_words(rng, 3).title(), author=rng.choice(WORDS).title(), details=_words(rng, 20),
+                 budget=rng.randint(100, 3000), is_free=False, created_at=when(),
+                 user_id=rng.randint(1, users), **where())
+            for _ in range(buy_requests)
+        ))
+    search.rebuild()
+    ratings.rebuild()
+    facets.rebuild()
+    geo.rebuild()
+    matching.rebuild()
+    if recommend.available():
+        recommend.rebuild()
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    return {"users": users, "books": books, "reviews": reviews,
+            "wishlist": len(pairs), "buy_requests": buy_requests}
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run_routes(app, repeat, warmup):
+    """{route name: {"p50_ms", "p95_ms", "queries"}} for every route in ``ROUTES``."""
+    from app import db
+    from app.models import Book
+
+    with app.app_context():
+        _, email = db.session.execute(
+            sa.text(
+                "SELECT u.id, u.email FROM user u JOIN book b ON b.owner_id = u.id "
+                "GROUP BY u.id ORDER BY count(*) DESC LIMIT 1"
+            )
+        ).one()
+        book_id = db.session.execute(
+            sa.select(Book.id).order_by(Book.review_count.desc()).limit(1)
+        ).scalar()
+        engines = list(db.engines.values())
+
+    statements = []
+
+    def count(conn, cur, statement, parameters, context, executemany):
+        if not statement.startswith(("BEGIN", "COMMIT", "ROLLBACK")):
+            statements.append(statement)
+
+    client = app.test_client()
+    client.post("/login", data={"email": email, "password": PASSWORD})
+    for engine in engines:
+        sa.event.listen(engine, "before_cursor_execute", count)
+    results = {}
+    try:
+        for name, template in ROUTES:
+            url = template.format(book=book_id)
+            for _ in range(warmup):
+                client.get(url)
+            timings, queries = [], []
+            for _ in range(repeat):
+                statements.clear()
+                start = time.perf_counter()
+                resp = client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+                queries.append(len(statements))
+                if resp.status_code != 200:
+                    raise click.ClickException(f"{url} returned HTTP {resp.status_code}")
+            results[name] = {
+                "p50_ms": round(statistics.median(timings), 2),
+                "p95_ms": round(_percentile(timings, 95), 2),
+                "queries": max(queries),
+            }
+    finally:
+        for engine in engines:
+            sa.event.remove(engine, "before_cursor_execute", count)
+    return results
+
+
+def compare(results, baseline, tolerance, slack_ms):
+    """Regression messages for ``results`` against ``baseline``."""
+    problems = []
+    for name, now in results.items():
+        then = baseline.get(name)
+        if then is None:
+            continue
+        if now["queries"] > then["queries"]:
+            problems.append(f"{name}: {now['queries']} queries, baseline {then['queries']}")
+        limit = then["p95_ms"] * (1 + tolerance) + slack_ms
+        if now["p95_ms"] > limit:
+            problems.append(f"{name}: p95 {now['p95_ms']}ms, baseline {then['p95_ms']}ms (limit {limit:.1f}ms)")
+    return problems
+
+
+@bench_cli.command("seed")
+@click.option("--db", "path", help="SQLite file to fill (default instance/bench.sqlite).")
+@click.option("--users", default=10000)
+@click.option("--books", default=100000)
+@click.option("--reviews", default=1000000)
+@click.option("--wishlist", default=500000)
+@click.option("--buy-requests", default=20000)
+@click.option("--seed", "seed_value", default=1, help="Random seed; the same seed gives the same data.")
+def seed_command(path, users, books, reviews, wishlist, buy_requests, seed_value):
+    """Replace the benchmark database with freshly generated data."""
+    path = os.path.abspath(path or _default_path())
+    app = _bench_app(path)
+    start = time.perf_counter()
+    with app.app_context():
+        counts = seed(users, books, reviews, wishlist, buy_requests, seed_value)
+    with open(f"{path}.json", "w") as f:
+        json.dump({"seed": seed_value, **counts}, f)
+    summary = ", ".join(f"{v} {k}" for k, v in counts.items())
+    click.echo(f"Seeded {path} with {summary} in {time.perf_counter() - start:.1f}s.")
+
+
+@bench_cli.command("run")
+@click.option("--db", "path", help="Seeded SQLite file (default instance/bench.sqlite).")
+@click.option("--baseline", "baseline_path", default="bench_baseline.json", show_default=True)
+@click.option("--save", is_flag=True, help="Write the results as the new baseline.")
+@click.option("--repeat", default=30, show_default=True, help="Timed requests per route.")
+@click.option("--warmup", default=3, show_default=True)
+@click.option("--tolerance", default=0.25, show_default=True, help="Allowed relative p95 increase.")
+@click.option("--slack-ms", default=5.0, show_default=True, help="Allowed absolute p95 increase.")
+def run_command(path, baseline_path, save, repeat, warmup, tolerance, slack_ms):
+    """Time the hot routes and compare them against the stored baseline."""
+    path = os.path.abspath(path or _default_path())
+    if not os.path.exists(path):
+        raise click.ClickException(f"{path} doesn't exist; run 'flask bench seed' first.")
+    with open(f"{path}.json") as f:
+        dataset = json.load(f)
+    results = run_routes(_bench_app(path), repeat, warmup)
+
+    click.echo(f"{'route':<28}{'p50 ms':>10}{'p95 ms':>10}{'queries':>9}")
+    for name, r in results.items():
+        click.echo(f"{name:<28}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['queries']:>9}")
+
+    if save:
+        with open(baseline_path, "w") as f:
+            json.dump({"dataset": dataset, "routes": results}, f, indent=2)
+            f.write("\n")
+        click.echo(f"Saved baseline to {baseline_path}.")
+        return
+    if not os.path.exists(baseline_path):
+        click.echo(f"No baseline at {baseline_path}; run with --save to record one.")
+        return
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline["dataset"] != dataset:
+        click.echo("Warning: the baseline was recorded against a different dataset.", err=True)
+    problems = compare(results, baseline["routes"], tolerance, slack_ms)
+    for p in problems:
+        click.echo(f"REGRESSION {p}")
+    if problems:
+        sys.exit(1)
+    click.echo(f"No regressions against {baseline_path}.")
+
+
+def init_app(app):
+    app.cli.add_command(bench_cli)
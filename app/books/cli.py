@@ -0,0 +1,179 @@
+"""``flask books import``: bulk-load listings from CSV or JSON Lines.
+
+    flask books import shop.csv --owner shop@example.com
+    flask books import shop.jsonl --owner shop@example.com --start 250000 --batch-size 5000
+    flask books import shop.csv --owner shop@example.com --dry-run
+
+Rows are streamed from the file and validated with ``BookForm``'s field
+validators, so an import accepts exactly what the create form would. Valid
+rows are inserted ``--batch-size`` at a time, one transaction per batch (which
+also indexes them for search and by location and adds them to the browse
+facet counts), so memory stays bounded by a single batch whatever the file
+size. Each batch queues a ``matching.books`` job in the same transaction;
+``flask jobs worker`` matches the new listings against buy requests once the
+batch is committed, so the import doesn't hold the write lock for it. After each
+batch the command prints how many data rows are committed; pass that number as
+``--start`` to resume an interrupted import.
+
+Columns: title, author, condition (new/used), is_free, price, category,
+location, description. Unknown columns are ignored. Category names are folded
+into existing categories the way the create form does it.
+
+Every committed batch bumps the "books" cache generation, so pages show the
+rows imported so far while a long import runs. Web workers see the new rows
+at once only through a shared ``CACHE_BACKEND`` ("sqlite", the production
+default), so run the command with the same config as the server. With the
+per-process "memory" backend they keep serving cached pages for up to
+``CACHE_DEFAULT_TIMEOUT`` seconds.
+"""
+import csv
+import json
+import sys
+import time
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+from werkzeug.datastructures import MultiDict
+from wtforms import Form
+
+from app import db, facets, geo, jobs, search
+from app.cache import MemoryBackend, cache
+from app.forms import BookForm
+from app.models import Book, User
+
+IMPORT_FIELDS = ("title", "author", "condition", "is_free", "price", "category", "location", "description")
+FALSE_VALUES = {"", "0", "false", "no", "n", "off"}
+MAX_REPORTED_ERRORS = 20
+
+books_cli = AppGroup("books", help="Book listing commands.")
+
+# BookForm's fields and validators, minus CSRF, the upload and the submit button
+BookImportForm = type("BookImportForm", (Form,), {name: getattr(BookForm, name) for name in IMPORT_FIELDS})
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per data row."""
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def validate_row(form, row):
+    """``(values for Book, None)`` for a valid row, else ``(None, errors)``.
+
+    ``form`` is a ``BookImportForm`` reused across rows; binding a fresh form
+    per row costs more than the validation itself.
+    """
+    if not isinstance(row, dict):
+        return None, {"row": ["Expected a JSON object."]}
+    data = {k: str(v).strip() for k, v in row.items() if k in IMPORT_FIELDS and v is not None}
+    data["condition"] = data.get("condition", "").lower()
+    if data.get("is_free", "").lower() in FALSE_VALUES:
+        data.pop("is_free", None)
+    form.process(MultiDict(data))
+    if not form.validate():
+        return None, form.errors
+    return {
+        "title": form.title.data,
+        "author": form.author.data or None,
+        "condition": form.condition.data,
+        "is_free": form.is_free.data,
+        "price": None if form.is_free.data or form.price.data is None else float(form.price.data),
+        "category": form.category.data or None,
+        "location": form.location.data or None,
+        "description": form.description.data or None,
+    }, None
+
+
+def _insert_batch(rows):
+    conn = db.session.connection()
+    names = [row.pop("category") for row in rows]
+    ids = facets.category_ids(conn, set(names))
+    for row, name in zip(rows, names):
+        row["category_id"] = ids.get(name)
+        row["latitude"], row["longitude"] = geo.coordinates(row["location"])
+    max_id = sa.select(sa.func.coalesce(sa.func.max(Book.id), 0))
+    last_id = conn.execute(max_id).scalar()
+    conn.execute(Book.__table__.insert(), rows)
+    facets.count_rows(conn, last_id)
+    geo.index_rows(conn, Book, last_id)
+    if search.is_enabled(conn):
+        search.index_rows(conn, last_id)
+    jobs.enqueue("matching.books", after_id=last_id, until_id=conn.execute(max_id).scalar())
+    db.session.commit()
+    cache.invalidate("books")
+
+
+@books_cli.command("import")
+@click.argument("source", type=click.File("r", encoding="utf-8-sig"))
+@click.option("--owner", required=True, help="Email of the account the listings belong to.")
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]),
+              help="Input format (default: from the file extension).")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows per insert transaction.")
+@click.option("--start", default=0, help="Skip this many data rows first (resume an import).")
+@click.option("--dry-run", is_flag=True, help="Validate only; write nothing.")
+def import_command(source, owner, fmt, batch_size, start, dry_run):
+    """Import book listings from a CSV or JSONL file (``-`` for stdin)."""
+    owner_id = db.session.execute(
+        sa.select(User.id).where(User.email == owner.lower().strip())
+    ).scalar()
+    # each batch is its own transaction; don't hold one open while reading the file
+    db.session.commit()
+    if owner_id is None:
+        raise click.ClickException(f"No user with email {owner}.")
+    fmt = fmt or ("jsonl" if source.name.endswith((".jsonl", ".ndjson", ".json")) else "csv")
+
+    form = BookImportForm()
+    started = time.perf_counter()
+    seen = imported = invalid = 0
+    batch = []
+
+    def flush():
+        nonlocal imported
+        if not dry_run:
+            _insert_batch(batch)
+        imported += len(batch)
+        batch.clear()
+        rate = (seen - start) / max(time.perf_counter() - started, 1e-9)
+        verb = "validated" if dry_run else "committed"
+        click.echo(f"{verb} through row {seen}: {imported} imported, {invalid} invalid, {rate:,.0f} rows/s", err=True)
+
+    try:
+        for seen, row in enumerate(read_rows(source, fmt), start=1):
+            if seen <= start:
+                continue
+            values, errors = validate_row(form, row)
+            if errors:
+                invalid += 1
+                if invalid <= MAX_REPORTED_ERRORS:
+                    click.echo(f"row {seen}: {errors}", err=True)
+                continue
+            values["owner_id"] = owner_id
+            batch.append(values)
+            if len(batch) >= batch_size:
+                flush()
+    except (csv.Error, json.JSONDecodeError) as exc:
+        if batch:
+            flush()
+        click.echo(f"Stopped at row {seen + 1}: {exc}", err=True)
+        sys.exit(1)
+    if batch:
+        flush()
+
+    if imported and not dry_run and isinstance(cache.backend, MemoryBackend):
+        click.echo("CACHE_BACKEND is 'memory': running web workers keep their cached pages "
+                   "until CACHE_DEFAULT_TIMEOUT.", err=True)
+    elapsed = time.perf_counter() - started
+    rate = (seen - start) / max(elapsed, 1e-9)
+    click.echo(
+        f"{'Would import' if dry_run else 'Imported'} {imported} books "
+        f"({invalid} invalid rows skipped) in {elapsed:.1f}s, {rate:,.0f} rows/s."
+    )
+
+
+def init_app(app):
+    app.cli.add_command(books_cli)
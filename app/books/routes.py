@@ -1,19 +1,19 @@
-import os, uuid, secrets
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app
-from app import db
-from app.models import Book, Review, Wishlist, BuyRequest
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from app import db, search, images, export, facets, geo, recommend, storage, wishlist
+from app.models import Book, Review, BuyRequest, Category
 from app.forms import BookForm, ReviewForm, BuyRequestForm
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
-from datetime import datetime, date
+import sqlalchemy as sa
 from sqlalchemy.orm import joinedload
+from app.utils import paginate_request, next_page_url
+from app.cache import cached
+from app.ratelimit import limit
 
 # ✅ Define Blueprint here
 # app/books/routes.py
 books_bp = Blueprint("books", __name__)
 
 
-UPLOAD_FOLDER = os.path.join("app", "static", "uploads")
 ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "gif"}
 
 
@@ -23,31 +23,23 @@ def allowed_file(filename):
 
 
 
+def _created(resp):
+    # only successful posts (which redirect) use up the daily quota
+    return resp.status_code == 302
+
+
 @books_bp.route("/create", methods=["GET", "POST"])
 @login_required
+@limit("10/day", deduct_when=_created, message="You can only post 10 books per day.")
 def create_book():
-    # Count how many books this user has posted today
-    today_start = datetime.combine(date.today(), datetime.min.time())
-    today_end = datetime.combine(date.today(), datetime.max.time())
-    user_books_today = Book.query.filter(
-        Book.owner_id == current_user.id,
-        Book.created_at >= today_start,
-        Book.created_at <= today_end
-    ).count()
-
-    if user_books_today >= 10:
-        flash("You can only post 10 books per day.", "warning")
-        return redirect(url_for("books.browse"))
-
     form = BookForm()
     if form.validate_on_submit():
         filename = None
 
         if form.image.data and allowed_file(form.image.data.filename):
-            ext = form.image.data.filename.rsplit(".", 1)[1].lower()
-            filename = f"{current_user.id}_{uuid.uuid4().hex}.{ext}"
-            save_path = os.path.join(current_app.root_path, "static/uploads", filename)
-            form.image.data.save(save_path)
+            filename, new = storage.store.save(form.image.data)
+            if new:
+                images.enqueue(filename)
 
         price = None if form.is_free.data else form.price.data
 
@@ -57,7 +49,7 @@ def create_book():
             condition=form.condition.data,
             is_free=form.is_free.data,
             price=price,
-            category=form.category.data.strip() if form.category.data else None,
+            category=facets.resolve(form.category.data) if form.category.data else None,
             location=form.location.data.strip() if form.location.data else None,
             image_file=filename,
             description=form.description.data.strip() if form.description.data else None,
@@ -95,83 +87,107 @@ def book_detail(book_id):
         flash("Thanks for the review.", "success")
         return redirect(url_for("books.book_detail", book_id=book.id))
 
-    # Check if the current user has wishlisted this book
-    wished = False
-    if current_user.is_authenticated:
-        wished = Wishlist.query.filter_by(user_id=current_user.id, book_id=book.id).first() is not None
+    wished = current_user.is_authenticated and book.id in wishlist.wished_ids(current_user.id, [book.id])
 
     # Calculate average rating and reviews
     avg = book.avg_rating()
-    reviews = book.reviews.order_by(Review.created_at.desc()).all()
+    reviews = book.reviews.options(joinedload(Review.author)).order_by(Review.created_at.desc()).all()
+    also_wanted = recommend.also_wanted(book.id)
 
-    return render_template("books/book_detail.html", book=book, form=form, wished=wished, avg=avg, reviews=reviews)
+    return render_template("books/book_detail.html", book=book, form=form, wished=wished, avg=avg, reviews=reviews,
+                           also_wanted=also_wanted)
 
 @books_bp.route("/toggle-wishlist/<int:book_id>", methods=["POST"])
 @login_required
+@limit("60/minute", scope="wishlist")
 def toggle_wishlist(book_id):
+    """``action=add|remove`` sets the state; without it the state is toggled."""
     book = Book.query.get_or_404(book_id)
-    item = Wishlist.query.filter_by(user_id=current_user.id, book_id=book.id).first()
+    wished = wishlist.apply(current_user.id, book.id, request.form.get("action"))
+    db.session.commit()
+    return jsonify({"status": "added" if wished else "removed"})
 
-    if item:
-        # Remove from wishlist
-        db.session.delete(item)
-        db.session.commit()
-        return jsonify({"status": "removed"})
-    else:
-        # Add to wishlist
-        w = Wishlist(user_id=current_user.id, book_id=book.id)
-        db.session.add(w)
-        db.session.commit()
-        return jsonify({"status": "added"})
 
+@books_bp.route("/wishlist/state")
+@login_required
+def wishlist_state():
+    """``?ids=1,2,3`` -> which of those books the current user has wishlisted."""
+    try:
+        ids = {int(i) for i in request.args.get("ids", "").split(",") if i}
+    except ValueError:
+        return jsonify({"error": "ids must be integers"}), 400
+    ids = list(ids)[:BROWSE_PER_PAGE * 4]
+    return jsonify({"wished": sorted(wishlist.wished_ids(current_user.id, ids))})
 
-@books_bp.route("/browse")
-def browse():
-    q = request.args.get("q", "")
-    condition = request.args.get("condition", "")
-    free = request.args.get("free") == "1"
-    category = request.args.get("category", "")
+
+BROWSE_PER_PAGE = 24
+REQUESTS_PER_PAGE = 24
+
+# feed order: newest first, id breaks ties so the cursor is unique
+BOOK_FEED_KEYS = [(Book.created_at, True), (Book.id, True)]
+REQUEST_FEED_KEYS = [(BuyRequest.created_at, True), (BuyRequest.id, True)]
+
+
+def browse_query(args):
+    """The browse filters in ``args`` applied to ``Book.query``; returns (query, pagination keys).
+
+    Besides ``q`` these are the facets: ``category`` (a category key or name),
+    ``condition``, ``free`` (1 or 0) and ``price`` (a bucket, see app.facets);
+    and ``near``/``radius``/``sort=distance`` (see app.geo).
+    """
+    q = args.get("q", "")
 
     books = Book.query
+    keys = BOOK_FEED_KEYS
     if q:
-        like = f"%{q}%"
-        books = books.filter(Book.title.ilike(like) | Book.author.ilike(like) | Book.description.ilike(like))
-    if condition in ("new", "used"):
-        books = books.filter_by(condition=condition)
-    if free:
-        books = books.filter_by(is_free=True)
-    if category:
-        books = books.filter(Book.category.ilike(f"%{category}%"))
+        books, rank = search.filter_books(books, q)
+        if rank is not None:
+            keys = [(rank, False), (Book.id, True)]
+    return geo.near_feed(facets.filter_books(books, args), Book, args, keys)
 
-    books = books.order_by(Book.created_at.desc()).limit(100).all()
-    return render_template("books/list_books.html", books=books)
+
+def _browse_page():
+    books, keys = browse_query(request.args)
+    return paginate_request(books, keys, per_page=BROWSE_PER_PAGE)
+
+
+@books_bp.route("/browse")
+@cached("books")
+def browse():
+    page = _browse_page()
+    return render_template(
+        "books/list_books.html",
+        books=page.items,
+        facets=facets.facet_counts(request.args, "books.browse"),
+        near=geo.selected(request.args),
+        next_url=next_page_url(page, "books.browse"),
+        more_url=next_page_url(page, "books.browse_more"),
+    )
+
+
+@books_bp.route("/browse/more")
+@cached("books", anonymous_only=False)
+def browse_more():
+    """JSON "load more" for the browse grid: rendered cards plus the next cursor."""
+    page = _browse_page()
+    return jsonify({
+        "html": render_template("books/_book_cards.html", books=page.items),
+        "next_cursor": page.next_cursor,
+        "more_url": next_page_url(page, "books.browse_more"),
+    })
 
 
 @books_bp.route("/buyrequest/new", methods=["GET", "POST"])
 @login_required
+@limit("10/day", deduct_when=_created, message="You can only post 10 buy requests per day.")
 def create_buyrequest():
-    # Count how many buy requests this user has posted today
-    today_start = datetime.combine(date.today(), datetime.min.time())
-    today_end = datetime.combine(date.today(), datetime.max.time())
-    user_requests_today = BuyRequest.query.filter(
-        BuyRequest.user_id == current_user.id,
-        BuyRequest.created_at >= today_start,
-        BuyRequest.created_at <= today_end
-    ).count()
-
-    if user_requests_today >= 10:
-        flash("You can only post 10 buy requests per day.", "warning")
-        return redirect(url_for("books.buy_requests"))
-
     form = BuyRequestForm()
     if form.validate_on_submit():
         filename = None
         if form.image.data:
-            random_hex = secrets.token_hex(8)
-            _, f_ext = os.path.splitext(secure_filename(form.image.data.filename))
-            filename = random_hex + f_ext
-            filepath = os.path.join(current_app.root_path, "static/uploads", filename)
-            form.image.data.save(filepath)
+            filename, new = storage.store.save(form.image.data)
+            if new:
+                images.enqueue(filename)
 
         buy_request = BuyRequest(
             title=form.title.data,
@@ -193,17 +209,66 @@ def create_buyrequest():
 
 
 
+def buy_requests_query(args):
+    """``BuyRequest.query`` with the ``near`` filter in ``args``; returns (query, pagination keys)."""
+    return geo.near_feed(BuyRequest.query, BuyRequest, args, REQUEST_FEED_KEYS)
+
+
+def _buy_requests_page():
+    requests, keys = buy_requests_query(request.args)
+    return paginate_request(requests, keys, per_page=REQUESTS_PER_PAGE)
+
+
 @books_bp.route("/buy-requests")
+@cached("buy_requests")
 def buy_requests():
-    requests = BuyRequest.query.order_by(BuyRequest.created_at.desc()).limit(50).all()
-    return render_template("books/buy_requests.html", requests=requests)
+    page = _buy_requests_page()
+    return render_template(
+        "books/buy_requests.html",
+        requests=page.items,
+        near=geo.selected(request.args),
+        next_url=next_page_url(page, "books.buy_requests"),
+        more_url=next_page_url(page, "books.buy_requests_more"),
+    )
+
+
+@books_bp.route("/buy-requests/more")
+@cached("buy_requests", anonymous_only=False)
+def buy_requests_more():
+    page = _buy_requests_page()
+    return jsonify({
+        "html": render_template("books/_request_cards.html", requests=page.items),
+        "next_cursor": page.next_cursor,
+        "more_url": next_page_url(page, "books.buy_requests_more"),
+    })
+
+
+# public columns only; owner contact details stay behind the site's pages
+BOOK_EXPORT_COLUMNS = [
+    Book.id, Book.title, Book.author, Book.price, Book.is_free, Book.condition,
+    sa.select(Category.name).where(Category.id == Book.category_id).scalar_subquery().label("category"),
+    Book.location, Book.description, Book.image_file, Book.review_count, Book.rating_sum, Book.created_at,
+]
+REQUEST_EXPORT_COLUMNS = [
+    BuyRequest.id, BuyRequest.title, BuyRequest.author, BuyRequest.details, BuyRequest.budget,
+    BuyRequest.is_free, BuyRequest.location, BuyRequest.image_file, BuyRequest.created_at,
+]
+
+
+@books_bp.route("/export")
+@limit("60/hour", key="ip", methods=("GET",), scope="export")
+def export_books():
+    """All listings as NDJSON or CSV; see app.export for ``format`` and ``since``."""
+    return export.stream_export("books", BOOK_EXPORT_COLUMNS, Book.created_at, Book.id)
+
+
+@books_bp.route("/buy-requests/export")
+@limit("60/hour", key="ip", methods=("GET",), scope="export")
+def export_buy_requests():
+    return export.stream_export("buy_requests", REQUEST_EXPORT_COLUMNS, BuyRequest.created_at, BuyRequest.id)
 
 
 @books_bp.route("/buyrequest/<int:request_id>")
 def buy_request_detail(request_id):
-    buy_request = BuyRequest.query.get_or_404(request_id)
-    print("DEBUG:", buy_request.user)        # Should not be None
-    if buy_request.user:
-        print("DEBUG phone:", buy_request.user.phone)
-
+    buy_request = BuyRequest.query.options(joinedload(BuyRequest.user)).filter_by(id=request_id).first_or_404()
     return render_template("books/buy_request_detail.html", buy_request=buy_request)
@@ -0,0 +1,337 @@
+"""Response caching for public pages.
+
+Cached entries are keyed by endpoint, full query string and the current
+*generation* of every namespace the view depends on ("books",
+"buy_requests"). Committing a change to a model in a namespace bumps its
+generation, so stale entries are never read again and simply age out of the
+backend. Generations live in the backend itself, which keeps invalidation
+consistent across workers when the shared SQLite store is used.
+
+Backends (``CACHE_BACKEND``):
+
+* ``memory`` -- per-process LRU bounded by entry count and total bytes, with TTL
+* ``sqlite`` -- a local SQLite file shared by every worker on the box
+* ``null``   -- caching disabled
+
+Whole responses are cached with the ``cached`` view decorator; templates can
+cache rendered pieces with the ``cache_fragment`` call block. Hit/miss
+counters for this worker are exported at ``/metrics`` (app.metrics).
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from itertools import chain
+
+import sqlalchemy as sa
+from flask import make_response, request, session
+from markupsafe import Markup
+from flask_login import current_user
+
+from app import metrics
+from app.models import Book, BuyRequest, Category, Review
+
+# which cache namespaces a committed change to each model invalidates
+MODEL_NAMESPACES = {
+    Book: "books",
+    Review: "books",  # reviews change the rating aggregates shown on cards
+    Category: "books",
+    BuyRequest: "buy_requests",
+}
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def generation(self, namespace):
+        return 0
+
+    def bump(self, namespace):
+        pass
+
+
+class MemoryBackend:
+    """Thread-safe LRU with per-entry expiry, bounded by count and size."""
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expires, size, value)
+        self._bytes = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(key)
+                return None
+            self._data.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, value, timeout):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic() + timeout, size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._data)))
+
+    def _drop(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def generation(self, namespace):
+        return self._generations.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+
+class SQLiteBackend:
+    """Cache stored in a local SQLite file, shared by all worker processes."""
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._sets = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_generation "
+                "(namespace TEXT PRIMARY KEY, generation INTEGER NOT NULL)"
+            )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value, timeout):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + timeout),
+        )
+        self._sets += 1
+        if self._sets % 100 == 0:
+            self._prune(conn)
+
+    def _prune(self, conn):
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires "
+            "LIMIT max(0, (SELECT count(*) FROM cache) - ?))",
+            (self.max_entries,),
+        )
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._conn().execute("DELETE FROM cache")
+
+    def generation(self, namespace):
+        row = self._conn().execute(
+            "SELECT generation FROM cache_generation WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, namespace):
+        self._conn().execute(
+            "INSERT INTO cache_generation (namespace, generation) VALUES (?, 1) "
+            "ON CONFLICT(namespace) DO UPDATE SET generation = generation + 1",
+            (namespace,),
+        )
+
+
+def _sizeof(value):
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(_sizeof(v) for v in value) + 64
+    return 64
+
+
+class Cache:
+    def __init__(self):
+        self.backend = NullBackend()
+        self.default_timeout = 60
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "invalidations": 0}
+        self._stats_lock = threading.Lock()
+
+    def init_app(self, app):
+        kind = app.config.get("CACHE_BACKEND", "memory")
+        self.default_timeout = app.config.get("CACHE_DEFAULT_TIMEOUT", 60)
+        if kind == "memory":
+            self.backend = MemoryBackend(
+                max_entries=app.config.get("CACHE_MAX_ENTRIES", 1024),
+                max_bytes=app.config.get("CACHE_MAX_BYTES", 64 * 1024 * 1024),
+            )
+        elif kind == "sqlite":
+            path = app.config.get("CACHE_SQLITE_PATH") or os.path.join(app.instance_path, "cache.sqlite")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.backend = SQLiteBackend(path, max_entries=app.config.get("CACHE_MAX_ENTRIES", 10000))
+        elif kind == "null":
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f"unknown CACHE_BACKEND {kind!r}")
+        metrics.collector("cache", self.metric_lines)
+        app.add_template_global(cache_fragment)
+
+    def _count(self, stat, n=1):
+        with self._stats_lock:
+            self.stats[stat] += n
+
+    def snapshot(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def metric_lines(self):
+        samples = {(event,): n for event, n in self.snapshot().items()}
+        return metrics.family("cache_events_total", "Page cache hits, misses, sets and invalidations.",
+                              "counter", ("event",), samples)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout or self.default_timeout)
+        self._count("sets")
+
+    def invalidate(self, *namespaces):
+        for ns in namespaces:
+            self.backend.bump(ns)
+        self._count("invalidations", len(namespaces))
+
+    def clear(self):
+        self.backend.clear()
+
+    def key(self, name, namespaces, *parts):
+        gens = ",".join(f"{ns}={self.backend.generation(ns)}" for ns in namespaces)
+        return "|".join((name, gens) + tuple(str(p) for p in parts))
+
+
+cache = Cache()
+
+
+def _request_key(namespaces):
+    args = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+    return cache.key(f"view:{request.endpoint}", namespaces, request.path, args)
+
+
+def cached(*namespaces, timeout=None, anonymous_only=True):
+    """Cache a view's 200 responses until a namespace changes or ``timeout`` expires.
+
+    With ``anonymous_only`` (the default) logged-in users, who see a
+    personalised navbar, always get a fresh render, as does anyone with
+    flashed messages pending.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or "_flashes" in session or (
+                anonymous_only and current_user.is_authenticated
+            ):
+                return view(*args, **kwargs)
+
+            key = _request_key(namespaces)
+            hit = cache.get(key)
+            if hit is not None:
+                body, status, headers = hit
+                return body, status, {**headers, "X-Cache": "HIT"}
+
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code == 200 and not resp.direct_passthrough:
+                headers = {"Content-Type": resp.headers["Content-Type"]}
+                cache.set(key, (resp.get_data(), resp.status_code, headers), timeout)
+            resp.headers["X-Cache"] = "MISS"
+            return resp
+        return wrapper
+    return decorator
+
+
+def cache_fragment(name, *namespaces, timeout=None, caller=None):
+    """Jinja call block caching a rendered fragment::
+
+        {% call cache_fragment("book-grid:" ~ ids, "books") %}...{% endcall %}
+    """
+    key = cache.key(f"fragment:{name}", namespaces)
+    html = cache.get(key)
+    if html is None:
+        html = str(caller())
+        cache.set(key, html, timeout)
+    return Markup(html)
+
+
+def _touched(session_):
+    return session_.info.setdefault("cache_namespaces", set())
+
+
+@sa.event.listens_for(sa.orm.Session, "after_flush")
+def _collect_namespaces(session_, flush_context):
+    touched = _touched(session_)
+    for obj in chain(session_.new, session_.dirty, session_.deleted):
+        ns = MODEL_NAMESPACES.get(type(obj))
+        if ns:
+            touched.add(ns)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_commit")
+def _invalidate_committed(session_):
+    touched = session_.info.pop("cache_namespaces", None)
+    if touched:
+        cache.invalidate(*touched)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_soft_rollback")
+def _discard_rolled_back(session_, previous_transaction):
+    session_.info.pop("cache_namespaces", None)
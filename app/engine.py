@@ -0,0 +1,185 @@
+"""SQLite engine tuning and read/write routing.
+
+Every SQLite connection gets the pragmas in ``SQLITE_PRAGMAS`` when it is
+opened (WAL journal, synchronous=NORMAL, busy_timeout, cache and mmap sizes).
+Transactions on the primary engine start with ``BEGIN IMMEDIATE`` outside
+read-only requests, taking the write lock up front; a deferred transaction
+that reads first and upgrades to a writer later fails immediately with
+"database is locked" when another writer got there first, and busy_timeout
+can't retry that case. Code outside a request that only reads -- the job
+worker's poll of an idle queue, reporting commands -- runs under
+``deferred()`` so it doesn't queue on the write lock or hold writers up.
+
+With ``SQLITE_READ_ENGINE`` enabled a second, read-only engine is bound as
+``"read"`` and ``RoutingSession`` sends every query issued while serving a
+GET/HEAD request to it, leaving the primary pool to writers. Flushes and
+INSERT/UPDATE/DELETE statements always go to the primary engine.
+"""
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+import sqlalchemy as sa
+from flask import has_request_context, request
+from flask.cli import AppGroup
+from flask_sqlalchemy.session import Session
+
+READ_BIND = "read"
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+engine_cli = AppGroup("engine", help="Database engine commands.")
+
+_deferred = contextvars.ContextVar("sqlite_deferred", default=False)
+
+
+def _read_only_request():
+    return has_request_context() and request.method in READ_METHODS
+
+
+@contextmanager
+def deferred():
+    """Begin primary-engine transactions with a plain ``BEGIN`` inside the block.
+
+    Only for transactions that don't write; also usable as a decorator.
+    """
+    token = _deferred.set(True)
+    try:
+        yield
+    finally:
+        _deferred.reset(token)
+
+
+class RoutingSession(Session):
+    """Session that reads from the read-only engine during GET/HEAD requests."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        writing = self._flushing or getattr(clause, "is_dml", False)
+        if bind is None and not writing and _read_only_request():
+            engine = self._db.engines.get(READ_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only_url(url):
+    """``sqlite:///path`` -> the same file opened read-only through a URI filename."""
+    url = sa.engine.make_url(url)
+    return url.set(database=f"file:{url.database}", query={"mode": "ro", "uri": "true"})
+
+
+def configure(app):
+    """Add the read-only bind to the config. Call before ``db.init_app``."""
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI", "")
+    if not (app.config.get("SQLITE_READ_ENGINE") and uri.startswith("sqlite:///")):
+        return
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+    options = dict(app.config.get("SQLALCHEMY_READ_ENGINE_OPTIONS", {}))
+    options["url"] = read_only_url(uri)
+    binds.setdefault(READ_BIND, options)
+
+
+def _install(engine, pragmas, read_only):
+    @sa.event.listens_for(engine, "connect")
+    def _on_connect(dbapi_conn, record):
+        # take over transaction control from pysqlite so "begin" below decides the mode
+        dbapi_conn.isolation_level = None
+        cur = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            if read_only and name == "journal_mode":
+                continue
+            cur.execute(f"PRAGMA {name} = {value}")
+        cur.close()
+
+    @sa.event.listens_for(engine, "begin")
+    def _on_begin(conn):
+        if read_only or _deferred.get() or _read_only_request():
+            conn.exec_driver_sql("BEGIN")
+        else:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def init_app(app, db):
+    pragmas = app.config.get("SQLITE_PRAGMAS", {})
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.dialect.name == "sqlite":
+                _install(engine, pragmas, read_only=key == READ_BIND)
+    app.cli.add_command(engine_cli)
+
+
+@engine_cli.command("stress")
+@click.option("--readers", default=8, help="Reader threads.")
+@click.option("--writers", default=4, help="Writer threads.")
+@click.option("--seconds", default=5.0, help="How long to run.")
+def stress_command(readers, writers, seconds):
+    """Run concurrent readers and writers against a scratch copy of the schema.
+
+    Exits non-zero if any thread hit a lock error or made no progress.
+    """
+    import tempfile
+    from app import create_app, db
+    from app.models import Book, User
+    from config import Config
+
+    tmp = tempfile.mkdtemp()
+
+    class StressConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmp, 'stress.sqlite')}"
+        SQLITE_READ_ENGINE = True
+        CACHE_BACKEND = "null"
+        IMAGE_WORKERS = 0
+
+    app = create_app(StressConfig)
+    with app.app_context():
+        db.create_all()
+        owner = User(name="Stress", email="stress@example.com", phone="000000", password_hash="x")
+        db.session.add(owner)
+        db.session.commit()
+        owner_id = owner.id
+
+    done = time.monotonic() + seconds
+    counts = {"reads": [0] * readers, "writes": [0] * writers}
+    errors = []
+
+    def reader(i):
+        while time.monotonic() < done:
+            try:
+                with app.test_request_context("/", method="GET"):
+                    Book.query.order_by(Book.created_at.desc(), Book.id.desc()).limit(24).all()
+                    db.session.remove()
+                counts["reads"][i] += 1
+            except sa.exc.OperationalError as exc:
+                errors.append(str(exc.orig))
+
+    def writer(i):
+        while time.monotonic() < done:
+            try:
+                with app.test_request_context("/", method="POST"):
+                    db.session.add(Book(title=f"stress {i}", owner_id=owner_id))
+                    db.session.commit()
+                    db.session.remove()
+                counts["writes"][i] += 1
+            except sa.exc.OperationalError as exc:
+                errors.append(str(exc.orig))
+            time.sleep(random.random() / 1000)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    click.echo(f"reads:  {sum(counts['reads'])} ({counts['reads']})")
+    click.echo(f"writes: {sum(counts['writes'])} ({counts['writes']})")
+    click.echo(f"errors: {len(errors)}")
+    for msg in sorted(set(errors)):
+        click.echo(f"  {msg}")
+    stalled = [n for n in counts["reads"] + counts["writes"] if n == 0]
+    if errors or stalled:
+        sys.exit(1)
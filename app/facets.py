@@ -0,0 +1,340 @@
+"""Listing categories and browse facet counts.
+
+Categories live in their own table and listings point at them. Free-text
+input is folded to a ``key`` by ``category_key``: case, accents, spacing,
+punctuation and a trailing plural are ignored, so "Fiction", " fiction" and
+"Fictions" are one category. The name is kept as it was first entered.
+
+``book_facet_count`` holds the number of listings per (category, condition,
+free, price bucket) cell. Mapper events on ``Book`` adjust it in the same
+transaction as the listing, like the rating aggregates in app.ratings.
+``flask facets rebuild`` recomputes it.
+
+``facet_counts`` answers the browse sidebar with one grouped aggregate. Without
+a search or ``near`` filter it reads the count table, which holds one row per
+cell; with either it groups the matching listings. Either result is cached in the
+"books" namespace and covers every filter combination. Each facet's counts
+apply all *other* active filters, so picking a category still shows how many
+listings the other categories have.
+"""
+import re
+
+import click
+import sqlalchemy as sa
+from flask import url_for
+from flask.cli import AppGroup
+
+from app import db, geo, search
+from app.cache import cache
+from app.matching import normalize
+from app.models import Book, BookFacetCount, Category
+
+facets_cli = AppGroup("facets", help="Category and facet count commands.")
+
+# paid listings by price; free listings and those without a price are NO_BUCKET
+PRICE_BUCKETS = (("0-500", 0, 500), ("500-1000", 500, 1000), ("1000-2000", 1000, 2000), ("2000-up", 2000, None))
+NO_BUCKET = -1
+CONDITIONS = ("new", "used")
+MAX_CATEGORIES = 20
+FACETS_TIMEOUT = 300
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_counts = BookFacetCount.__table__
+_category = Category.__table__
+
+
+# --- categories ----------------------------------------------------------------
+
+def category_key(name):
+    """Normalized category name: "Science  Fictions" -> "science-fiction"."""
+    words = _WORD_RE.findall(normalize(name))
+    if words:
+        last = words[-1]
+        if len(last) > 3 and last.endswith("s") and not last.endswith(("ss", "us", "is", "ics")):
+            words[-1] = last[:-1]
+    return "-".join(words)[:120]
+
+
+def _display_name(name):
+    return " ".join(name.split())[:120]
+
+
+def resolve(name):
+    """The ``Category`` for free-text ``name``, added to the session if new; None for blank input."""
+    key = category_key(name)
+    if not key:
+        return None
+    category = Category.query.filter_by(key=key).first()
+    if category is None:
+        category = Category(key=key, name=_display_name(name))
+        db.session.add(category)
+    return category
+
+
+def category_ids(connection, names):
+    """{name: category id} for bulk inserts, creating missing categories."""
+    keys = {name: category_key(name) for name in names if name}
+    keys = {name: key for name, key in keys.items() if key}
+    if not keys:
+        return {}
+    existing = dict(connection.execute(
+        sa.select(_category.c.key, _category.c.id).where(_category.c.key.in_(set(keys.values())))
+    ).all())
+    new = {}
+    for name, key in keys.items():
+        if key not in existing and key not in new:
+            new[key] = _display_name(name)
+    if new:
+        connection.execute(_category.insert(), [{"key": k, "name": n} for k, n in new.items()])
+        existing.update(connection.execute(
+            sa.select(_category.c.key, _category.c.id).where(_category.c.key.in_(new))
+        ).all())
+    return {name: existing[key] for name, key in keys.items()}
+
+
+# --- facet count maintenance -----------------------------------------------------
+
+def price_bucket(is_free, price):
+    if is_free or price is None:
+        return NO_BUCKET
+    for i, (_, _, high) in enumerate(PRICE_BUCKETS):
+        if high is None or price < high:
+            return i
+
+
+def bucket_expr():
+    """SQL version of ``price_bucket`` over the book table."""
+    whens = [(sa.or_(Book.is_free.is_(True), Book.price.is_(None)), NO_BUCKET)]
+    whens += [(Book.price < high, i) for i, (_, _, high) in enumerate(PRICE_BUCKETS) if high is not None]
+    return sa.case(*whens, else_=len(PRICE_BUCKETS) - 1)
+
+
+def _cell(category_id, condition, is_free, price):
+    return {
+        "category_id": category_id or 0,
+        "condition": condition or "",
+        "is_free": bool(is_free),
+        "price_bucket": price_bucket(is_free, price),
+    }
+
+
+def _adjust(connection, cell, delta):
+    where = [_counts.c[name] == value for name, value in cell.items()]
+    updated = connection.execute(
+        _counts.update().where(*where).values(count=_counts.c.count + delta)
+    ).rowcount
+    if not updated:
+        connection.execute(_counts.insert().values(**cell, count=delta))
+
+
+_FACET_ATTRS = ("category_id", "condition", "is_free", "price")
+
+
+def _book_cell(book):
+    return _cell(book.category_id, book.condition, book.is_free, book.price)
+
+
+@sa.event.listens_for(Book, "after_insert")
+def _book_added(mapper, connection, book):
+    _adjust(connection, _book_cell(book), 1)
+
+
+@sa.event.listens_for(Book, "after_delete")
+def _book_deleted(mapper, connection, book):
+    _adjust(connection, _book_cell(book), -1)
+
+
+@sa.event.listens_for(Book, "after_update")
+def _book_changed(mapper, connection, book):
+    state = sa.inspect(book)
+    if not any(state.attrs[a].history.has_changes() for a in _FACET_ATTRS):
+        return
+    old = {}
+    for attr in _FACET_ATTRS:
+        history = state.attrs[attr].history
+        old[attr] = history.deleted[0] if history.deleted else getattr(book, attr)
+    before, after = _cell(**old), _book_cell(book)
+    if before != after:
+        _adjust(connection, before, -1)
+        _adjust(connection, after, 1)
+
+
+def _grouped(where=None):
+    """(category_id, condition, is_free, price_bucket, count) over the book table."""
+    cell = (
+        sa.func.coalesce(Book.category_id, 0), sa.func.coalesce(Book.condition, ""),
+        sa.func.coalesce(Book.is_free, False), bucket_expr(),
+    )
+    stmt = sa.select(*cell, sa.func.count()).group_by(*cell)
+    if where is not None:
+        stmt = stmt.where(where)
+    return stmt
+
+
+def count_rows(connection, after_id=0):
+    """Add every book with ``id > after_id`` to the counts; for rows bulk-inserted with Core."""
+    for category_id, condition, is_free, bucket, n in connection.execute(_grouped(Book.id > after_id)).all():
+        cell = {"category_id": category_id, "condition": condition, "is_free": bool(is_free), "price_bucket": bucket}
+        _adjust(connection, cell, n)
+
+
+def rebuild():
+    """Recompute the facet counts from the book table. Returns the number of cells."""
+    with db.engine.begin() as conn:
+        conn.execute(_counts.delete())
+        rows = conn.execute(_grouped()).all()
+        if rows:
+            conn.execute(_counts.insert(), [
+                {"category_id": c, "condition": cond, "is_free": bool(free), "price_bucket": b, "count": n}
+                for c, cond, free, b, n in rows
+            ])
+        return len(rows)
+
+
+# --- browse facets ---------------------------------------------------------------
+
+def selected(args):
+    """The facet filters in ``args``, normalized; absent ones are None."""
+    condition = args.get("condition", "")
+    free = args.get("free", "")
+    price = args.get("price", "")
+    return {
+        "category": category_key(args.get("category", "")) or None,
+        "condition": condition if condition in CONDITIONS else None,
+        "free": {"1": True, "0": False}.get(free),
+        "price": next((i for i, (label, _, _) in enumerate(PRICE_BUCKETS) if label == price), None),
+    }
+
+
+def filter_books(query, args):
+    """Apply the facet filters in ``args`` to a ``Book`` query."""
+    active = selected(args)
+    if active["category"]:
+        category_id = sa.select(Category.id).where(Category.key == active["category"]).scalar_subquery()
+        query = query.filter(Book.category_id == category_id)
+    if active["condition"]:
+        query = query.filter(Book.condition == active["condition"])
+    if active["free"] is True:
+        query = query.filter(Book.is_free.is_(True))
+    elif active["free"] is False:
+        query = query.filter(Book.is_free.is_not(True))
+    if active["price"] is not None:
+        _, low, high = PRICE_BUCKETS[active["price"]]
+        query = query.filter(Book.is_free.is_not(True), Book.price >= low)
+        if high is not None:
+            query = query.filter(Book.price < high)
+    return query
+
+
+def _cells(args):
+    """[(category key, category name, condition, is_free, bucket, count)], from the cache if possible.
+
+    The cells cover the listings matching the search and ``near`` filter in ``args``.
+    """
+    q = args.get("q", "").strip()
+    near = geo.selected(args)
+    scope = f"{q}|{near.latitude},{near.longitude},{near.radius}" if near else q
+    key = cache.key(f"facets:{scope}", ("books",))
+    rows = cache.get(key)
+    if rows is not None:
+        return rows
+    if q or near:
+        matched = search.filter_books(Book.query, q)[0] if q else Book.query
+        matched, _ = geo.filter_near(matched, Book, args)
+        stmt = (
+            matched.with_entities(
+                Category.key, Category.name, Book.condition, Book.is_free, bucket_expr(), sa.func.count()
+            )
+            .outerjoin(Category, Category.id == Book.category_id)
+            .group_by(Category.key, Category.name, Book.condition, Book.is_free, bucket_expr())
+            .statement
+        )
+    else:
+        stmt = (
+            sa.select(Category.key, Category.name, _counts.c.condition, _counts.c.is_free,
+                      _counts.c.price_bucket, _counts.c.count)
+            .select_from(_counts.outerjoin(Category, Category.id == _counts.c.category_id))
+            .where(_counts.c.count > 0)
+        )
+    rows = [(k, n, cond or "", bool(free), b, c) for k, n, cond, free, b, c in db.session.execute(stmt)]
+    cache.set(key, rows, FACETS_TIMEOUT)
+    return rows
+
+
+FACETS = ("category", "condition", "free", "price")
+
+
+def facet_counts(args, endpoint=None):
+    """{"total": n, "category": [...], "condition": [...], "free": [...], "price": [...]}.
+
+    Each facet entry is ``{"value", "label", "count", "active"}``; values are
+    what the browse page takes in its query string. With ``endpoint`` every
+    entry also gets a ``url`` that toggles its filter on the current page.
+    """
+    active = selected(args)
+    rows = [
+        {"category": key, "name": name, "condition": cond or None, "free": free,
+         "price": bucket if bucket != NO_BUCKET else None, "count": n}
+        for key, name, cond, free, bucket, n in _cells(args)
+    ]
+
+    def matches(row, skip=None):
+        return all(
+            value is None or name == skip or row[name] == value
+            for name, value in active.items()
+        )
+
+    def tally(facet):
+        counts, labels = {}, {}
+        for row in rows:
+            value = row[facet]
+            if value is None or not matches(row, skip=facet):
+                continue
+            counts[value] = counts.get(value, 0) + row["count"]
+            labels.setdefault(value, row["name"])
+        return counts, labels
+
+    categories, names = tally("category")
+    conditions, _ = tally("condition")
+    free, _ = tally("free")
+    prices, _ = tally("price")
+    top = sorted(categories.items(), key=lambda kv: (-kv[1], kv[0]))[:MAX_CATEGORIES]
+    result = {
+        "total": sum(row["count"] for row in rows if matches(row)),
+        "category": [
+            {"value": key, "label": names[key], "count": n, "active": key == active["category"]}
+            for key, n in top
+        ],
+        "condition": [
+            {"value": c, "label": c.capitalize(), "count": conditions.get(c, 0), "active": c == active["condition"]}
+            for c in CONDITIONS
+        ],
+        "free": [
+            {"value": v, "label": label, "count": free.get(flag, 0), "active": flag is active["free"]}
+            for v, label, flag in (("1", "Free", True), ("0", "Paid", False))
+        ],
+        "price": [
+            {"value": label, "label": f"Rs {low}+" if high is None else f"Rs {low}–{high}",
+             "count": prices.get(i, 0), "active": i == active["price"]}
+            for i, (label, low, high) in enumerate(PRICE_BUCKETS)
+        ],
+    }
+    if endpoint:
+        params = {k: v for k, v in args.items() if k != "cursor"}
+        for facet in FACETS:
+            for option in result[facet]:
+                toggled = {k: v for k, v in params.items() if k != facet}
+                if not option["active"]:
+                    toggled[facet] = option["value"]
+                option["url"] = url_for(endpoint, **toggled)
+    return result
+
+
+@facets_cli.command("rebuild")
+def rebuild_command():
+    """Recompute the facet counts from the book table."""
+    click.echo(f"Rebuilt {rebuild()} facet count cells.")
+
+
+def init_app(app):
+    app.cli.add_command(facets_cli)
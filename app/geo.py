@@ -0,0 +1,395 @@
+"""Listing locations: gazetteer lookup and radius search.
+
+Locations are typed as free text. ``lookup`` resolves them against the
+gazetteer bundled as ``app/data/gazetteer.csv``: cities and well-known areas
+within them, each with coordinates and alternative spellings. "Gulberg,
+Lahore", "gulberg" and "Gulberg III" all resolve to the same area. An area
+name that several cities share ("DHA", "Saddar") only resolves when the city
+is mentioned too. Text naming no known place resolves to nothing.
+
+Mapper events fill ``latitude``/``longitude`` on ``Book`` and ``BuyRequest``
+whenever ``location`` changes and mirror them into SQLite R*Tree tables
+(``book_geo``, ``buy_request_geo``) keyed by the row id, the way app.search
+mirrors listings into FTS. ``flask geo rebuild`` re-resolves every location,
+e.g. after the gazetteer grew, and repopulates the R*Trees.
+
+``filter_near`` applies the ``near`` (a place, or "lat,lon") and ``radius``
+(km) filter, ``near_feed`` also ``sort=distance``. Candidates come from the
+circle's bounding box, through the R*Tree when it holds few rows, and a
+distance check on the row's own coordinates drops the corners. Distances are
+equirectangular: within a fraction of a percent at these radii, with no SQL
+math functions needed. They are compared squared.
+"""
+import csv
+import math
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+
+from app import db
+from app.matching import normalize
+from app.models import Book, BuyRequest
+from app.utils import InvalidCursor, decode_cursor
+
+geo_cli = AppGroup("geo", help="Location and spatial index commands.")
+
+GAZETTEER = os.path.join(os.path.dirname(__file__), "data", "gazetteer.csv")
+KM_PER_DEGREE = 111.32
+DEFAULT_RADIUS_KM = 25
+MAX_RADIUS_KM = 500
+RADIUS_CHOICES = (5, 10, 25, 50, 100)
+# up to this many rows in the circle's bounding box are fetched through the R*Tree
+SPARSE_ROWS = 1000
+# nearest-first rings must hold a full page plus the look-ahead row; 101 covers the API's largest page
+PAGE_ROWS = 101
+MIN_RING_KM = 0.5
+
+# key: "lahore" or "lahore/gulberg"; label: "Gulberg, Lahore"; parent: the city's key for an area
+Place = namedtuple("Place", "key label parent latitude longitude")
+# a resolved ``near`` filter; latitude/longitude are None when the place is unknown
+Near = namedtuple("Near", "text label latitude longitude radius")
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_POINT_RE = re.compile(r"^\s*(-?\d{1,2}(?:\.\d+)?)\s*,\s*(-?\d{1,3}(?:\.\d+)?)\s*$")
+
+# the R*Tree mirror of each model's coordinates; a point is a zero-size box
+MIRRORS = {Book: "book_geo", BuyRequest: "buy_request_geo"}
+_BOX = ("min_lat", "max_lat", "min_lon", "max_lon")
+_mirrors = {name: sa.table(name, sa.column("id"), *(sa.column(c) for c in _BOX)) for name in MIRRORS.values()}
+
+
+def is_enabled(bind):
+    return bind.dialect.name == "sqlite"
+
+
+def _create_ddl(name):
+    return f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING rtree(id, {', '.join(_BOX)})"
+
+
+def _drop_ddl(name):
+    return f"DROP TABLE IF EXISTS {name}"
+
+
+for _name in MIRRORS.values():
+    sa.event.listen(db.metadata, "after_create", sa.DDL(_create_ddl(_name)).execute_if(dialect="sqlite"))
+    sa.event.listen(db.metadata, "before_drop", sa.DDL(_drop_ddl(_name)).execute_if(dialect="sqlite"))
+
+
+# --- gazetteer -------------------------------------------------------------------
+
+def _words(text):
+    return _WORD_RE.findall(normalize(text))
+
+
+@lru_cache(maxsize=None)
+def _gazetteer():
+    """``({phrase: [Place, ...]}, longest phrase in words)`` over names and aliases."""
+    with open(GAZETTEER, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    names = {row["key"]: row["name"] for row in rows}
+    index = {}
+    for row in rows:
+        parent = row["parent"] or None
+        label = f"{row['name']}, {names[parent]}" if parent else row["name"]
+        place = Place(row["key"], label, parent, float(row["latitude"]), float(row["longitude"]))
+        for phrase in [row["name"], *filter(None, row["aliases"].split("|"))]:
+            index.setdefault(" ".join(_words(phrase)), []).append(place)
+    return index, max(len(phrase.split()) for phrase in index)
+
+
+def places():
+    """Every place in the gazetteer."""
+    index, _ = _gazetteer()
+    return list({p.key: p for matches in index.values() for p in matches}.values())
+
+
+@lru_cache(maxsize=4096)
+def lookup(text):
+    """The ``Place`` that free-text ``text`` names, or None.
+
+    Every run of words is looked up, longest first. An area inside a city that
+    is also mentioned wins, then the city, then an area whose longest matching
+    name belongs to it alone.
+    """
+    words = _words(text or "")
+    index, longest = _gazetteer()
+    found = []  # (words matched, place), longest match first
+    for n in range(min(longest, len(words)), 0, -1):
+        for i in range(len(words) - n + 1):
+            found.extend((n, place) for place in index.get(" ".join(words[i:i + n]), ()))
+    cities = {place.key: place for _, place in found if place.parent is None}
+    areas = [(n, place) for n, place in found if place.parent is not None]
+    for _, place in areas:
+        if place.parent in cities:
+            return place
+    if cities:
+        return next(iter(cities.values()))
+    if areas:
+        best = {place.key: place for n, place in areas if n == areas[0][0]}
+        if len(best) == 1:
+            return best.popitem()[1]
+    return None
+
+
+def coordinates(text):
+    """``(latitude, longitude)`` of the place ``text`` names, or ``(None, None)``."""
+    place = lookup(text) if text else None
+    return (place.latitude, place.longitude) if place else (None, None)
+
+
+# --- coordinates and the R*Tree mirrors --------------------------------------------
+
+def _locate(mapper, connection, target):
+    target.latitude, target.longitude = coordinates(target.location)
+
+
+def _location_changed(mapper, connection, target):
+    if sa.inspect(target).attrs.location.history.has_changes():
+        _locate(mapper, connection, target)
+
+
+def _mirror(connection, target):
+    if not is_enabled(connection):
+        return
+    table = _mirrors[MIRRORS[type(target)]]
+    if target.latitude is None or target.longitude is None:
+        connection.execute(table.delete().where(table.c.id == target.id))
+        return
+    connection.execute(table.insert().prefix_with("OR REPLACE").values(
+        id=target.id, min_lat=target.latitude, max_lat=target.latitude,
+        min_lon=target.longitude, max_lon=target.longitude,
+    ))
+
+
+def _mirror_insert(mapper, connection, target):
+    if target.latitude is not None:
+        _mirror(connection, target)
+
+
+def _mirror_update(mapper, connection, target):
+    state = sa.inspect(target)
+    if state.attrs.latitude.history.has_changes() or state.attrs.longitude.history.has_changes():
+        _mirror(connection, target)
+
+
+def _mirror_delete(mapper, connection, target):
+    if is_enabled(connection):
+        table = _mirrors[MIRRORS[type(target)]]
+        connection.execute(table.delete().where(table.c.id == target.id))
+
+
+for _model in MIRRORS:
+    sa.event.listen(_model, "before_insert", _locate)
+    sa.event.listen(_model, "before_update", _location_changed)
+    sa.event.listen(_model, "after_insert", _mirror_insert)
+    sa.event.listen(_model, "after_update", _mirror_update)
+    sa.event.listen(_model, "after_delete", _mirror_delete)
+
+
+def index_rows(connection, model, after_id=0):
+    """Mirror the coordinates of every ``model`` row with ``id > after_id``; for Core bulk inserts."""
+    table = model.__table__.name
+    connection.exec_driver_sql(
+        f"INSERT OR REPLACE INTO {MIRRORS[model]}(id, {', '.join(_BOX)}) "
+        f"SELECT id, latitude, latitude, longitude, longitude FROM {table} "
+        "WHERE id > ? AND latitude IS NOT NULL AND longitude IS NOT NULL",
+        (after_id,),
+    )
+
+
+def rebuild():
+    """Re-resolve every location and repopulate the R*Trees. Returns {table: rows located}."""
+    counts = {}
+    with db.engine.begin() as conn:
+        for model, name in MIRRORS.items():
+            t = model.__table__
+            changed = []
+            for id_, location, old_lat, old_lon in conn.execute(
+                sa.select(t.c.id, t.c.location, t.c.latitude, t.c.longitude)
+            ):
+                lat, lon = coordinates(location)
+                if (lat, lon) != (old_lat, old_lon):
+                    changed.append({"row_id": id_, "lat": lat, "lon": lon})
+            if changed:
+                conn.execute(
+                    t.update().where(t.c.id == sa.bindparam("row_id"))
+                    .values(latitude=sa.bindparam("lat"), longitude=sa.bindparam("lon"), updated_at=datetime.utcnow()),
+                    changed,
+                )
+            if is_enabled(conn):
+                conn.exec_driver_sql(_drop_ddl(name))
+                conn.exec_driver_sql(_create_ddl(name))
+                index_rows(conn, model)
+            counts[t.name] = conn.execute(
+                sa.select(sa.func.count()).select_from(t).where(t.c.latitude.is_not(None))
+            ).scalar()
+    return counts
+
+
+# --- radius search ---------------------------------------------------------------
+
+def selected(args):
+    """The ``near``/``radius`` filter in ``args`` as a ``Near``; None without ``near``."""
+    text = args.get("near", "").strip()[:140]
+    if not text:
+        return None
+    try:
+        radius = float(args.get("radius", DEFAULT_RADIUS_KM))
+    except ValueError:
+        radius = DEFAULT_RADIUS_KM
+    radius = min(radius, MAX_RADIUS_KM) if radius >= 1 else DEFAULT_RADIUS_KM
+    m = _POINT_RE.match(text)
+    if m:
+        lat, lon = float(m.group(1)), float(m.group(2))
+        if abs(lat) <= 90 and abs(lon) <= 180:
+            return Near(text, text, lat, lon, radius)
+        return Near(text, text, None, None, radius)
+    place = lookup(text)
+    if place is None:
+        return Near(text, text, None, None, radius)
+    return Near(text, place.label, place.latitude, place.longitude, radius)
+
+
+def distance_sq(model, latitude, longitude):
+    """Squared distance in km² between (latitude, longitude) and a ``model`` row."""
+    kx = KM_PER_DEGREE * math.cos(math.radians(latitude))
+    dy = (model.latitude - latitude) * KM_PER_DEGREE
+    dx = (model.longitude - longitude) * kx
+    return dy * dy + dx * dx
+
+
+def _box(latitude, longitude, radius):
+    """(min lat, max lat, min lon, max lon) around the circle."""
+    dlat = radius / KM_PER_DEGREE
+    dlon = radius / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    return latitude - dlat, latitude + dlat, longitude - dlon, longitude + dlon
+
+
+def _in_box(columns, box):
+    return sa.and_(columns.max_lat >= box[0], columns.min_lat <= box[1],
+                   columns.max_lon >= box[2], columns.min_lon <= box[3])
+
+
+def _through_rtree(query, model, box):
+    """``query`` joined to the R*Tree entries inside ``box``; SQLite drives the join from the R*Tree."""
+    mirror = _mirrors[MIRRORS[model]]
+    return query.join(mirror, mirror.c.id == model.id).filter(_in_box(mirror.c, box))
+
+
+def _sparse(model, box):
+    """Whether fewer than ``SPARSE_ROWS`` rows lie in ``box``; reads at most that many R*Tree entries."""
+    mirror = _mirrors[MIRRORS[model]]
+    hits = sa.select(mirror.c.id).where(_in_box(mirror.c, box)).limit(SPARSE_ROWS).subquery()
+    return db.session.execute(sa.select(sa.func.count()).select_from(hits)).scalar() < SPARSE_ROWS
+
+
+def _has_rows(query, n):
+    """Whether ``query`` returns at least ``n`` rows; stops reading after ``n``."""
+    rows = query.with_entities(sa.literal(1)).order_by(None).limit(n).subquery()
+    return db.session.execute(sa.select(sa.func.count()).select_from(rows)).scalar() >= n
+
+
+def filter_near(query, model, args, paged=False):
+    """Restrict a ``model`` query to rows within ``radius`` km of ``near``.
+
+    Returns ``(query, distance)``; ``distance`` is the squared distance
+    expression, or None without a usable ``near``. An unknown place matches
+    nothing. Rows are fetched through the R*Tree, except for a ``paged``
+    query (read a page at a time in index order) around a circle with many
+    rows: there the rows' own coordinates are checked as the index walks past
+    them, which fills a page quickly because matches are common.
+    """
+    near = selected(args)
+    if near is None:
+        return query, None
+    if near.latitude is None:
+        return query.filter(sa.false()), None
+    distance = distance_sq(model, near.latitude, near.longitude)
+    box = _box(near.latitude, near.longitude, near.radius)
+    if is_enabled(db.engine) and (not paged or _sparse(model, box)):
+        query = _through_rtree(query, model, box)
+    else:
+        query = query.filter(model.latitude.between(box[0], box[1]), model.longitude.between(box[2], box[3]))
+    return query.filter(distance <= near.radius ** 2), distance
+
+
+def _cursor_distance(args, keys):
+    """The squared distance a ``sort=distance`` cursor in ``args`` continues from; None on the first page."""
+    try:
+        return float(decode_cursor(args["cursor"], keys)[0]) if args.get("cursor") else None
+    except (InvalidCursor, TypeError, ValueError):
+        return None  # paginate_request rejects it
+
+
+def _page_radius(query, model, near, distance, after):
+    """A radius, at most ``near.radius``, whose ring beyond ``after`` holds ``PAGE_ROWS`` rows.
+
+    Rows past the ring are further away than every row in it, so the next page
+    in distance order lies inside it. The ring starts ``MIN_RING_KM`` wide and
+    grows 4x per try, so a page takes a few cheap counting queries: each stops
+    after ``PAGE_ROWS`` rows. Rows tied at exactly ``after`` aren't counted,
+    which can only make the ring larger than necessary.
+    """
+    inner = 0.0 if after is None else math.sqrt(after)
+    width = MIN_RING_KM
+    while inner + width < near.radius:
+        radius = inner + width
+        ring = _through_rtree(query, model, _box(near.latitude, near.longitude, radius))
+        ring = ring.filter(distance <= radius ** 2)
+        if after is not None:
+            ring = ring.filter(distance > after)
+        if _has_rows(ring, PAGE_ROWS):
+            return radius
+        width *= 4
+    return near.radius
+
+
+def near_feed(query, model, args, keys):
+    """Apply the ``near`` filter and ``sort=distance`` in ``args`` to a feed.
+
+    Returns ``(query, pagination keys)``: nearest first with ``sort=distance``,
+    otherwise ``keys``. Nearest-first pages only read the rows in the ring that
+    holds the next page (see ``_page_radius``), so their cost doesn't grow
+    with the radius.
+    """
+    near = selected(args)
+    if near is None or args.get("sort") != "distance":
+        return filter_near(query, model, args, paged=True)[0], keys
+    if near.latitude is None:
+        return query.filter(sa.false()), keys
+    distance = distance_sq(model, near.latitude, near.longitude)
+    keys = [(distance, False), (model.id, False)]
+    if not is_enabled(db.engine):
+        return filter_near(query, model, args)[0], keys
+    radius = _page_radius(query, model, near, distance, _cursor_distance(args, keys))
+    box = _box(near.latitude, near.longitude, radius)
+    return _through_rtree(query, model, box).filter(distance <= radius ** 2), keys
+
+
+@geo_cli.command("lookup")
+@click.argument("text")
+def lookup_command(text):
+    """Show which place TEXT resolves to."""
+    place = lookup(text)
+    if place is None:
+        raise click.ClickException(f"No place found for {text!r}.")
+    click.echo(f"{place.label} ({place.key}): {place.latitude}, {place.longitude}")
+
+
+@geo_cli.command("rebuild")
+def rebuild_command():
+    """Re-resolve all locations and rebuild the spatial index."""
+    for table, count in rebuild().items():
+        click.echo(f"{table}: {count} rows located.")
+
+
+def init_app(app):
+    # for _near_form.html
+    app.jinja_env.globals.update(near_radii=RADIUS_CHOICES, default_radius=DEFAULT_RADIUS_KM)
+    app.cli.add_command(geo_cli)
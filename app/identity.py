@@ -0,0 +1,97 @@
+"""Cached user loading for Flask-Login.
+
+``load_user`` returns a ``UserSnapshot`` -- the handful of columns the
+navbar and profile pages show -- from a small cache instead of querying the
+``user`` table on every authenticated request. Anything else (relationships,
+``password_hash``) is read from the real ``User`` row, loaded on first
+access. Views that change a user must edit ``current_user.record`` and call
+``invalidate`` after committing.
+
+Backends (``IDENTITY_CACHE_BACKEND``) are the page cache's: ``memory``
+(per worker), ``sqlite`` (shared by workers on one box) or ``null``. With the
+per-worker backend other workers may serve a stale name or avatar for up to
+``IDENTITY_CACHE_TIMEOUT`` seconds after a change.
+"""
+import os
+
+from flask_login import UserMixin
+
+from app import db, login_manager
+from app.cache import MemoryBackend, NullBackend, SQLiteBackend
+from app.models import User
+
+SNAPSHOT_FIELDS = ("id", "name", "email", "phone", "avatar_file", "created_at")
+
+
+class UserSnapshot(UserMixin):
+    """Read-only stand-in for ``User`` built from cached column values."""
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+    @property
+    def record(self):
+        """The full ``User`` row, loaded from the database on first access."""
+        user = self.__dict__.get("_record")
+        if user is None:
+            user = self.__dict__["_record"] = db.session.get(User, self.id)
+        return user
+
+    def __getattr__(self, name):
+        # only reached for attributes that aren't in the snapshot
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.record, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"UserSnapshot is read-only; set {name!r} on .record instead")
+
+    def __repr__(self):
+        return f"<UserSnapshot {self.id}>"
+
+
+class IdentityCache:
+    def __init__(self):
+        self.backend = NullBackend()
+        self.timeout = 60
+
+    def init_app(self, app):
+        kind = app.config.get("IDENTITY_CACHE_BACKEND", "memory")
+        self.timeout = app.config.get("IDENTITY_CACHE_TIMEOUT", 60)
+        max_entries = app.config.get("IDENTITY_CACHE_MAX_ENTRIES", 10000)
+        if kind == "memory":
+            self.backend = MemoryBackend(max_entries=max_entries, max_bytes=max_entries * 1024)
+        elif kind == "sqlite":
+            path = app.config.get("IDENTITY_CACHE_SQLITE_PATH") or os.path.join(app.instance_path, "identity.sqlite")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.backend = SQLiteBackend(path, max_entries=max_entries)
+        elif kind == "null":
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f"unknown IDENTITY_CACHE_BACKEND {kind!r}")
+        login_manager.user_loader(load_user)
+
+    def get(self, user_id):
+        fields = self.backend.get(f"user:{user_id}")
+        if fields is not None:
+            return UserSnapshot(fields)
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        fields = {name: getattr(user, name) for name in SNAPSHOT_FIELDS}
+        self.backend.set(f"user:{user_id}", fields, self.timeout)
+        return UserSnapshot(dict(fields, _record=user))
+
+    def invalidate(self, user_id):
+        self.backend.delete(f"user:{user_id}")
+
+
+identity_cache = IdentityCache()
+
+
+def load_user(user_id):
+    return identity_cache.get(int(user_id))
+
+
+def invalidate(user_id):
+    identity_cache.invalidate(user_id)
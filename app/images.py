@@ -0,0 +1,163 @@
+"""Background image processing for uploads.
+
+After an upload is stored, ``enqueue`` hands its key to a small worker pool
+that decodes it, applies and strips EXIF, and stores downscaled variants next
+to the original (see app.storage)::
+
+    3f/a2/3fa2...e9.jpg -> 3f/a2/3fa2...e9_thumb.webp, 3f/a2/3fa2...e9_thumb.jpg,
+                           3f/a2/3fa2...e9_card.webp, ... 3f/a2/3fa2...e9_full.jpg
+
+Templates use ``image_variants`` (via the ``picture`` macro in
+``_images.html``) to build ``srcset`` attributes. For stored uploads that
+costs no storage call: the variants are assumed to exist, and while they are
+still being made the browser gets a 404 and the macro's ``onerror`` handler
+switches to the original. Legacy uploads in ``static/`` keep the variants
+they already have, checked on local disk. Pillow is optional: without it the pipeline
+is disabled and the originals are served as before.
+"""
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+
+from app import db, storage
+from app.models import StoredFile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = ImageOps = None
+
+log = logging.getLogger(__name__)
+
+# name -> longest edge in pixels
+VARIANTS = {"thumb": 160, "card": 480, "full": 1600}
+FORMATS = (("webp", "WEBP"), ("jpg", "JPEG"))
+QUALITY = {"WEBP": 80, "JPEG": 82}
+
+_executor = None
+_static_folder = None
+
+images_cli = AppGroup("images", help="Uploaded image commands.")
+
+
+def variant_name(filename, variant, ext):
+    stem = filename.rsplit(".", 1)[0]
+    return f"{stem}_{variant}.{ext}"
+
+
+def _smallest():
+    return min(VARIANTS, key=VARIANTS.get)
+
+
+def variant_names(filename):
+    """All derived file names for an uploaded ``filename``."""
+    return [variant_name(filename, v, ext) for v in VARIANTS for ext, _ in FORMATS]
+
+
+def _encode(img, fmt):
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=QUALITY[fmt], optimize=True)
+    return buf.getvalue()
+
+
+def process(key):
+    """Store every variant of the stored image ``key``. Safe to call more than once."""
+    backend = storage.store.backend
+    with backend.open(key) as f, Image.open(f) as src:
+        # let the JPEG decoder downscale while decoding; far cheaper than a full decode
+        longest = max(VARIANTS.values())
+        src.draft("RGB", (longest, longest))
+        img = ImageOps.exif_transpose(src)
+        img = img.convert("RGB")  # drops EXIF/ICC metadata and alpha
+
+    # largest first so each step resizes an already-smaller image; the last file
+    # written (smallest JPEG) marks the set as complete, see image_variants()
+    for variant, edge in sorted(VARIANTS.items(), key=lambda kv: -kv[1]):
+        img.thumbnail((edge, edge), Image.LANCZOS)
+        for ext, fmt in FORMATS:
+            backend.put(variant_name(key, variant, ext), _encode(img, fmt))
+    return variant_names(key)
+
+
+def _run(key):
+    try:
+        process(key)
+    except Exception:
+        log.exception("image processing failed for %s", key)
+
+
+def enqueue(key):
+    """Process the stored image ``key`` in the background; returns immediately."""
+    if Image is None:
+        return None
+    if _executor is None:
+        _run(key)
+        return None
+    return _executor.submit(_run, key)
+
+
+def _processed(key):
+    # the smallest JPEG is written last, see process()
+    return storage.store.backend.exists(variant_name(key, _smallest(), "jpg"))
+
+
+def image_variants(folder, filename):
+    """``{"webp": srcset, "jpg": srcset, "src": url, "original": url}`` for an upload with variants, else None.
+
+    Stored uploads are not looked up (one storage round trip per image on a
+    page); the client falls back to ``original`` when a variant is missing.
+    """
+    if not filename:
+        return None
+    if storage.is_key(filename):
+        if Image is None:
+            return None
+    elif not os.path.exists(os.path.join(_static_folder, folder, variant_name(filename, _smallest(), "jpg"))):
+        return None
+
+    def url(variant, ext):
+        return storage.file_url(folder, variant_name(filename, variant, ext))
+
+    out = {
+        ext: ", ".join(f"{url(v, ext)} {edge}w" for v, edge in VARIANTS.items())
+        for ext, _ in FORMATS
+    }
+    out["src"] = url("card", "jpg")
+    out["original"] = storage.file_url(folder, filename)
+    return out
+
+
+@images_cli.command("process")
+@click.option("--force", is_flag=True, help="Regenerate variants that already exist.")
+def process_command(force):
+    """Generate variants for stored uploads that don't have them yet."""
+    if Image is None:
+        raise click.ClickException("Pillow is not installed.")
+    done = 0
+    keys = db.session.execute(sa.select(StoredFile.key).order_by(StoredFile.key)).scalars().all()
+    for key in keys:
+        if not force and _processed(key):
+            continue
+        try:
+            process(key)
+            done += 1
+        except Exception as exc:
+            click.echo(f"skipped {key}: {exc}", err=True)
+    click.echo(f"Processed {done} images.")
+
+
+def init_app(app):
+    global _executor, _static_folder
+    _static_folder = app.static_folder
+    workers = app.config.get("IMAGE_WORKERS", 2)
+    if Image is None:
+        log.warning("Pillow is not installed; image variants are disabled")
+    elif workers and _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="images")
+    app.add_template_global(image_variants)
+    app.cli.add_command(images_cli)
@@ -0,0 +1,235 @@
+"""Durable background jobs stored in the ``job`` table.
+
+``enqueue(name, **payload)`` adds a job to the current session, so it is
+committed -- or rolled back -- together with the change that called for it.
+``flask jobs worker`` polls for due jobs and runs each one with the function
+registered under its name by ``@task``.
+
+Claiming a job marks it ``running`` and moves ``available_at`` forward by
+``JOBS_VISIBILITY_TIMEOUT``: a worker that dies mid-job doesn't lose it, the
+job becomes claimable again once that lease runs out. A job that raises is
+retried after an exponential, jittered backoff until ``max_attempts`` is used
+up, then left as ``failed`` with its traceback (``flask jobs retry`` requeues
+it). Finished jobs are deleted.
+
+Delivery is at-least-once, so tasks must be safe to run twice. Tasks commit
+their own writes.
+"""
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import db, engine
+from app.models import Job
+
+jobs_cli = AppGroup("jobs", help="Background job queue commands.")
+
+PENDING = ("queued", "running")
+
+_tasks = {}
+
+
+def task(name):
+    """Register the decorated function as the handler for jobs called ``name``."""
+    def decorator(fn):
+        _tasks[name] = fn
+        return fn
+    return decorator
+
+
+def enqueue(name, delay=0, unique=False, **payload):
+    """Add a job to the session (the caller commits).
+
+    With ``unique`` nothing is added while a job of the same name is still
+    pending; use it for jobs that do a full pass, like ``uploads.gc``.
+    """
+    if unique:
+        pending = db.session.execute(
+            sa.select(Job.id).where(Job.name == name, Job.status.in_(PENDING)).limit(1)
+        ).first()
+        if pending:
+            return None
+    job = Job(
+        name=name,
+        payload=payload,
+        max_attempts=current_app.config.get("JOBS_MAX_ATTEMPTS", 5),
+        available_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    return job
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that failed ``attempts`` times."""
+    base = current_app.config.get("JOBS_BACKOFF_BASE", 10)
+    cap = current_app.config.get("JOBS_BACKOFF_MAX", 3600)
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+def claim(worker_id):
+    """Lease the next due job to ``worker_id`` and return it, or None."""
+    lease = current_app.config.get("JOBS_VISIBILITY_TIMEOUT", 300)
+    # an idle queue is polled without taking the write lock
+    with engine.deferred():
+        due = db.session.execute(
+            sa.select(Job.id).where(Job.status.in_(PENDING), Job.available_at <= datetime.utcnow()).limit(1)
+        ).first()
+        db.session.commit()
+    if due is None:
+        return None
+    while True:
+        now = datetime.utcnow()
+        job = (
+            Job.query.filter(Job.status.in_(PENDING), Job.available_at <= now)
+            .order_by(Job.available_at, Job.id)
+            .first()
+        )
+        if job is None:
+            db.session.commit()
+            return None
+        if job.attempts >= job.max_attempts:
+            # its last lease ran out without the worker reporting back
+            job.status = "failed"
+            job.last_error = job.last_error or f"lease expired on attempt {job.attempts}"
+            db.session.commit()
+            continue
+        # conditional on what we read, so two workers can't both take it
+        claimed = db.session.execute(
+            sa.update(Job)
+            .where(Job.id == job.id, Job.status == job.status, Job.available_at == job.available_at)
+            .values(
+                status="running",
+                attempts=Job.attempts + 1,
+                available_at=now + timedelta(seconds=lease),
+                locked_by=worker_id,
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return job
+
+
+def run(job):
+    """Run a claimed job and record the outcome. Returns True if it succeeded."""
+    job_id, name, attempts, max_attempts = job.id, job.name, job.attempts, job.max_attempts
+    # the lease is ours while nobody else has claimed the job since
+    ours = (Job.id == job_id, Job.status == "running", Job.attempts == attempts)
+    try:
+        handler = _tasks.get(name)
+        if handler is None:
+            raise LookupError(f"no task registered for {name!r}")
+        handler(**job.payload)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        current_app.logger.warning("job %s (%s) failed on attempt %s", job_id, name, attempts)
+        if attempts >= max_attempts:
+            values = {"status": "failed", "last_error": error}
+        else:
+            retry_at = datetime.utcnow() + timedelta(seconds=backoff(attempts))
+            values = {"status": "queued", "available_at": retry_at, "last_error": error}
+        db.session.execute(sa.update(Job).where(*ours).values(**values))
+        db.session.commit()
+        return False
+    db.session.execute(sa.delete(Job).where(*ours))
+    db.session.commit()
+    if job in db.session:
+        db.session.expunge(job)
+    return True
+
+
+def schedule_periodic(last_run):
+    """Enqueue the ``JOBS_SCHEDULE`` jobs whose interval has passed since ``last_run``."""
+    now = time.monotonic()
+    for name, every in current_app.config.get("JOBS_SCHEDULE", {}).items():
+        if now - last_run.get(name, float("-inf")) >= every:
+            enqueue(name, unique=True)
+            last_run[name] = now
+    db.session.commit()
+
+
+@jobs_cli.command("worker")
+@click.option("--once", is_flag=True, help="Run the jobs that are due, then exit.")
+@click.option("--poll", type=float, default=None, help="Seconds to sleep when the queue is empty.")
+def worker_command(once, poll):
+    """Run queued jobs until interrupted (SIGTERM finishes the current job first)."""
+    poll = poll if poll is not None else current_app.config.get("JOBS_POLL_INTERVAL", 2)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    last_run = {}
+    done = failed = 0
+    click.echo(f"Worker {worker_id} started.")
+    try:
+        while not stopping:
+            if not once:
+                schedule_periodic(last_run)
+            job = claim(worker_id)
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll)
+                continue
+            if run(job):
+                done += 1
+            else:
+                failed += 1
+    except KeyboardInterrupt:
+        pass
+    click.echo(f"Worker {worker_id} stopped: {done} done, {failed} failed.")
+
+
+@jobs_cli.command("enqueue")
+@click.argument("name")
+@click.option("--delay", default=0, help="Seconds before the job is due.")
+def enqueue_command(name, delay):
+    """Queue a job with no payload, e.g. ``uploads.gc``."""
+    if name not in _tasks:
+        raise click.ClickException(f"unknown task {name!r}; known: {', '.join(sorted(_tasks))}")
+    job = enqueue(name, delay=delay)
+    db.session.commit()
+    click.echo(f"Queued job {job.id}.")
+
+
+@jobs_cli.command("stats")
+@engine.deferred()
+def stats_command():
+    """Pending and failed jobs by name and status."""
+    rows = db.session.execute(
+        sa.select(Job.name, Job.status, sa.func.count(), sa.func.min(Job.available_at))
+        .group_by(Job.name, Job.status)
+        .order_by(Job.name, Job.status)
+    ).all()
+    if not rows:
+        click.echo("The queue is empty.")
+    for name, status, count, due in rows:
+        click.echo(f"{name:<24} {status:<8} {count:>6}  next {due:%Y-%m-%d %H:%M:%S}")
+
+
+@jobs_cli.command("retry")
+@click.option("--name", default=None, help="Only requeue failed jobs with this name.")
+def retry_command(name):
+    """Requeue failed jobs with a fresh set of attempts."""
+    stmt = sa.update(Job).where(Job.status == "failed")
+    if name:
+        stmt = stmt.where(Job.name == name)
+    count = db.session.execute(
+        stmt.values(status="queued", attempts=0, available_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    click.echo(f"Requeued {count} jobs.")
+
+
+def init_app(app):
+    app.cli.add_command(jobs_cli)
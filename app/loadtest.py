@@ -0,0 +1,185 @@
+"""Load tests for the production server.
+
+``flask serve loadtest`` drives a running server from several client
+processes. ``flask serve scaling`` starts gunicorn with each ``--workers``
+count in turn and reports throughput relative to one worker.
+
+Registered only when the app is loaded by the CLI, see ``create_app``.
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+from urllib.parse import urlsplit
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+serve_cli = AppGroup("serve", help="Production serving commands.")
+
+DEFAULT_PATHS = ("/", "/books/browse", "/api/v1/books")
+
+
+def _client_process(args):
+    """One client process: ``threads`` keep-alive connections hammering ``paths``."""
+    host, port, paths, threads, seconds = args
+    deadline = time.monotonic() + seconds
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def loop(offset):
+        conn = HTTPConnection(host, port, timeout=10)
+        mine, failed, i = [], 0, offset
+        while time.monotonic() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status >= 500:
+                    failed += 1
+                else:
+                    mine.append(time.perf_counter() - start)
+            except (OSError, ConnectionError):
+                failed += 1
+                conn.close()
+                conn = HTTPConnection(host, port, timeout=10)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    workers = [threading.Thread(target=loop, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return latencies, errors[0]
+
+
+def load(url, paths, concurrency, seconds, processes=None):
+    """Request ``paths`` round-robin for ``seconds``; returns rps, p50/p95 ms and errors."""
+    parts = urlsplit(url)
+    processes = max(1, min(processes or os.cpu_count() or 1, concurrency))
+    per_process = [concurrency // processes + (i < concurrency % processes) for i in range(processes)]
+    args = [(parts.hostname, parts.port or 80, list(paths), n, seconds) for n in per_process]
+    started = time.monotonic()
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        results = pool.map(_client_process, args)
+    elapsed = time.monotonic() - started
+    latencies = sorted(lat for lats, _ in results for lat in lats)
+    errors = sum(e for _, e in results)
+    if not latencies:
+        return {"requests": 0, "rps": 0.0, "p50_ms": None, "p95_ms": None, "errors": errors}
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+        "errors": errors,
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _ms(value):
+    """A latency for the report; "-" when a run had no successful requests."""
+    return "-" if value is None else value
+
+
+def _wait_ready(url, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request("GET", "/readyz")
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+@serve_cli.command("loadtest")
+@click.option("--url", default="http://127.0.0.1:8000", show_default=True, help="Server to load.")
+@click.option("--path", "paths", multiple=True, help="Path to request (repeatable).")
+@click.option("--concurrency", default=32, show_default=True, help="Concurrent connections.")
+@click.option("--seconds", default=10.0, show_default=True)
+@click.option("--processes", type=int, default=None, help="Client processes (default: CPU count).")
+def loadtest_command(url, paths, concurrency, seconds, processes):
+    """Load a running server and report throughput and latency."""
+    r = load(url, paths or DEFAULT_PATHS, concurrency, seconds, processes)
+    click.echo(f"{r['requests']} requests, {r['rps']} req/s, p50 {_ms(r['p50_ms'])}ms, "
+               f"p95 {_ms(r['p95_ms'])}ms, {r['errors']} errors")
+    if r["errors"]:
+        sys.exit(1)
+
+
+@serve_cli.command("scaling")
+@click.option("--workers", "worker_counts", default="1,2,4", show_default=True, help="Worker counts to compare.")
+@click.option("--threads", default=None, type=int, help="Threads per worker (default: gunicorn.conf.py).")
+@click.option("--path", "paths", multiple=True, help="Path to request (repeatable).")
+@click.option("--concurrency", default=32, show_default=True)
+@click.option("--seconds", default=10.0, show_default=True)
+@click.option("--min-efficiency", default=0.0, show_default=True,
+              help="Fail if rps / (workers x single-worker rps) drops below this, e.g. 0.6.")
+def scaling_command(worker_counts, threads, paths, concurrency, seconds, min_efficiency):
+    """Start gunicorn with each worker count and compare throughput.
+
+    Efficiency only means something up to the number of cores; the client
+    processes compete with the server for them, too.
+    """
+    root = os.path.dirname(current_app.root_path)
+    counts = [int(n) for n in worker_counts.split(",")]
+    rows = []
+    for workers in counts:
+        port = _free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, WEB_CONCURRENCY=str(workers), GUNICORN_BIND=f"127.0.0.1:{port}",
+                   GUNICORN_MAX_REQUESTS="0")
+        if threads:
+            env["GUNICORN_THREADS"] = str(threads)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+            cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not _wait_ready(url):
+                raise click.ClickException(f"gunicorn with {workers} workers didn't become ready")
+            rows.append((workers, load(url, paths or DEFAULT_PATHS, concurrency, seconds)))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+    base = rows[0][1]["rps"] / rows[0][0] or 1.0
+    click.echo(f"cores: {os.cpu_count()}")
+    click.echo(f"{'workers':>8}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}{'speedup':>9}{'eff.':>7}")
+    problems = []
+    for workers, r in rows:
+        speedup = r["rps"] / rows[0][1]["rps"] if rows[0][1]["rps"] else 0.0
+        efficiency = r["rps"] / (workers * base)
+        click.echo(f"{workers:>8}{r['rps']:>10}{_ms(r['p50_ms']):>9}{_ms(r['p95_ms']):>9}{r['errors']:>8}"
+                   f"{speedup:>9.2f}{efficiency:>7.2f}")
+        if r["errors"] or efficiency < min_efficiency:
+            problems.append(workers)
+    if problems:
+        sys.exit(1)
+
+
+def init_app(app):
+    app.cli.add_command(serve_cli)
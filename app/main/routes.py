@@ -1,14 +1,39 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, jsonify
 from app.models import Book, BuyRequest
+from app.books.routes import BOOK_FEED_KEYS
+from app.utils import paginate_request, next_page_url
+from app.cache import cached
 
 # Define blueprint
 main_bp = Blueprint("main", __name__)
 
+FEED_PER_PAGE = 12
+
+
 @main_bp.route("/")
+@cached("books", "buy_requests")
 def index():
-    listings = Book.query.order_by(Book.created_at.desc()).limit(12).all()
-    buy_requests = BuyRequest.query.order_by(BuyRequest.created_at.desc()).limit(10).all()
-    return render_template("main/index.html", listings=listings, buy_requests=buy_requests)
+    page = paginate_request(Book.query, BOOK_FEED_KEYS, per_page=FEED_PER_PAGE)
+    buy_requests = BuyRequest.query.order_by(BuyRequest.created_at.desc(), BuyRequest.id.desc()).limit(10).all()
+    return render_template(
+        "main/index.html",
+        listings=page.items,
+        buy_requests=buy_requests,
+        next_url=next_page_url(page, "main.index"),
+        more_url=next_page_url(page, "main.feed_more"),
+    )
+
+
+@main_bp.route("/feed/more")
+@cached("books", anonymous_only=False)
+def feed_more():
+    """JSON "load more" for the home page listing feed."""
+    page = paginate_request(Book.query, BOOK_FEED_KEYS, per_page=FEED_PER_PAGE)
+    return jsonify({
+        "html": render_template("books/_book_cards.html", books=page.items),
+        "next_cursor": page.next_cursor,
+        "more_url": next_page_url(page, "main.feed_more"),
+    })
 
 @main_bp.route("/privacy")
 def privacy():
@@ -0,0 +1,275 @@
+"""Matching new listings against open buy requests.
+
+Buy request titles and authors are tokenized into ``buy_request_token``, an
+inverted index keyed by ``(token, field, buy_request_id)`` and kept in sync
+by mapper events on ``BuyRequest``. When a ``Book`` is inserted, the tokens of
+its title and author are looked up in the index -- a few index range reads,
+independent of how many requests exist -- and the candidate requests are
+scored on:
+
+* title: share of the request's title tokens found in the listing's title
+* author: the same for the author, when the request names one
+* budget: the listing is free, or its price is within (or near) the budget
+* location: same city
+
+Requests scoring at least ``MIN_SCORE`` get a ``Match`` row, written in the
+same transaction as the listing; matches populate the requester's
+notifications page. Listings bulk-inserted by ``flask books import`` are
+matched afterwards by a ``matching.books`` job, one per committed batch.
+``flask matching rebuild`` recreates the index and ``flask matching run``
+matches existing listings.
+"""
+import re
+import unicodedata
+from collections import defaultdict
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+
+from app import db, jobs
+from app.models import Book, BuyRequest, BuyRequestToken, Match
+
+matching_cli = AppGroup("matching", help="Buy request matching commands.")
+
+STOPWORDS = frozenset(
+    "a an and the of to in on for by with from at or is are book books edition ed vol volume part new".split()
+)
+# tokens in more than this many requests carry no signal and would make lookups slow
+MAX_POSTINGS = 5000
+MAX_CANDIDATES = 200
+# tokens per IN list when looking up posting list lengths
+TOKEN_CHUNK = 500
+MIN_TITLE = 0.6
+MIN_SCORE = 0.6
+WEIGHTS = {"title": 0.55, "author": 0.2, "budget": 0.15, "location": 0.1}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_token = BuyRequestToken.__table__
+_request = BuyRequest.__table__
+_match = Match.__table__
+
+
+def normalize(text):
+    """Lowercase with accents stripped."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower().strip()
+
+
+def tokenize(text):
+    return {
+        word[:64] for word in _WORD_RE.findall(normalize(text))
+        if len(word) > 1 and word not in STOPWORDS
+    }
+
+
+# --- index maintenance --------------------------------------------------------
+
+def _postings(req):
+    return [
+        {"token": token, "field": field, "buy_request_id": req.id}
+        for field, text in (("t", req.title), ("a", req.author))
+        for token in tokenize(text)
+    ]
+
+
+def _index(connection, req):
+    rows = _postings(req)
+    if rows:
+        connection.execute(_token.insert(), rows)
+
+
+def _unindex(connection, request_id):
+    connection.execute(_token.delete().where(_token.c.buy_request_id == request_id))
+
+
+@sa.event.listens_for(BuyRequest, "after_insert")
+def _request_added(mapper, connection, req):
+    _index(connection, req)
+
+
+@sa.event.listens_for(BuyRequest, "after_update")
+def _request_changed(mapper, connection, req):
+    state = sa.inspect(req)
+    if state.attrs.title.history.has_changes() or state.attrs.author.history.has_changes():
+        _unindex(connection, req.id)
+        _index(connection, req)
+
+
+@sa.event.listens_for(BuyRequest, "after_delete")
+def _request_deleted(mapper, connection, req):
+    _unindex(connection, req.id)
+
+
+# --- matching ------------------------------------------------------------------
+
+def _budget_score(book, req):
+    if req.is_free:
+        return 1.0 if book.is_free else 0.0
+    if book.is_free:
+        return 1.0
+    if req.budget is None or book.price is None:
+        return 0.5
+    budget, price = float(req.budget), float(book.price)
+    if price <= budget:
+        return 1.0
+    return max(0.0, 1.0 - (price - budget) / budget) if budget else 0.0
+
+
+def _location_score(book, req):
+    if not book.location or not req.location:
+        return 0.5
+    return 1.0 if normalize(book.location) == normalize(req.location) else 0.0
+
+
+def score(title, author, budget, location):
+    return (
+        WEIGHTS["title"] * title + WEIGHTS["author"] * author
+        + WEIGHTS["budget"] * budget + WEIGHTS["location"] * location
+    )
+
+
+def _wanted(book):
+    return {"t": tokenize(book.title), "a": tokenize(book.author)}
+
+
+def common_tokens(connection, tokens):
+    """The subset of ``tokens`` found in more than ``MAX_POSTINGS`` requests.
+
+    One grouped query (per ``TOKEN_CHUNK`` tokens) for a whole set of listings,
+    rather than a count per token.
+    """
+    tokens, common = list(tokens), set()
+    for start in range(0, len(tokens), TOKEN_CHUNK):
+        common.update(connection.execute(
+            sa.select(_token.c.token)
+            .where(_token.c.token.in_(tokens[start:start + TOKEN_CHUNK]))
+            .group_by(_token.c.token)
+            .having(sa.func.count() > MAX_POSTINGS)
+        ).scalars())
+    return common
+
+
+def find_matches(connection, book, common=None):
+    """[(buy_request_id, user_id, score)] for the requests ``book`` satisfies.
+
+    ``common`` is the result of ``common_tokens`` when the caller already
+    looked it up for a batch of listings.
+    """
+    wanted = _wanted(book)
+    if not wanted["t"]:
+        return []
+
+    if common is None:
+        common = common_tokens(connection, wanted["t"] | wanted["a"])
+    clauses = [
+        sa.and_(_token.c.field == field, _token.c.token.in_(tokens - common))
+        for field, tokens in wanted.items() if tokens - common
+    ]
+    if not clauses:
+        return []
+    hits = defaultdict(dict)  # request id -> {field: matched tokens}
+    for request_id, field, n in connection.execute(
+        sa.select(_token.c.buy_request_id, _token.c.field, sa.func.count())
+        .where(sa.or_(*clauses))
+        .group_by(_token.c.buy_request_id, _token.c.field)
+    ):
+        hits[request_id][field] = n
+    candidates = sorted(
+        (rid for rid, h in hits.items() if "t" in h), key=lambda rid: -hits[rid]["t"]
+    )[:MAX_CANDIDATES]
+    if not candidates:
+        return []
+
+    totals = defaultdict(dict)
+    for request_id, field, n in connection.execute(
+        sa.select(_token.c.buy_request_id, _token.c.field, sa.func.count())
+        .where(_token.c.buy_request_id.in_(candidates))
+        .group_by(_token.c.buy_request_id, _token.c.field)
+    ):
+        totals[request_id][field] = n
+
+    matches = []
+    for req in connection.execute(
+        sa.select(_request.c.id, _request.c.user_id, _request.c.budget, _request.c.is_free, _request.c.location)
+        .where(_request.c.id.in_(candidates))
+    ):
+        if req.user_id == book.owner_id:
+            continue
+        title = hits[req.id]["t"] / totals[req.id]["t"]
+        if title < MIN_TITLE:
+            continue
+        budget = _budget_score(book, req)
+        if not budget:
+            continue  # a paid copy for a free request, or far over budget
+        author = hits[req.id].get("a", 0) / totals[req.id]["a"] if totals[req.id].get("a") else 0.5
+        total = score(title, author, budget, _location_score(book, req))
+        if total >= MIN_SCORE:
+            matches.append((req.id, req.user_id, round(total, 3)))
+    return matches
+
+
+def match_book(connection, book, common=None):
+    """Write ``Match`` rows for ``book``. Returns how many were found."""
+    found = find_matches(connection, book, common)
+    if found:
+        connection.execute(
+            _match.insert().prefix_with("OR IGNORE", dialect="sqlite"),
+            [{"buy_request_id": rid, "user_id": uid, "book_id": book.id, "score": s} for rid, uid, s in found],
+        )
+    return len(found)
+
+
+def match_books_after(connection, after_id, until_id=None):
+    """Match every listing with ``after_id < id <= until_id``; for rows bulk-inserted with Core."""
+    cols = [Book.id, Book.title, Book.author, Book.price, Book.is_free, Book.location, Book.owner_id]
+    query = sa.select(*cols).where(Book.id > after_id).order_by(Book.id)
+    if until_id is not None:
+        query = query.where(Book.id <= until_id)
+    rows = connection.execute(query).all()
+    wanted = [_wanted(row) for row in rows]
+    common = common_tokens(connection, set().union(*(w["t"] | w["a"] for w in wanted)))
+    return sum(match_book(connection, row, common) for row in rows)
+
+
+@jobs.task("matching.books")
+def match_books_job(after_id, until_id):
+    """Match a committed batch of imported listings; queued by ``flask books import``."""
+    return match_books_after(db.session.connection(), after_id, until_id)
+
+
+@sa.event.listens_for(Book, "after_insert")
+def _book_added(mapper, connection, book):
+    match_book(connection, book)
+
+
+# --- commands ------------------------------------------------------------------
+
+def rebuild():
+    """Recreate the token index from the buy_request table. Returns the number of requests."""
+    with db.engine.begin() as conn:
+        conn.execute(_token.delete())
+        requests = conn.execute(sa.select(_request.c.id, _request.c.title, _request.c.author)).all()
+        rows = [posting for req in requests for posting in _postings(req)]
+        if rows:
+            conn.execute(_token.insert(), rows)
+        return len(requests)
+
+
+@matching_cli.command("rebuild")
+def rebuild_command():
+    """Rebuild the buy request token index."""
+    click.echo(f"Indexed {rebuild()} buy requests.")
+
+
+@matching_cli.command("run")
+@click.option("--after-id", default=0, help="Only match listings with a larger id.")
+def run_command(after_id):
+    """Match existing listings against the open buy requests."""
+    with db.engine.begin() as conn:
+        found = match_books_after(conn, after_id)
+    click.echo(f"Found {found} matches.")
+
+
+def init_app(app):
+    app.cli.add_command(matching_cli)
@@ -0,0 +1,388 @@
+"""Request and SQL instrumentation, exported at ``/metrics``.
+
+Engine events time every statement. Inside a request, the statement count and
+database time are added up per endpoint, and the totals go into the
+``Server-Timing`` response header. Two kinds of statement are logged and
+counted:
+
+* slow: a statement that took longer than ``METRICS_SLOW_QUERY_MS``;
+* N+1: identical SQL text run ``METRICS_N_PLUS_ONE_THRESHOLD`` times in one
+  request, usually a lazy relationship loaded once per row. It is logged once
+  per request.
+
+Request latency, statements and database time per request are histograms
+labelled by endpoint and blueprint. Other modules add their own counters
+with ``collector`` (the page cache, the password hasher). ``/metrics``
+renders everything in the Prometheus text format and requires
+``Authorization: Bearer <METRICS_TOKEN>``. Without a token configured it is
+only served in debug and testing; otherwise it answers 404.
+
+The bookkeeping is a few dict updates per statement and one lock per request.
+Where the request histograms and counters live depends on ``METRICS_BACKEND``:
+
+* ``memory`` -- per process; with several workers each scrape sees only the
+  worker that answered it
+* ``sqlite`` -- a local SQLite file shared by every worker on the box (the
+  production default). Each worker adds what it recorded to the file at most
+  every ``METRICS_FLUSH_INTERVAL`` seconds, on its next request, and
+  ``/metrics`` reports the totals over all workers, past ones included.
+
+The ``collector`` families describe the worker that answers the scrape (its
+cache counters, its hashing pool) in either case.
+"""
+import bisect
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import sqlalchemy as sa
+from flask import Response, abort, current_app, g, has_request_context, request
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# set from the config by init_app
+_slow_seconds = 0.1
+_repeat_threshold = 5
+
+
+class Histogram:
+    def __init__(self, name, doc, buckets):
+        self.name, self.doc, self.buckets = name, doc, buckets
+        self.series = {}  # labels -> [per-bucket counts + overflow, sum, count]
+
+    def observe(self, labels, value):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+        s[2] += 1
+
+    def samples(self):
+        """``(labels, slot, value)`` for every stored number; ``load`` adds them back."""
+        for labels, (counts, total, n) in self.series.items():
+            for i, count in enumerate(counts):
+                if count:
+                    yield labels, f"b{i}", count
+            yield labels, "sum", total
+            yield labels, "count", n
+
+    def load(self, labels, slot, value):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        if slot == "sum":
+            s[1] += value
+        elif slot == "count":
+            s[2] += int(value)
+        elif int(slot[1:]) < len(s[0]):
+            s[0][int(slot[1:])] += int(value)
+
+    def render(self, names):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, n) in sorted(self.series.items()):
+            base = _labels(names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}'
+            yield f'{self.name}_bucket{{{base},le="+Inf"}} {n}'
+            yield f"{self.name}_sum{{{base}}} {total:.6f}"
+            yield f"{self.name}_count{{{base}}} {n}"
+
+
+class CounterMetric:
+    def __init__(self, name, doc):
+        self.name, self.doc = name, doc
+        self.series = Counter()
+
+    def inc(self, labels, value=1):
+        self.series[labels] += value
+
+    def samples(self):
+        for labels, value in self.series.items():
+            yield labels, "", value
+
+    def load(self, labels, slot, value):
+        self.series[labels] += int(value)
+
+    def render(self, names):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self.series.items()):
+            yield f"{self.name}{{{_labels(names, labels)}}} {value}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    return ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+
+
+def family(name, doc, kind, names, samples):
+    """Prometheus lines for one metric; ``samples`` maps label value tuples to values."""
+    yield f"# HELP {name} {doc}"
+    yield f"# TYPE {name} {kind}"
+    for labels, value in sorted(samples.items()):
+        yield f"{name}{{{_labels(names, labels)}}} {value}" if names else f"{name} {value}"
+
+
+# name -> callable returning Prometheus lines, added to /metrics
+_collectors = {}
+
+
+def collector(name, fn):
+    """Render ``fn()`` (an iterable of lines) at ``/metrics``; registering a name again replaces it."""
+    _collectors[name] = fn
+
+
+class SQLiteStore:
+    """Metric totals in a local SQLite file that every worker adds to."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS metric_sample (name TEXT NOT NULL, labels TEXT NOT NULL, "
+            "slot TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (name, labels, slot))"
+        )
+
+    def _conn(self):
+        # a connection opened before gunicorn forked belongs to the master
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def add(self, samples):
+        """Add ``(name, labels, slot, value)`` deltas to the totals."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO metric_sample (name, labels, slot, value) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name, labels, slot) DO UPDATE SET value = value + excluded.value",
+                [(name, json.dumps(labels), slot, value) for name, labels, slot, value in samples],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def samples(self):
+        for name, labels, slot, value in self._conn().execute(
+            "SELECT name, labels, slot, value FROM metric_sample"
+        ):
+            yield name, tuple(json.loads(labels)), slot, value
+
+
+class Registry:
+    ENDPOINT = ("endpoint", "blueprint")
+
+    def __init__(self, store=None, flush_interval=5):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # with a store, the metrics below only hold what was recorded since the last flush
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        self.requests = CounterMetric("http_requests_total", "Requests served.")
+        self.latency = Histogram(
+            "http_request_duration_seconds", "Time to build the response.", LATENCY_BUCKETS
+        )
+        self.statements = Histogram(
+            "db_statements_per_request", "SQL statements executed per request.", STATEMENT_BUCKETS
+        )
+        self.db_time = Histogram(
+            "db_time_per_request_seconds", "Time spent in SQL statements per request.", LATENCY_BUCKETS
+        )
+        self.slow = CounterMetric("db_slow_statements_total", "Statements slower than METRICS_SLOW_QUERY_MS.")
+        self.n_plus_one = CounterMetric(
+            "db_n_plus_one_total", "Requests that repeated one statement METRICS_N_PLUS_ONE_THRESHOLD times."
+        )
+
+    def record_request(self, endpoint, blueprint, method, status, seconds, stats):
+        key = (endpoint, blueprint)
+        with self.lock:
+            self.requests.inc((endpoint, blueprint, method, status))
+            self.latency.observe(key, seconds)
+            self.statements.observe(key, stats.count)
+            self.db_time.observe(key, stats.seconds)
+            if stats.slow:
+                self.slow.inc(key, stats.slow)
+            if stats.repeated:
+                self.n_plus_one.inc(key)
+        if self.store is not None and time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def _metrics(self):
+        """Each metric with its label names."""
+        return [
+            (self.requests, self.ENDPOINT + ("method", "status")),
+            (self.latency, self.ENDPOINT),
+            (self.statements, self.ENDPOINT),
+            (self.db_time, self.ENDPOINT),
+            (self.slow, self.ENDPOINT),
+            (self.n_plus_one, self.ENDPOINT),
+        ]
+
+    def flush(self):
+        """Move what this process recorded since the last flush into the store."""
+        with self.lock:
+            pending = [(metric.name, *sample) for metric, _ in self._metrics() for sample in metric.samples()]
+            for metric, _ in self._metrics():
+                metric.series = type(metric.series)()
+            self.flushed = time.monotonic()
+        if not pending:
+            return
+        try:
+            self.store.add(pending)
+        except sqlite3.Error:
+            log.warning("could not write metrics to %s; keeping them for the next flush", self.store.path,
+                        exc_info=True)
+            self._load(pending)
+
+    def _load(self, samples):
+        metrics = {metric.name: metric for metric, _ in self._metrics()}
+        with self.lock:
+            for name, labels, slot, value in samples:
+                if name in metrics:
+                    metrics[name].load(labels, slot, value)
+
+    def render(self):
+        if self.store is not None:
+            self.flush()
+            totals = Registry()
+            totals._load(self.store.samples())
+            lines = [line for metric, names in totals._metrics() for line in metric.render(names)]
+        else:
+            with self.lock:
+                lines = [
+                    "# HELP process_start_time_seconds Start time of the process since the epoch.",
+                    "# TYPE process_start_time_seconds gauge",
+                    f"process_start_time_seconds {self.started:.3f}",
+                    *(line for metric, names in self._metrics() for line in metric.render(names)),
+                ]
+        for fn in _collectors.values():
+            lines.extend(fn())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class RequestStats:
+    """Statements issued while serving one request."""
+
+    __slots__ = ("count", "seconds", "slow", "seen", "repeated")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slow = 0
+        self.seen = Counter()
+        self.repeated = set()
+
+
+def _endpoint():
+    return request.endpoint or "none", request.blueprint or "none"
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _where():
+    return "%s (%s)" % _endpoint() if has_request_context() else "outside a request"
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_started"].pop()
+    slow = elapsed >= _slow_seconds
+    if slow:
+        log.warning("slow statement (%.1f ms) in %s: %s", elapsed * 1000, _where(), statement)
+    stats = g.get("sql_stats") if has_request_context() else None
+    if stats is None:
+        return
+    stats.count += 1
+    stats.seconds += elapsed
+    stats.slow += slow
+    stats.seen[statement] += 1
+    if stats.seen[statement] == _repeat_threshold:
+        stats.repeated.add(statement)
+        log.warning("possible N+1 in %s: statement run %s times: %s", _where(), _repeat_threshold, statement)
+
+
+def _failed(context):
+    started = context.connection.info.get("metrics_started") if context.connection else None
+    if started:
+        started.pop()
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.sql_stats = RequestStats()
+
+
+def _finish_request(response):
+    started = g.pop("request_started", None)
+    stats = g.pop("sql_stats", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint, blueprint = _endpoint()
+    registry.record_request(endpoint, blueprint, request.method, response.status_code, elapsed, stats)
+    response.headers.add(
+        "Server-Timing", f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries"'
+    )
+    response.headers.add("Server-Timing", f"app;dur={elapsed * 1000:.1f}")
+    return response
+
+
+def metrics_view():
+    token = current_app.config.get("METRICS_TOKEN")
+    if not token:
+        if not (current_app.debug or current_app.testing):
+            abort(404)
+    else:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            abort(401)
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app, db):
+    global registry, _slow_seconds, _repeat_threshold
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+    _slow_seconds = app.config.get("METRICS_SLOW_QUERY_MS", 100) / 1000
+    _repeat_threshold = app.config.get("METRICS_N_PLUS_ONE_THRESHOLD", 5)
+    kind = app.config.get("METRICS_BACKEND", "memory")
+    if kind == "sqlite":
+        path = app.config.get("METRICS_SQLITE_PATH") or os.path.join(app.instance_path, "metrics.sqlite")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        registry = Registry(SQLiteStore(path), app.config.get("METRICS_FLUSH_INTERVAL", 5))
+    elif kind != "memory":
+        raise ValueError(f"unknown METRICS_BACKEND {kind!r}")
+    with app.app_context():
+        for engine in db.engines.values():
+            sa.event.listen(engine, "before_cursor_execute", _before_execute)
+            sa.event.listen(engine, "after_cursor_execute", _after_execute)
+            sa.event.listen(engine, "handle_error", _failed)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -1,7 +1,6 @@
-from . import db, login_manager
+from . import db, passwords
 from datetime import datetime
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 
 
 class User(db.Model, UserMixin):
@@ -23,41 +22,97 @@ class User(db.Model, UserMixin):
     # buy_requests backref will be defined in BuyRequest
 
     def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = passwords.hash_password(pw)
 
     def check_password(self, pw):
-        return check_password_hash(self.password_hash, pw)
-
-
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+        """Verify ``pw``; a hash made with outdated parameters is replaced (caller commits)."""
+        if not passwords.verify_password(self.password_hash, pw):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            self.set_password(pw)
+        return True
 
 
 class Book(db.Model):
+    __table_args__ = (
+        # keyset pagination of the listing feeds: ORDER BY created_at DESC, id DESC
+        db.Index("ix_book_created_at_id", "created_at", "id"),
+        # a seller's listings / daily posting quota
+        db.Index("ix_book_owner_id_created_at", "owner_id", "created_at"),
+        # the browse feed filtered by category
+        db.Index("ix_book_category_id_created_at", "category_id", "created_at"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150), nullable=False)
     author = db.Column(db.String(100))
     price = db.Column(db.Float)
     is_free = db.Column(db.Boolean, default=False)
     condition = db.Column(db.String(20))
-    category = db.Column(db.String(120))
+    category_id = db.Column(db.Integer, db.ForeignKey("category.id"))
     location = db.Column(db.String(140))
+    # resolved from location by app.geo; None when it names no known place
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     description = db.Column(db.Text)
-    image_file = db.Column(db.String(200))  # uploaded filename
+    image_file = db.Column(db.String(200))  # storage key (or legacy file name), see app.storage
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # bumped by every UPDATE, including the rating aggregate adjustments; API ETags use it
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     owner_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
+    # Review aggregates, kept up to date by app.ratings in the same transaction
+    # as every Review insert/update/delete. rating_1..rating_5 form the histogram.
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_1 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_2 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_3 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_4 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_5 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
     reviews = db.relationship("Review", backref="book", lazy="dynamic", cascade="all,delete")
     wishlist = db.relationship("Wishlist", backref="book", lazy="dynamic", cascade="all,delete")
+    matches = db.relationship("Match", backref="book", lazy="dynamic", cascade="all,delete")
+    category = db.relationship("Category", lazy="joined")
 
     def avg_rating(self):
-        vals = [r.rating for r in self.reviews]
-        return round(sum(vals) / len(vals), 2) if vals else 0
+        return round(self.rating_sum / self.review_count, 2) if self.review_count else 0
+
+    def rating_histogram(self):
+        """{stars: count} for 1..5 stars."""
+        return {i: getattr(self, f"rating_{i}") or 0 for i in range(1, 6)}
+
+
+class Category(db.Model):
+    """A listing category. ``key`` is the normalized name (see app.facets.category_key)."""
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(120), unique=True, nullable=False)
+    name = db.Column(db.String(120), nullable=False)  # as first entered
+
+    def __str__(self):
+        return self.name
+
+
+class BookFacetCount(db.Model):
+    """Listings per (category, condition, free, price bucket), maintained by app.facets."""
+    __tablename__ = "book_facet_count"
+
+    # 0 / "" stand for no category / condition, so every cell has a usable primary key
+    category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    condition = db.Column(db.String(20), primary_key=True)
+    is_free = db.Column(db.Boolean, primary_key=True)
+    price_bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 
 class Review(db.Model):
+    __table_args__ = (
+        db.Index("ix_review_book_id_created_at", "book_id", "created_at"),
+        db.Index("ix_review_user_id", "user_id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     rating = db.Column(db.Integer, nullable=False)  # 1–5
     comment = db.Column(db.Text)
@@ -68,6 +123,12 @@ class Review(db.Model):
 
 
 class Wishlist(db.Model):
+    __table_args__ = (
+        # also serves every (user_id, book_id) lookup and a user's wishlist page
+        db.UniqueConstraint("user_id", "book_id", name="uq_wishlist_user_id_book_id"),
+        db.Index("ix_wishlist_book_id", "book_id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -75,7 +136,34 @@ class Wishlist(db.Model):
     book_id = db.Column(db.Integer, db.ForeignKey("book.id"), nullable=False)
 
 
+class BookNeighbor(db.Model):
+    """One of a book's "readers also wanted" books, by rank; maintained by app.recommend."""
+    __tablename__ = "book_neighbor"
+    __table_args__ = (
+        # lists to fix up when a book is deleted
+        db.Index("ix_book_neighbor_neighbor_id", "neighbor_id"),
+    )
+
+    book_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+
+class BookNeighborStale(db.Model):
+    """A book whose neighbors changed since they were computed (see app.recommend)."""
+    __tablename__ = "book_neighbor_stale"
+
+    book_id = db.Column(db.Integer, primary_key=True)
+    marked_at = db.Column(db.DateTime, nullable=False)
+
+
 class BuyRequest(db.Model):
+    __table_args__ = (
+        db.Index("ix_buy_request_created_at_id", "created_at", "id"),
+        db.Index("ix_buy_request_user_id_created_at", "user_id", "created_at"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(260), nullable=False)
     author = db.Column(db.String(200))
@@ -83,11 +171,91 @@ class BuyRequest(db.Model):
     budget = db.Column(db.Numeric(10, 2))
     is_free = db.Column(db.Boolean, default=False)
     location = db.Column(db.String(140))
+    latitude = db.Column(db.Float)  # see Book.latitude
+    longitude = db.Column(db.Float)
     image_file = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     user = db.relationship("User", backref="buy_requests")  # This is enough
+    matches = db.relationship("Match", backref="buy_request", lazy="dynamic", cascade="all,delete")
+
+
+class BuyRequestToken(db.Model):
+    """Inverted index over buy request titles/authors, maintained by app.matching."""
+    __tablename__ = "buy_request_token"
+    __table_args__ = (
+        db.Index("ix_buy_request_token_buy_request_id", "buy_request_id"),
+    )
+
+    token = db.Column(db.String(64), primary_key=True)
+    field = db.Column(db.String(1), primary_key=True)  # "t"itle or "a"uthor
+    buy_request_id = db.Column(db.Integer, db.ForeignKey("buy_request.id"), primary_key=True)
+
+
+class Match(db.Model):
+    """A listing that fits a buy request; shown on the requester's notifications page."""
+    __table_args__ = (
+        db.UniqueConstraint("buy_request_id", "book_id", name="uq_match_buy_request_id_book_id"),
+        db.Index("ix_match_user_id_created_at", "user_id", "created_at"),
+        db.Index("ix_match_book_id", "book_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    read = db.Column(db.Boolean, nullable=False, default=False, server_default="0")
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # user_id is the requester, copied so the notifications page needs no join to filter
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    buy_request_id = db.Column(db.Integer, db.ForeignKey("buy_request.id"), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey("book.id"), nullable=False)
+
+    @property
+    def title(self):
+        return f"New listing for your request “{self.buy_request.title}”"
+
+    @property
+    def body(self):
+        price = "free" if self.book.is_free else f"Rs {self.book.price or 0:.0f}"
+        where = f" in {self.book.location}" if self.book.location else ""
+        return f"{self.book.title} ({price}{where})"
+
+
+class Job(db.Model):
+    """A unit of background work, run by ``flask jobs worker`` (see app.jobs)."""
+    __table_args__ = (
+        # the worker's poll: due jobs by status, oldest first
+        db.Index("ix_job_status_available_at", "status", "available_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(10), nullable=False, default="queued")  # queued, running or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    # when a queued job is due, or when a running job's lease runs out
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(120))
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class StoredFile(db.Model):
+    """A file in content-addressed storage and how many rows refer to it (see app.storage)."""
+    __tablename__ = "stored_file"
+    __table_args__ = (
+        # the upload GC: unreferenced files past the grace period
+        db.Index("ix_stored_file_refs_touched_at", "refs", "touched_at"),
+    )
+
+    key = db.Column(db.String(120), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+    # last upload of these bytes
+    touched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 
 class Donation(db.Model):
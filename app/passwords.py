@@ -0,0 +1,140 @@
+"""Password hashing off the request threads.
+
+``hash_password`` and ``verify_password`` run werkzeug's hash functions in a
+small process pool, so a burst of logins costs pool time rather than holding
+every request worker on CPU-bound key stretching. At most
+``PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE`` hashes are in flight; a
+request that can't get a slot within ``PASSWORD_HASH_WAIT`` seconds gets a 503
+with ``Retry-After`` instead of queueing without bound.
+
+``PASSWORD_HASH_METHOD`` is a full werkzeug method string with its cost
+parameters (``"scrypt:32768:8:1"``, ``"pbkdf2:sha256:1000000"``). Stored
+hashes made with anything else are upgraded at the user's next login, see
+``User.check_password``.
+
+Queue wait and hashing time are tracked apart from request latency and
+exported at ``/metrics`` (app.metrics).
+"""
+import atexit
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import metrics
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.method = "scrypt:32768:8:1"
+        self.salt_length = 16
+        self.workers = 0
+        self.wait = 5
+        self._slots = None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.stats = {
+            op: {"count": 0, "wait_ms": 0.0, "hash_ms": 0.0, "max_hash_ms": 0.0}
+            for op in ("hash", "verify")
+        }
+        self.stats["rejected"] = 0
+        self._stats_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.method = app.config.get("PASSWORD_HASH_METHOD", self.method)
+        self.salt_length = app.config.get("PASSWORD_SALT_LENGTH", self.salt_length)
+        self.workers = app.config.get("PASSWORD_HASH_WORKERS", 2)
+        self.wait = app.config.get("PASSWORD_HASH_WAIT", 5)
+        queue = app.config.get("PASSWORD_HASH_QUEUE", 8)
+        self._slots = threading.BoundedSemaphore(max(1, self.workers) + queue)
+        metrics.collector("passwords", self.metric_lines)
+
+    def _pool(self):
+        # created on first use so each server process forks its own workers
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                atexit.register(self.shutdown)
+            return self._executor
+
+    def shutdown(self):
+        """Stop the pool while the interpreter is still whole (registered with atexit)."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _run(self, op, fn, *args):
+        start = time.perf_counter()
+        if self._slots is not None and not self._slots.acquire(timeout=self.wait):
+            with self._stats_lock:
+                self.stats["rejected"] += 1
+            raise ServiceUnavailable("The server is busy. Please try again.", retry_after=1)
+        try:
+            queued = time.perf_counter()
+            if self.workers:
+                future = self._pool().submit(fn, *args)
+                result = future.result()
+            else:
+                result = fn(*args)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+        done = time.perf_counter()
+        # wall time in the pool, including the hop to the worker process
+        self._record(op, (queued - start) * 1000, (done - queued) * 1000)
+        return result
+
+    def _record(self, op, wait_ms, hash_ms):
+        with self._stats_lock:
+            s = self.stats[op]
+            s["count"] += 1
+            s["wait_ms"] += wait_ms
+            s["hash_ms"] += hash_ms
+            s["max_hash_ms"] = max(s["max_hash_ms"], hash_ms)
+
+    def metric_lines(self):
+        with self._stats_lock:
+            ops = {op: dict(self.stats[op]) for op in ("hash", "verify")}
+            rejected = self.stats["rejected"]
+
+        def per_op(field, scale=1):
+            return {(op,): round(s[field] * scale, 6) for op, s in ops.items()}
+
+        yield from metrics.family("password_hash_workers", "Processes in the hashing pool.",
+                                  "gauge", (), {(): self.workers})
+        yield from metrics.family("password_hash_total", "Hashes computed.", "counter", ("op",), per_op("count"))
+        yield from metrics.family("password_hash_wait_seconds_total", "Time spent waiting for a pool slot.",
+                                  "counter", ("op",), per_op("wait_ms", 0.001))
+        yield from metrics.family("password_hash_seconds_total", "Time spent hashing in the pool.",
+                                  "counter", ("op",), per_op("hash_ms", 0.001))
+        yield from metrics.family("password_hash_max_seconds", "Slowest single hash.",
+                                  "gauge", ("op",), per_op("max_hash_ms", 0.001))
+        yield from metrics.family("password_hash_rejected_total", "Requests turned away with a 503.",
+                                  "counter", (), {(): rejected})
+
+    def hash(self, password):
+        return self._run("hash", generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        return self._run("verify", check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split("$", 1)[0] != self.method
+
+
+hasher = PasswordHasher()
+
+
+def hash_password(password):
+    return hasher.hash(password)
+
+
+def verify_password(pwhash, password):
+    return hasher.verify(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return hasher.needs_rehash(pwhash)
@@ -0,0 +1,290 @@
+"""Query-plan regression check for the hot routes.
+
+``flask queryplan check`` builds a throwaway SQLite database, seeds a few rows,
+requests every route in ``ROUTES`` through the test client and runs
+``EXPLAIN QUERY PLAN`` on each SELECT the route issued. Any plan step that
+walks a whole table is reported and the command exits non-zero, so a dropped
+or unusable index fails CI. It also feeds the paginated routes in
+``CURSOR_ROUTES`` each of the malformed ``BAD_CURSORS`` and fails unless they
+answer 400. That covers ``SCAN <table>``, full scans of an
+index, and AUTOMATIC indexes SQLite builds on the fly; the one exception is
+an index-ordered scan in a LIMIT query (the feeds), which stops after a page.
+
+``flask queryplan counts`` guards the batch-loaded pages against N+1 queries.
+It gives one user 0, 1 and then many listings (with reviews, wishlist entries
+and buy requests) and counts every statement each route in ``CONSTANT_ROUTES``
+issues. It fails if the counts differ.
+"""
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+
+queryplan_cli = AppGroup("queryplan", help="Query plan checks.")
+
+# (method, url template, needs login); {book} / {request} / {cursor} / {since} are filled in after seeding
+ROUTES = [
+    ("GET", "/", False),
+    ("GET", "/?cursor={cursor}", False),
+    ("GET", "/books/browse", False),
+    ("GET", "/books/browse?q=potter", False),
+    ("GET", "/books/browse?q=pot*&condition=used", False),
+    ("GET", "/books/browse?condition=new&free=1", False),
+    ("GET", "/books/browse?category=fiction&price=500-1000", False),
+    ("GET", "/books/browse?near=Gulberg+Lahore&radius=10", False),
+    ("GET", "/books/browse?near=31.52,74.35&sort=distance&category=fiction", False),
+    ("GET", "/books/browse/more?cursor={cursor}", False),
+    ("GET", "/books/buy-requests", False),
+    ("GET", "/books/buy-requests?near=Lahore&sort=distance", False),
+    ("GET", "/books/export?since={since}", False),
+    ("GET", "/api/v1/books?condition=used", False),
+    ("GET", "/api/v1/books/{book}", False),
+    ("GET", "/api/v1/buy-requests", False),
+    ("GET", "/books/{book}", True),
+    ("GET", "/books/buyrequest/{request}", False),
+    ("GET", "/books/create", True),
+    ("GET", "/books/buyrequest/new", True),
+    ("POST", "/books/toggle-wishlist/{book}", True),
+    ("GET", "/books/wishlist/state?ids={book},2,3", True),
+    ("GET", "/account/my_listings", True),
+    ("GET", "/account/wishlist", True),
+    ("GET", "/api/v1/wishlist", True),
+    ("GET", "/account/notifications", True),
+]
+
+# paginated routes and cursors they must reject with a 400 (a cursor is a JSON list of key values)
+CURSOR_ROUTES = ["/?cursor={cursor}", "/books/browse/more?cursor={cursor}", "/books/browse/more?q=potter&cursor={cursor}"]
+BAD_CURSORS = [
+    [{"created_at": "2026-01-01T00:00:00"}, 1],
+    ["2026-01-01T00:00:00", {"id": 1}],
+    ["2026-01-01T00:00:00", [1]],
+    ["2026-01-01T00:00:00", "1"],
+    ["2026-01-01T00:00:00", True],
+    ["2026-01-01T00:00:00", None],
+    ["2026-01-01T00:00:00"],
+]
+
+# routes whose statement count must not grow with the user's own rows
+CONSTANT_ROUTES = ["/account/my_listings"]
+LISTING_COUNTS = (0, 1, 25)
+
+_SCAN_RE = re.compile(r"^SCAN (\w+)(.*)$")
+_LIMIT_RE = re.compile(r"\bLIMIT\b", re.IGNORECASE)
+
+
+# lookup tables with a row per category / facet cell: scanning them is the plan
+SMALL_TABLES = {"category", "book_facet_count"}
+
+
+def full_scans(conn, statement, parameters, tables):
+    """Plan steps of ``statement`` that scan one of ``tables`` without an index."""
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    limited = _LIMIT_RE.search(statement) is not None
+    bad = []
+    for row in rows:
+        detail = row[-1]
+        m = _SCAN_RE.match(detail)
+        if "AUTOMATIC" in detail:
+            bad.append(detail)
+        elif m and m.group(1) in tables and not (limited and "INDEX" in m.group(2)):
+            bad.append(detail)
+    return bad
+
+
+def _seed(db):
+    from app.models import User, Book, Review, Wishlist, BuyRequest, Category
+
+    user = User(name="Plan Check", email="plan@example.com", phone="000000")
+    user.set_password("plancheck")
+    db.session.add(user)
+    db.session.flush()
+    t0 = datetime.utcnow() - timedelta(days=1)
+    fiction = Category(key="fiction", name="Fiction")
+    books = []
+    for i in range(40):
+        b = Book(
+            title=f"Harry Potter {i}" if i % 2 else f"Book {i}",
+            author="Author", condition="used" if i % 3 else "new", is_free=i % 4 == 0,
+            category=fiction, price=None if i % 4 == 0 else 100 * i, location="Gulberg, Lahore" if i % 2 else "Karachi",
+            created_at=t0 + timedelta(minutes=i), owner_id=user.id,
+        )
+        db.session.add(b)
+        books.append(b)
+    db.session.flush()
+    for b in books[:10]:
+        db.session.add(Review(rating=4, comment="ok", user_id=user.id, book_id=b.id))
+        db.session.add(Wishlist(user_id=user.id, book_id=b.id))
+    req = BuyRequest(title="Wanted", location="Lahore", user_id=user.id, created_at=t0)
+    db.session.add(req)
+    db.session.commit()
+    return user, books[0], req
+
+
+def _app():
+    """An app on a fresh throwaway database."""
+    from app import create_app
+    from config import Config
+
+    tmp = tempfile.mkdtemp()
+
+    class PlanConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmp, 'plan.sqlite')}"
+        WTF_CSRF_ENABLED = False
+        TESTING = True
+        SQLITE_READ_ENGINE = False  # capture every statement on the primary engine
+        CACHE_BACKEND = "null"
+        IMAGE_WORKERS = 0
+
+    return create_app(PlanConfig)
+
+
+def check_routes(verbose=False):
+    """Returns a list of (route, statement, [bad plan steps])."""
+    from app import db
+    from app.utils import encode_cursor
+
+    app = _app()
+    with app.app_context():
+        db.create_all()
+        user, book, req = _seed(db)
+        email, book_id, req_id = user.email, book.id, req.id
+        cursor = encode_cursor([book.created_at + timedelta(minutes=30), 10**6])
+        since = f"{(book.created_at + timedelta(minutes=30)).isoformat()},{book.id}"
+        tables = set(db.metadata.tables) - SMALL_TABLES
+        engine = db.engine
+
+    captured = []
+
+    def capture(conn, cur, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and not executemany:
+            captured.append((statement, parameters))
+
+    # requests run outside the seeding app context so each gets a fresh session
+    client = app.test_client()
+    logged_in = False
+    problems = []
+    for method, template, needs_login in ROUTES:
+        if needs_login and not logged_in:
+            client.post("/login", data={"email": email, "password": "plancheck"})
+            logged_in = True
+        url = template.format(book=book_id, request=req_id, cursor=cursor, since=since)
+        captured.clear()
+        sa.event.listen(engine, "before_cursor_execute", capture)
+        try:
+            resp = client.open(url, method=method)
+        finally:
+            sa.event.remove(engine, "before_cursor_execute", capture)
+        if resp.status_code >= 500:
+            problems.append((url, f"HTTP {resp.status_code}", []))
+        with engine.connect() as conn:
+            for statement, parameters in captured:
+                bad = full_scans(conn, statement, parameters, tables)
+                if bad:
+                    problems.append((url, statement, bad))
+                elif verbose:
+                    click.echo(f"ok   {url}: {' '.join(statement.split())[:100]}")
+    for template in CURSOR_ROUTES:
+        for values in BAD_CURSORS:
+            url = template.format(cursor=encode_cursor(values))
+            status = client.get(url).status_code
+            if status != 400:
+                problems.append((url, f"HTTP {status} for cursor {values!r}, expected 400", []))
+            elif verbose:
+                click.echo(f"ok   {url}: rejected {values!r}")
+    engine.dispose()
+    return problems
+
+
+def _add_listings(db, user, reader, n):
+    """Give ``user`` ``n`` more listings, each reviewed and wishlisted by ``reader``, and ``n`` buy requests."""
+    from app.models import Book, Review, Wishlist, BuyRequest
+
+    for i in range(n):
+        book = Book(title=f"Listing {i}", author="Author", condition="used", price=100 + i,
+                    location="Lahore", owner_id=user.id)
+        db.session.add(book)
+        db.session.flush()
+        db.session.add(Review(rating=1 + i % 5, comment="ok", user_id=reader.id, book_id=book.id))
+        db.session.add(Wishlist(user_id=reader.id, book_id=book.id))
+        db.session.add(BuyRequest(title=f"Wanted {i}", location="Lahore", user_id=user.id))
+    db.session.commit()
+
+
+def count_statements():
+    """{route: [statements issued with each of LISTING_COUNTS listings]}."""
+    from app import db
+    from app.models import User
+
+    app = _app()
+    with app.app_context():
+        db.create_all()
+        user = User(name="Count Check", email="count@example.com", phone="000000")
+        reader = User(name="Reader", email="reader@example.com", phone="000001")
+        user.set_password("countcheck")
+        reader.set_password("countcheck")
+        db.session.add_all([user, reader])
+        db.session.commit()
+        user_id, reader_id, engine = user.id, reader.id, db.engine
+
+    statements = []
+
+    def count(conn, cur, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    client = app.test_client()
+    client.post("/login", data={"email": "count@example.com", "password": "countcheck"})
+    counts = {route: [] for route in CONSTANT_ROUTES}
+    have = 0
+    for n in LISTING_COUNTS:
+        with app.app_context():
+            _add_listings(db, db.session.get(User, user_id), db.session.get(User, reader_id), n - have)
+        have = n
+        for route in CONSTANT_ROUTES:
+            client.get(route)  # warm the per-user caches; the second request is the one counted
+            statements.clear()
+            sa.event.listen(engine, "before_cursor_execute", count)
+            try:
+                resp = client.get(route)
+            finally:
+                sa.event.remove(engine, "before_cursor_execute", count)
+            if resp.status_code != 200:
+                raise click.ClickException(f"{route} returned HTTP {resp.status_code}")
+            counts[route].append(len(statements))
+    engine.dispose()
+    return counts
+
+
+@queryplan_cli.command("counts")
+def counts_command():
+    """Fail if a batch-loaded page issues more queries for a user with more listings."""
+    failed = False
+    for route, counts in count_statements().items():
+        detail = ", ".join(f"{n} listings: {c}" for n, c in zip(LISTING_COUNTS, counts))
+        ok = len(set(counts)) == 1
+        failed = failed or not ok
+        click.echo(f"{'ok  ' if ok else 'FAIL'} {route} ({detail})")
+    if failed:
+        sys.exit(1)
+
+
+@queryplan_cli.command("check")
+@click.option("-v", "--verbose", is_flag=True, help="Also list statements that pass.")
+def check_command(verbose):
+    """Fail if any hot-route query falls back to a full table scan."""
+    problems = check_routes(verbose)
+    for url, statement, bad in problems:
+        click.echo(f"FAIL {url}\n  {' '.join(statement.split())}")
+        for step in bad:
+            click.echo(f"    -> {step}")
+    if problems:
+        sys.exit(1)
+    click.echo(f"All queries for {len(ROUTES)} routes use indexes.")
+
+
+def init_app(app):
+    app.cli.add_command(queryplan_cli)
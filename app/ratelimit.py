@@ -0,0 +1,207 @@
+"""Token-bucket rate limiting for views.
+
+    @limit("10/day", key="user", deduct_when=created)
+    def create_book(): ...
+
+A rule ``"N/period"`` is a bucket holding N tokens that refills at N per
+period, so bursts up to N are allowed and the long-run rate is N per period.
+Each check is a single keyed read/write, independent of how much history
+there is. When the bucket is empty the request is rejected with ``429 Too
+Many Requests`` and a ``Retry-After`` header.
+
+Backends (``RATELIMIT_BACKEND``):
+
+* ``memory`` -- per-process buckets
+* ``sqlite`` -- a local SQLite file shared by every worker on the box
+* ``null``   -- limiting disabled
+"""
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_rule(rule):
+    """``"10/day"`` -> (capacity, tokens per second)."""
+    count, _, period = rule.partition("/")
+    capacity = int(count)
+    return capacity, capacity / PERIODS[period.strip().rstrip("s")]
+
+
+class NullBackend:
+    def take(self, key, capacity, rate, cost=1, consume=True):
+        return True, 0
+
+    def refund(self, key, capacity, rate, cost=1):
+        pass
+
+
+class MemoryBackend:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, updated_at, capacity, rate)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, cost=1, consume=True):
+        """Try to take ``cost`` tokens. Returns (allowed, seconds until allowed)."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= cost
+            if consume and allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now, capacity, rate)
+            if len(self._buckets) > self.max_keys:
+                self._sweep(now)
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def refund(self, key, capacity, rate, cost=1):
+        """Give back ``cost`` tokens taken by ``take``."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+            self._buckets[key] = (min(capacity, tokens + (now - ts) * rate + cost), now, capacity, rate)
+
+    def _sweep(self, now):
+        # buckets that have refilled completely carry no state worth keeping
+        full = [
+            k for k, (tokens, ts, capacity, rate) in self._buckets.items()
+            if tokens + (now - ts) * rate >= capacity
+        ]
+        for k in full:
+            del self._buckets[k]
+
+
+class SQLiteBackend:
+    """Buckets in a local SQLite file so all workers share the same limits."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS bucket "
+            "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate, cost=1, consume=True):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM bucket WHERE key = ?", (key,)).fetchone()
+            tokens, ts = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= cost
+            if consume and allowed:
+                tokens -= cost
+            conn.execute(
+                "INSERT OR REPLACE INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def refund(self, key, capacity, rate, cost=1):
+        now = time.time()
+        self._conn().execute(
+            "UPDATE bucket SET tokens = min(?, tokens + (? - updated_at) * ? + ?), updated_at = ? WHERE key = ?",
+            (capacity, now, rate, cost, now, key),
+        )
+
+
+class RateLimiter:
+    def __init__(self):
+        self.backend = NullBackend()
+
+    def init_app(self, app):
+        kind = app.config.get("RATELIMIT_BACKEND", "memory")
+        if kind == "memory":
+            self.backend = MemoryBackend()
+        elif kind == "sqlite":
+            path = app.config.get("RATELIMIT_SQLITE_PATH") or os.path.join(app.instance_path, "ratelimit.sqlite")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.backend = SQLiteBackend(path)
+        elif kind == "null":
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f"unknown RATELIMIT_BACKEND {kind!r}")
+
+
+limiter = RateLimiter()
+
+
+def _client_key(key):
+    if callable(key):
+        return key()
+    if key == "user" and current_user.is_authenticated:
+        return f"user:{current_user.get_id()}"
+    return f"ip:{request.remote_addr}"
+
+
+def _too_many(retry_after, message):
+    retry_after = max(1, int(retry_after + 0.999))
+    if request.accept_mimetypes.best == "application/json" or request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        resp = make_response(jsonify({"error": "rate_limited", "retry_after": retry_after}), 429)
+        resp.headers["Retry-After"] = str(retry_after)
+        raise TooManyRequests(response=resp)
+    raise TooManyRequests(message, retry_after=retry_after)
+
+
+def limit(rule, key="user", methods=("POST",), scope=None, deduct_when=None, message=None):
+    """Rate-limit a view.
+
+    ``key`` is "user" (falls back to the client IP when logged out), "ip", or
+    a callable returning the bucket key. Only requests whose method is in
+    ``methods`` count. With ``deduct_when`` only requests for which
+    ``deduct_when(response)`` is true are charged -- e.g. only successful
+    posts, or only failed logins. The token is still taken before the view
+    runs, so concurrent requests can't all pass on the last one, and given
+    back afterwards otherwise (also when the view raises).
+    """
+    capacity, rate = parse_rule(rule)
+
+    def decorator(view):
+        bucket_scope = scope or view.__name__
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in methods or not current_app.config.get("RATELIMIT_ENABLED", True):
+                return view(*args, **kwargs)
+
+            bucket = f"{bucket_scope}:{_client_key(key)}"
+            allowed, retry_after = limiter.backend.take(bucket, capacity, rate)
+            if not allowed:
+                _too_many(retry_after, message or f"Too many requests. Limit is {rule}.")
+            if deduct_when is None:
+                return view(*args, **kwargs)
+
+            try:
+                resp = make_response(view(*args, **kwargs))
+            except BaseException:
+                limiter.backend.refund(bucket, capacity, rate)
+                raise
+            if not deduct_when(resp):
+                limiter.backend.refund(bucket, capacity, rate)
+            return resp
+        return wrapper
+    return decorator
@@ -0,0 +1,85 @@
+"""Denormalized rating aggregates on ``Book``.
+
+``Book.review_count``, ``Book.rating_sum`` and the ``rating_1..rating_5``
+histogram are adjusted with relative UPDATEs from mapper events on ``Review``,
+so they commit (or roll back) together with the review itself. ``flask ratings
+rebuild`` recomputes them from the review table.
+"""
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+
+from app import db
+from app.models import Book, Review
+
+ratings_cli = AppGroup("ratings", help="Book rating aggregate commands.")
+
+_book = Book.__table__
+
+
+def _adjust(connection, book_id, rating, delta):
+    if book_id is None or rating not in range(1, 6):
+        return
+    bucket = _book.c[f"rating_{rating}"]
+    connection.execute(
+        _book.update()
+        .where(_book.c.id == book_id)
+        .values({
+            _book.c.review_count: _book.c.review_count + delta,
+            _book.c.rating_sum: _book.c.rating_sum + delta * rating,
+            bucket: bucket + delta,
+        })
+    )
+
+
+@sa.event.listens_for(Review, "after_insert")
+def _review_added(mapper, connection, review):
+    _adjust(connection, review.book_id, review.rating, 1)
+
+
+@sa.event.listens_for(Review, "after_delete")
+def _review_deleted(mapper, connection, review):
+    _adjust(connection, review.book_id, review.rating, -1)
+
+
+@sa.event.listens_for(Review, "after_update")
+def _review_changed(mapper, connection, review):
+    state = sa.inspect(review)
+    rating = state.attrs.rating.history
+    book_id = state.attrs.book_id.history
+    if not (rating.has_changes() or book_id.has_changes()):
+        return
+    old_rating = rating.deleted[0] if rating.deleted else review.rating
+    old_book_id = book_id.deleted[0] if book_id.deleted else review.book_id
+    _adjust(connection, old_book_id, old_rating, -1)
+    _adjust(connection, review.book_id, review.rating, 1)
+
+
+def _aggregate(column, where=None):
+    stmt = sa.select(column).where(Review.book_id == _book.c.id)
+    if where is not None:
+        stmt = stmt.where(where)
+    return stmt.scalar_subquery()
+
+
+def rebuild():
+    """Recompute every book's aggregates from the review table. Returns the number of books updated."""
+    values = {
+        "review_count": _aggregate(sa.func.count(Review.id)),
+        "rating_sum": _aggregate(sa.func.coalesce(sa.func.sum(Review.rating), 0)),
+    }
+    for i in range(1, 6):
+        values[f"rating_{i}"] = _aggregate(sa.func.count(Review.id), Review.rating == i)
+    with db.engine.begin() as conn:
+        return conn.execute(_book.update().values(values)).rowcount
+
+
+@ratings_cli.command("rebuild")
+def rebuild_command():
+    """Backfill/repair rating aggregates from the review table."""
+    count = rebuild()
+    click.echo(f"Updated rating aggregates for {count} books.")
+
+
+def init_app(app):
+    app.cli.add_command(ratings_cli)
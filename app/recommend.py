@@ -0,0 +1,351 @@
+""""Readers also wanted" recommendations.
+
+Wishlist entries and reviews form a user x book interaction matrix: a
+wishlist entry counts 1, a review ``rating / 5``, and a book both wished for
+and reviewed by one user takes the larger of the two. Two books are similar
+when the same users interacted with both, scored by the cosine of their
+columns. ``book_neighbor`` keeps the ``TOP_K`` most similar books for every
+book, so ``book_detail`` reads its strip with one indexed lookup.
+
+The matrix algebra runs in NumPy/SciPy, which are optional like Pillow in
+app.images: without them nothing is computed and the strip stays empty. They
+are imported on first use (``available``), so web workers, which only read
+``book_neighbor``, never pay for loading them.
+
+``flask recommend rebuild`` computes every list from scratch. After that the
+lists are kept current incrementally. A new or removed interaction with book
+*b* only changes similarities that involve *b*, so *b* is queued in
+``book_neighbor_stale``. This happens in the same transaction as the change,
+from mapper events on ``Review`` and ``Wishlist`` and from app.wishlist,
+whose writes are Core statements. The ``recommend.refresh`` job
+(``JOBS_SCHEDULE``) recomputes the queued books' lists. Only the users who
+touched them are loaded, not the whole matrix. Similarity is symmetric, so
+the same rows show which other lists *b* now enters. Those lists, and the
+lists that already held *b*, are recomputed in the same pass.
+"""
+import logging
+from datetime import datetime
+
+import click
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from flask.cli import AppGroup
+
+from app import db, engine, jobs
+from app.models import Book, BookNeighbor, BookNeighborStale, Review, Wishlist
+
+# numpy and scipy.sparse once ``available`` has imported them
+np = sparse = None
+
+log = logging.getLogger(__name__)
+
+recommend_cli = AppGroup("recommend", help="Book recommendation commands.")
+
+TOP_K = 12
+STRIP_SIZE = 6
+WISHLIST_WEIGHT = 1.0
+MAX_RATING = 5.0
+# stale books recomputed per pass, and books per block of a full rebuild
+REFRESH_BATCH = 500
+REBUILD_BLOCK = 2000
+# ids per IN (...) list
+ID_CHUNK = 5000
+
+_neighbors = BookNeighbor.__table__
+_stale = BookNeighborStale.__table__
+
+
+# --- queueing --------------------------------------------------------------------
+
+def _mark(connection, book_ids):
+    """Queue ``book_ids`` for a refresh; a book already queued is re-stamped."""
+    if not book_ids:
+        return
+    now = datetime.utcnow()
+    rows = [{"book_id": b, "marked_at": now} for b in book_ids]
+    if connection.dialect.name == "sqlite":
+        stmt = sqlite_insert(_stale)
+        connection.execute(
+            stmt.on_conflict_do_update(index_elements=["book_id"], set_={"marked_at": stmt.excluded.marked_at}),
+            rows,
+        )
+    else:
+        connection.execute(_stale.delete().where(_stale.c.book_id.in_(list(book_ids))))
+        connection.execute(_stale.insert(), rows)
+
+
+def interaction_changed(book_id):
+    """Queue ``book_id`` after a wishlist change written with Core statements (the caller commits)."""
+    _mark(db.session.connection(), {book_id})
+
+
+@sa.event.listens_for(Review, "after_insert")
+@sa.event.listens_for(Review, "after_delete")
+@sa.event.listens_for(Wishlist, "after_insert")
+@sa.event.listens_for(Wishlist, "after_delete")
+def _row_changed(mapper, connection, row):
+    _mark(connection, {row.book_id} - {None})
+
+
+@sa.event.listens_for(Review, "after_update")
+def _review_changed(mapper, connection, review):
+    state = sa.inspect(review)
+    if not any(state.attrs[a].history.has_changes() for a in ("rating", "user_id", "book_id")):
+        return
+    _mark(connection, ({review.book_id} | set(state.attrs.book_id.history.deleted)) - {None})
+
+
+@sa.event.listens_for(Book, "after_delete")
+def _book_deleted(mapper, connection, book):
+    pointing = connection.execute(
+        sa.select(_neighbors.c.book_id).where(_neighbors.c.neighbor_id == book.id)
+    ).scalars().all()
+    connection.execute(_neighbors.delete().where(
+        sa.or_(_neighbors.c.book_id == book.id, _neighbors.c.neighbor_id == book.id)
+    ))
+    _mark(connection, set(pointing))
+
+
+# --- computation -------------------------------------------------------------------
+
+def available():
+    """Import numpy and scipy.sparse on first use; False when they are not installed."""
+    global np, sparse
+    if sparse is None:
+        try:
+            import numpy as np
+            from scipy import sparse
+        except ImportError:  # pragma: no cover - numpy/scipy are optional
+            return False
+    return True
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), ID_CHUNK):
+        yield ids[start:start + ID_CHUNK]
+
+
+def _interactions(column=None, ids=None):
+    """``(user ids, book ids, weights)`` arrays with one entry per (user, book).
+
+    With ``column`` ("user_id" or "book_id") only rows whose column is in ``ids``.
+    """
+    def load(where_ids):
+        wished = sa.select(Wishlist.user_id, Wishlist.book_id, sa.literal(WISHLIST_WEIGHT).label("weight"))
+        reviewed = sa.select(Review.user_id, Review.book_id, (Review.rating / MAX_RATING).label("weight"))
+        if where_ids is not None:
+            wished = wished.where(getattr(Wishlist, column).in_(where_ids))
+            reviewed = reviewed.where(getattr(Review, column).in_(where_ids))
+        both = sa.union_all(wished, reviewed).subquery()
+        return db.session.execute(
+            sa.select(both.c.user_id, both.c.book_id, sa.func.max(both.c.weight))
+            .group_by(both.c.user_id, both.c.book_id)
+        ).all()
+
+    rows = load(None) if column is None else [r for chunk in _chunks(ids) for r in load(chunk)]
+    data = np.array(rows, dtype=float).reshape(-1, 3)
+    return data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2]
+
+
+def _matrix(users, books, weights):
+    """CSC user x book matrix and the book id of each column (ascending)."""
+    user_ids, rows = np.unique(users, return_inverse=True)
+    book_ids, cols = np.unique(books, return_inverse=True)
+    matrix = sparse.csc_matrix((weights, (rows, cols)), shape=(len(user_ids), len(book_ids)))
+    return matrix, book_ids
+
+
+def _norms(matrix):
+    return np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+
+
+def _cosine(matrix, cols, norms, col_norms):
+    """Cosine similarity of columns ``cols`` against every column: a CSR ``len(cols) x n``."""
+    sims = (matrix[:, cols].T @ matrix).tocsr()
+    rows = np.repeat(np.arange(sims.shape[0]), np.diff(sims.indptr))
+    sims.data /= col_norms[rows] * norms[sims.indices]
+    return sims
+
+
+def _top(sims, book_ids, sources):
+    """``BookNeighbor`` rows for each row of ``sims``; row i belongs to book ``sources[i]``."""
+    out = []
+    for i, book_id in enumerate(sources):
+        start, end = sims.indptr[i], sims.indptr[i + 1]
+        neighbors, scores = book_ids[sims.indices[start:end]], sims.data[start:end]
+        keep = (neighbors != book_id) & (scores > 0)
+        neighbors, scores = neighbors[keep], scores[keep]
+        if len(scores) > TOP_K:
+            best = np.argpartition(-scores, TOP_K)[:TOP_K]
+            neighbors, scores = neighbors[best], scores[best]
+        # best score first; ties go to the lower (older) book id
+        for rank, j in enumerate(np.lexsort((neighbors, -scores))):
+            out.append({"book_id": int(book_id), "rank": rank,
+                        "neighbor_id": int(neighbors[j]), "score": float(scores[j])})
+    return out
+
+
+def rebuild():
+    """Recompute every book's neighbors. Returns the number of books with interactions."""
+    started = datetime.utcnow()
+    users, books, weights = _interactions()
+    db.session.commit()
+    matrix, book_ids = _matrix(users, books, weights)
+    norms = _norms(matrix)
+    rows = []
+    for start in range(0, len(book_ids), REBUILD_BLOCK):
+        cols = np.arange(start, min(start + REBUILD_BLOCK, len(book_ids)))
+        rows += _top(_cosine(matrix, cols, norms, norms[cols]), book_ids, book_ids[cols])
+    with db.engine.begin() as conn:
+        conn.execute(_neighbors.delete())
+        if rows:
+            conn.execute(_neighbors.insert(), rows)
+        conn.execute(_stale.delete().where(_stale.c.marked_at < started))
+    return len(book_ids)
+
+
+def _similarities(targets):
+    """Cosine rows for the ``targets`` that have interactions: ``(sims, book ids of columns, row book ids)``."""
+    # only users who touched a target contribute to its similarities...
+    users, _, _ = _interactions("book_id", targets.tolist())
+    users, books, weights = _interactions("user_id", np.unique(users).tolist())
+    matrix, book_ids = _matrix(users, books, weights)
+    # ...but the norms need every interaction with the books involved
+    _, norm_books, norm_weights = _interactions("book_id", book_ids.tolist())
+    norms = np.sqrt(np.bincount(np.searchsorted(book_ids, norm_books), weights=norm_weights ** 2,
+                                minlength=len(book_ids)))
+    present = targets[np.isin(targets, book_ids)]
+    cols = np.searchsorted(book_ids, present)
+    return _cosine(matrix, cols, norms, norms[cols]), book_ids, present
+
+
+def _touched_lists(targets, sims, book_ids, sources):
+    """Other books whose lists changed with the scores of ``targets``.
+
+    Those that held a target, and those a target's new score gets into: one
+    at least as high as their lowest entry, or any score if they hold fewer
+    than ``TOP_K``.
+    """
+    touched = set()
+    for chunk in _chunks(targets.tolist()):
+        touched.update(db.session.execute(
+            sa.select(_neighbors.c.book_id).where(_neighbors.c.neighbor_id.in_(chunk))
+        ).scalars())
+    pairs = sims.tocoo()
+    others, scores = book_ids[pairs.col], pairs.data
+    keep = (others != sources[pairs.row]) & (scores > 0)
+    others, scores = others[keep], scores[keep]
+    candidates, which = np.unique(others, return_inverse=True)
+    counts = np.zeros(len(candidates), dtype=np.int64)
+    lowest = np.zeros(len(candidates))
+    for chunk in _chunks(candidates.tolist()):
+        for book_id, n, low in db.session.execute(
+            sa.select(_neighbors.c.book_id, sa.func.count(), sa.func.min(_neighbors.c.score))
+            .where(_neighbors.c.book_id.in_(chunk)).group_by(_neighbors.c.book_id)
+        ):
+            i = np.searchsorted(candidates, book_id)
+            counts[i], lowest[i] = n, low
+    enters = (counts[which] < TOP_K) | (scores >= lowest[which])
+    touched.update(others[enters].tolist())
+    return np.array(sorted(touched - set(targets.tolist())), dtype=np.int64)
+
+
+def refresh(limit=REFRESH_BATCH):
+    """Recompute the lists of up to ``limit`` queued books and the lists they enter or leave.
+
+    Returns how many queued books were taken.
+    """
+    stale = db.session.execute(
+        sa.select(_stale.c.book_id, _stale.c.marked_at).order_by(_stale.c.book_id).limit(limit)
+    ).all()
+    if not stale:
+        db.session.commit()
+        return 0
+    targets = np.array([b for b, _ in stale], dtype=np.int64)
+    sims, book_ids, present = _similarities(targets)
+    rows = _top(sims, book_ids, present)
+    touched = _touched_lists(targets, sims, book_ids, present)
+    if len(touched):
+        sims, book_ids, present = _similarities(touched)
+        rows += _top(sims, book_ids, present)
+    db.session.commit()
+
+    with db.engine.begin() as conn:
+        for chunk in _chunks(np.concatenate([targets, touched]).tolist()):
+            conn.execute(_neighbors.delete().where(_neighbors.c.book_id.in_(chunk)))
+        if rows:
+            conn.execute(_neighbors.insert(), rows)
+        # a book queued again meanwhile has a newer marked_at and stays queued
+        conn.execute(
+            _stale.delete().where(_stale.c.book_id == sa.bindparam("b"), _stale.c.marked_at == sa.bindparam("m")),
+            [{"b": b, "m": m} for b, m in stale],
+        )
+    return len(stale)
+
+
+@jobs.task("recommend.refresh")
+def refresh_job():
+    """Drain the refresh queue; scheduled through ``JOBS_SCHEDULE``."""
+    if not available():
+        log.warning("numpy/scipy are not installed; recommendations are not refreshed")
+        return 0
+    total = 0
+    while True:
+        taken = refresh()
+        total += taken
+        if taken < REFRESH_BATCH:
+            return total
+
+
+# --- lookups -----------------------------------------------------------------------
+
+def also_wanted(book_id, limit=STRIP_SIZE):
+    """The books most often wanted together with ``book_id``, best first."""
+    return (
+        Book.query.join(BookNeighbor, BookNeighbor.neighbor_id == Book.id)
+        .filter(BookNeighbor.book_id == book_id)
+        .order_by(BookNeighbor.rank)
+        .limit(limit)
+        .all()
+    )
+
+
+def _require_numpy():
+    if not available():
+        raise click.ClickException("numpy and scipy are not installed.")
+
+
+@recommend_cli.command("rebuild")
+def rebuild_command():
+    """Recompute every book's "also wanted" list."""
+    _require_numpy()
+    click.echo(f"Computed neighbors for {rebuild()} books.")
+
+
+@recommend_cli.command("refresh")
+def refresh_command():
+    """Recompute the queued lists now instead of waiting for the job."""
+    _require_numpy()
+    click.echo(f"Refreshed {refresh_job()} books.")
+
+
+@recommend_cli.command("show")
+@click.argument("book_id", type=int)
+@engine.deferred()
+def show_command(book_id):
+    """Print a book's neighbors with their scores."""
+    rows = db.session.execute(
+        sa.select(_neighbors.c.rank, _neighbors.c.score, Book.id, Book.title)
+        .join(Book, Book.id == _neighbors.c.neighbor_id)
+        .where(_neighbors.c.book_id == book_id)
+        .order_by(_neighbors.c.rank)
+    ).all()
+    for rank, score, neighbor_id, title in rows:
+        click.echo(f"{rank + 1:>3}  {score:.3f}  #{neighbor_id}  {title}")
+    if not rows:
+        click.echo("No neighbors.")
+
+
+def init_app(app):
+    app.cli.add_command(recommend_cli)
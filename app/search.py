@@ -0,0 +1,160 @@
+"""Full-text search over book listings.
+
+Listings are mirrored into an SQLite FTS5 table (``book_fts``) whose rowid is
+the ``Book.id``. The mirror is kept in sync by mapper events on ``Book`` and can
+be rebuilt from scratch with ``flask search rebuild``.
+"""
+import re
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+
+from app import db
+from app.models import Book
+
+FTS_TABLE = "book_fts"
+FTS_COLUMNS = ("title", "author", "description", "category")
+# bm25() column weights, same order as FTS_COLUMNS
+FTS_WEIGHTS = (10.0, 6.0, 1.0, 3.0)
+
+CREATE_FTS = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"{', '.join(FTS_COLUMNS)}, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+DROP_FTS = f"DROP TABLE IF EXISTS {FTS_TABLE}"
+
+search_cli = AppGroup("search", help="Full-text search index commands.")
+
+_fts = sa.table(FTS_TABLE, sa.column("rowid"), *(sa.column(c) for c in FTS_COLUMNS))
+_QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def is_enabled(bind):
+    return bind.dialect.name == "sqlite"
+
+
+# create/drop the FTS mirror together with the regular tables (db.create_all / drop_all)
+sa.event.listen(db.metadata, "after_create", sa.DDL(CREATE_FTS).execute_if(dialect="sqlite"))
+sa.event.listen(db.metadata, "before_drop", sa.DDL(DROP_FTS).execute_if(dialect="sqlite"))
+
+
+# the Book attributes each FTS column is built from
+_SOURCES = {"title": "title", "author": "author", "description": "description", "category": "category_id"}
+
+
+def _row(book):
+    row = {c: getattr(book, c) or "" for c in FTS_COLUMNS if c != "category"}
+    row["category"] = book.category.name if book.category else ""
+    return row
+
+
+@sa.event.listens_for(Book, "after_insert")
+def _index_insert(mapper, connection, book):
+    if is_enabled(connection):
+        # OR REPLACE: a bulk delete may have left a stale row behind for a reused id
+        connection.execute(_fts.insert().prefix_with("OR REPLACE").values(rowid=book.id, **_row(book)))
+
+
+@sa.event.listens_for(Book, "after_update")
+def _index_update(mapper, connection, book):
+    if not is_enabled(connection):
+        return
+    state = sa.inspect(book)
+    if not any(state.attrs[_SOURCES[c]].history.has_changes() for c in FTS_COLUMNS):
+        return
+    connection.execute(_fts.update().where(_fts.c.rowid == book.id).values(**_row(book)))
+
+
+@sa.event.listens_for(Book, "after_delete")
+def _index_delete(mapper, connection, book):
+    if is_enabled(connection):
+        connection.execute(_fts.delete().where(_fts.c.rowid == book.id))
+
+
+def build_match(q):
+    """Turn user input into a safe FTS5 MATCH expression.
+
+    Every term is quoted so FTS5 operators in the input are treated as text.
+    ``"exact phrase"`` stays a phrase query and a trailing ``*`` makes the
+    (last) term a prefix query. All terms must match. Returns None when the
+    input contains nothing searchable.
+    """
+    parts = []
+    for phrase, word in _QUERY_RE.findall(q or ""):
+        if phrase:
+            terms = _WORD_RE.findall(phrase)
+            if terms:
+                parts.append('"%s"' % " ".join(terms))
+            continue
+        terms = _WORD_RE.findall(word)
+        for i, term in enumerate(terms):
+            star = "*" if word.endswith("*") and i == len(terms) - 1 else ""
+            parts.append(f'"{term}"{star}')
+    return " ".join(parts) or None
+
+
+def match_subquery(q):
+    """(book_id, rank) rows matching ``q``; lower rank is a better match."""
+    expr = build_match(q)
+    if expr is None:
+        return None
+    fts = sa.literal_column(FTS_TABLE)
+    rank = sa.func.bm25(fts, *FTS_WEIGHTS)
+    return (
+        sa.select(_fts.c.rowid.label("book_id"), rank.label("rank"))
+        .where(fts.op("MATCH")(expr))
+        .subquery("matches")
+    )
+
+
+def filter_books(query, q):
+    """Restrict a ``Book`` query to listings matching ``q``.
+
+    Returns ``(query, rank)``; ``rank`` is the bm25 score to order by (lower is
+    better) or None when ranking isn't available.
+    """
+    if not is_enabled(db.engine):
+        like = f"%{q}%"
+        return query.filter(Book.title.ilike(like) | Book.author.ilike(like) | Book.description.ilike(like)), None
+
+    matches = match_subquery(q)
+    if matches is None:
+        return query, None
+    return query.join(matches, matches.c.book_id == Book.id), matches.c.rank
+
+
+def index_rows(connection, after_id=0):
+    """Mirror every book with ``id > after_id``; for rows bulk-inserted with Core."""
+    cols = ", ".join(FTS_COLUMNS)
+    coalesced = ", ".join(f"coalesce({'category.name' if c == 'category' else 'book.' + c}, '')" for c in FTS_COLUMNS)
+    connection.exec_driver_sql(
+        f"INSERT OR REPLACE INTO {FTS_TABLE}(rowid, {cols}) SELECT book.id, {coalesced} "
+        "FROM book LEFT JOIN category ON category.id = book.category_id WHERE book.id > ?",
+        (after_id,),
+    )
+
+
+def rebuild():
+    """Drop and repopulate the FTS mirror from the book table. Returns the row count."""
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(DROP_FTS)
+        conn.exec_driver_sql(CREATE_FTS)
+        index_rows(conn)
+        conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        return conn.exec_driver_sql(f"SELECT count(*) FROM {FTS_TABLE}").scalar()
+
+
+@search_cli.command("rebuild")
+def rebuild_command():
+    """Rebuild the full-text index from the book table."""
+    if not is_enabled(db.engine):
+        raise click.ClickException("Full-text search needs an SQLite database.")
+    count = rebuild()
+    click.echo(f"Indexed {count} books.")
+
+
+def init_app(app):
+    app.cli.add_command(search_cli)
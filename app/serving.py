@@ -0,0 +1,92 @@
+"""Production serving: health checks, fork hooks and load tests.
+
+The app is served by gunicorn with the settings in ``gunicorn.conf.py``::
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+``/healthz`` answers as long as the process does; ``/readyz`` also opens a
+connection to every database engine and returns 503 when one of them fails,
+so a load balancer stops routing to a worker that can't reach the database.
+Both report each engine's status and round-trip time.
+
+``after_fork`` runs in every worker. The app was created and warmed up in the
+master before forking, so templates, the URL map and SQLAlchemy's statement
+cache are shared. Pooled connections must not be shared, so the worker drops
+the inherited ones, opens its own and starts with empty metrics (with
+``METRICS_BACKEND = "sqlite"`` it adds to the shared totals).
+
+The load tests (``flask serve ...``) live in app.loadtest, which web workers
+never import.
+"""
+import json
+import os
+import time
+
+from flask import Response
+
+
+def check_database():
+    """``({bind: {"ok": bool, "ms": float[, "error": str]}}, all_ok)``."""
+    from app import db
+
+    report = {}
+    for key, engine in db.engines.items():
+        start = time.perf_counter()
+        try:
+            with engine.connect() as conn:
+                conn.exec_driver_sql("SELECT 1")
+                conn.rollback()
+            report[key or "default"] = {"ok": True, "ms": round((time.perf_counter() - start) * 1000, 2)}
+        except Exception as exc:
+            report[key or "default"] = {"ok": False, "ms": None, "error": str(exc).splitlines()[0]}
+    return report, all(r["ok"] for r in report.values())
+
+
+def _health_response(status, databases, code):
+    body = {"status": status, "pid": os.getpid(), "databases": databases}
+    return Response(json.dumps(body, separators=(",", ":")), status=code, mimetype="application/json",
+                    headers={"Cache-Control": "no-store"})
+
+
+def healthz():
+    databases, ok = check_database()
+    return _health_response("ok" if ok else "degraded", databases, 200)
+
+
+def readyz():
+    databases, ok = check_database()
+    return _health_response("ready" if ok else "unavailable", databases, 200 if ok else 503)
+
+
+def after_fork(app):
+    """Give a freshly forked worker its own connections and metrics."""
+    from app import db, metrics, startup
+
+    with app.app_context():
+        for engine in db.engines.values():
+            # close=False: the sockets/files still belong to the master's copies
+            engine.dispose(close=False)
+    metrics.registry = metrics.Registry(metrics.registry.store, metrics.registry.flush_interval)
+    if app.config.get("STARTUP_WARM_UP"):
+        startup.warm_up_connections(app)
+
+
+# settings whose "memory" backend keeps state that other workers never see
+SHARED_BACKENDS = ("CACHE_BACKEND", "IDENTITY_CACHE_BACKEND", "RATELIMIT_BACKEND")
+
+
+def check_shared_state(app, workers):
+    """Refuse per-process cache and rate-limit state when ``workers`` processes serve the app."""
+    if workers <= 1:
+        return
+    local = [name for name in SHARED_BACKENDS if app.config.get(name, "memory") == "memory"]
+    if local:
+        raise RuntimeError(
+            f"{', '.join(local)} = 'memory' keeps state per process, so with {workers} workers "
+            f"invalidations and limits would not reach the others; use 'sqlite' (or 'null')"
+        )
+
+
+def init_app(app):
+    app.add_url_rule("/healthz", "healthz", healthz)
+    app.add_url_rule("/readyz", "readyz", readyz)
@@ -0,0 +1,169 @@
+"""Cold start: template bytecode cache, warm-up and startup timing.
+
+Jinja compiles a template to Python the first time it is rendered, which
+puts the compile cost on the first request for each page in every fresh
+worker. With ``JINJA_BYTECODE_CACHE`` on, the compiled code is stored under
+``JINJA_BYTECODE_CACHE_DIR`` (``instance/jinja_cache``), where every other
+worker and every restart find it. ``flask startup precompile`` fills the
+cache at deploy time.
+
+``warm_up`` loads every template and opens ``STARTUP_WARM_CONNECTIONS``
+connections per engine, running their connect pragmas. It then requests
+``STARTUP_WARM_URLS`` so the URL map and SQLAlchemy's statement cache are
+populated too. ``create_app`` calls it when ``STARTUP_WARM_UP`` is set, which
+is the case in production.
+
+``flask startup report`` times the import, the app factory, the warm-up and
+the first and second request in fresh interpreters. Like ``flask bench run``,
+it can save a baseline and exit non-zero when a later run regresses.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+
+startup_cli = AppGroup("startup", help="Startup performance commands.")
+
+# the measurements each report run takes, in milliseconds
+STEPS = ("import", "create_app", "warm_up", "first_request", "second_request")
+
+# run in a fresh interpreter so imports aren't already cached
+_PROBE = """
+import json, os, sys, time
+t0 = time.perf_counter()
+import app
+from config import configs
+t1 = time.perf_counter()
+base = configs[os.environ.get("APP_CONFIG", "development")]
+config = type("ProbeConfig", (base,), {"STARTUP_WARM_UP": False})
+flask_app = app.create_app(config)
+t2 = time.perf_counter()
+if sys.argv[1] == "1":
+    from app.startup import warm_up
+    warm_up(flask_app)
+t3 = time.perf_counter()
+client = flask_app.test_client()
+status = client.get(sys.argv[2]).status_code
+t4 = time.perf_counter()
+client.get(sys.argv[2])
+t5 = time.perf_counter()
+ms = lambda a, b: round((b - a) * 1000, 1)
+print(json.dumps({
+    "status": status, "import": ms(t0, t1), "create_app": ms(t1, t2), "warm_up": ms(t2, t3),
+    "first_request": ms(t3, t4), "second_request": ms(t4, t5),
+}))
+"""
+
+
+def _templates(app):
+    return [name for name in app.jinja_env.list_templates() if name.endswith((".html", ".txt", ".xml"))]
+
+
+def precompile(app):
+    """Compile every template into the bytecode cache. Returns how many there were."""
+    names = _templates(app)
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_up_connections(app):
+    """Open ``STARTUP_WARM_CONNECTIONS`` pooled connections per engine."""
+    from app import db
+
+    with app.app_context():
+        for engine in db.engines.values():
+            # checked out together so the pool really holds that many; no SQL, so no transaction
+            conns = [engine.connect() for _ in range(app.config.get("STARTUP_WARM_CONNECTIONS", 2))]
+            for conn in conns:
+                conn.close()
+
+
+def warm_up(app):
+    """Load templates, open pooled connections and request the warm-up URLs."""
+    precompile(app)
+    warm_up_connections(app)
+    client = app.test_client()
+    for url in app.config.get("STARTUP_WARM_URLS", ()):
+        client.get(url)
+
+
+def init_app(app):
+    if app.config.get("JINJA_BYTECODE_CACHE", True):
+        path = app.config.get("JINJA_BYTECODE_CACHE_DIR") or os.path.join(app.instance_path, "jinja_cache")
+        os.makedirs(path, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(path)
+
+
+@startup_cli.command("precompile")
+def precompile_command():
+    """Compile all templates into the bytecode cache (run at deploy time)."""
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException("JINJA_BYTECODE_CACHE is disabled.")
+    start = time.perf_counter()
+    count = precompile(current_app)
+    click.echo(f"Compiled {count} templates in {(time.perf_counter() - start) * 1000:.0f}ms.")
+
+
+def measure(runs, warm, url):
+    """Median of each step over ``runs`` fresh interpreters."""
+    root = os.path.dirname(current_app.root_path)
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE, "1" if warm else "0", url],
+            cwd=root, capture_output=True, text=True, check=False,
+        )
+        if out.returncode:
+            raise click.ClickException(f"startup probe failed:\n{out.stderr}")
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    if samples[0]["status"] >= 500:
+        raise click.ClickException(f"{url} returned HTTP {samples[0]['status']}")
+    return {step: statistics.median(s[step] for s in samples) for step in STEPS}
+
+
+@startup_cli.command("report")
+@click.option("--runs", default=5, show_default=True, help="Fresh interpreters to take the median over.")
+@click.option("--url", default="/", show_default=True, help="Page timed as the first request.")
+@click.option("--warm-up/--no-warm-up", "warm", default=True, show_default=True)
+@click.option("--baseline", "baseline_path", default="startup_baseline.json", show_default=True)
+@click.option("--save", is_flag=True, help="Write the results as the new baseline.")
+@click.option("--tolerance", default=0.25, show_default=True, help="Allowed relative increase.")
+@click.option("--slack-ms", default=20.0, show_default=True, help="Allowed absolute increase.")
+def report_command(runs, url, warm, baseline_path, save, tolerance, slack_ms):
+    """Time imports, the app factory, warm-up and the first requests."""
+    results = measure(runs, warm, url)
+    for step in STEPS:
+        click.echo(f"{step:<16}{results[step]:>10.1f} ms")
+
+    if save:
+        with open(baseline_path, "w") as f:
+            json.dump({"url": url, "warm_up": warm, "steps": results}, f, indent=2)
+            f.write("\n")
+        click.echo(f"Saved baseline to {baseline_path}.")
+        return
+    if not os.path.exists(baseline_path):
+        click.echo(f"No baseline at {baseline_path}; run with --save to record one.")
+        return
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if (baseline["url"], baseline["warm_up"]) != (url, warm):
+        click.echo("Warning: the baseline was recorded with a different --url or --warm-up.", err=True)
+    problems = []
+    for step in STEPS:
+        then = baseline["steps"][step]
+        limit = then * (1 + tolerance) + slack_ms
+        if results[step] > limit:
+            problems.append(f"{step}: {results[step]}ms, baseline {then}ms (limit {limit:.1f}ms)")
+    for p in problems:
+        click.echo(f"REGRESSION {p}")
+    if problems:
+        sys.exit(1)
+    click.echo(f"No regressions against {baseline_path}.")
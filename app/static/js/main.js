@@ -86,3 +86,74 @@ function replyToComment(reviewId) {
     else alert('Failed to post reply');
   });
 }
+
+// "Load more" buttons on keyset-paginated grids (browse, buy requests, home feed).
+// The link works without JS; with JS we append the next page in place.
+document.addEventListener('click', async (event) => {
+  const btn = event.target.closest('[data-load-more]');
+  if (!btn) return;
+  event.preventDefault();
+  btn.classList.add('disabled');
+  try {
+    const res = await fetch(btn.dataset.loadMore, { headers: { 'X-Requested-With': 'XMLHttpRequest' } });
+    const data = await res.json();
+    document.querySelector(btn.dataset.target).insertAdjacentHTML('beforeend', data.html);
+    syncWishHearts();
+    if (data.more_url) {
+      btn.dataset.loadMore = data.more_url;
+      btn.classList.remove('disabled');
+    } else {
+      btn.remove();
+    }
+  } catch (e) {
+    console.error(e);
+    btn.classList.remove('disabled');
+  }
+});
+
+// Wishlist hearts on book cards. Cards are rendered without per-user state
+// (they're cached); one request fetches the state for every card on the page.
+function setWishHeart(el, wished) {
+  el.dataset.wished = wished ? '1' : '0';
+  el.textContent = wished ? '♥' : '♡';
+  el.classList.toggle('text-danger', wished);
+}
+
+async function syncWishHearts() {
+  if (document.body.dataset.authenticated !== '1') return;
+  const hearts = [...document.querySelectorAll('[data-wish-book]:not([data-wished])')];
+  if (!hearts.length) return;
+  const ids = [...new Set(hearts.map(el => el.dataset.wishBook))];
+  try {
+    const res = await fetch(`/books/wishlist/state?ids=${ids.join(',')}`, { headers: { 'X-Requested-With': 'XMLHttpRequest' } });
+    const wished = new Set((await res.json()).wished.map(String));
+    hearts.forEach(el => setWishHeart(el, wished.has(el.dataset.wishBook)));
+  } catch (e) {
+    console.error(e);
+  }
+}
+
+document.addEventListener('click', async (event) => {
+  const el = event.target.closest('[data-wish-book]');
+  if (!el) return;
+  event.preventDefault();
+  if (document.body.dataset.authenticated !== '1') {
+    window.location = '/login';
+    return;
+  }
+  const body = new FormData();
+  body.append('action', el.dataset.wished === '1' ? 'remove' : 'add');
+  try {
+    const res = await fetch(`/books/toggle-wishlist/${el.dataset.wishBook}`, {
+      method: 'POST',
+      body,
+      headers: { 'X-Requested-With': 'XMLHttpRequest' }
+    });
+    const data = await res.json();
+    setWishHeart(el, data.status === 'added');
+  } catch (e) {
+    console.error(e);
+  }
+});
+
+document.addEventListener('DOMContentLoaded', syncWishHearts);
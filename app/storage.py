@@ -0,0 +1,519 @@
+"""Content-addressed storage for uploaded files.
+
+Listing, buy request and avatar uploads are stored under the SHA-256 of their
+bytes, sharded two levels deep so no directory grows past a few thousand
+entries::
+
+    3f/a2/3fa2...e9.jpg          (image variants: 3f/a2/3fa2...e9_thumb.webp, ...)
+
+The database stores that key in ``image_file`` / ``avatar_file``. Uploading a
+photo that is already stored costs a hash and no write. ``stored_file`` counts
+the rows referring to each key; mapper events adjust it in the same
+transaction as the row, like the facet counts in app.facets, and
+``flask storage recount`` recomputes it. The ``uploads.gc`` job deletes files
+no row refers to (see app.uploads).
+
+An upload is hashed while it is copied to a temporary file ``CHUNK_SIZE``
+bytes at a time, so memory use doesn't depend on its size; ``MAX_CONTENT_LENGTH``
+caps the request. ``save`` then claims the key in ``stored_file`` and only
+then moves the file into place. The garbage collector deletes a row and its
+file in one transaction, so an upload either sees the row go or keeps it
+alive.
+
+Backends (``STORAGE_BACKEND``):
+
+* ``local``    -- files under ``STORAGE_ROOT`` (default ``instance/media``)
+* ``s3``       -- an S3-compatible bucket through boto3 (optional dependency)
+* ``s3-local`` -- the object-store backend over ``LocalObjectClient``, a
+  stand-in for the S3 API that keeps objects in a local directory
+
+Files are served at ``/media/<key>`` with far-future cache headers, since a
+key's content never changes; with ``STORAGE_PUBLIC_URL`` links point at the
+bucket instead. Names stored before this module existed are plain file names
+in ``static/uploads`` and ``static/avatars``; ``file_url`` still serves them
+and ``flask storage import-legacy`` moves them into the store.
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import tempfile
+from datetime import datetime
+
+import click
+import sqlalchemy as sa
+from flask import abort, current_app, redirect, send_file, url_for
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import FileStorage
+
+from app import db
+from app.models import Book, BuyRequest, StoredFile, User
+
+try:
+    import boto3
+except ImportError:  # pragma: no cover - only needed for the s3 backend
+    boto3 = None
+
+storage_cli = AppGroup("storage", help="Uploaded file storage commands.")
+
+CHUNK_SIZE = 64 * 1024
+# object-store uploads are spooled in memory up to this size, then on disk
+SPOOL_BYTES = 1024 * 1024
+ALLOWED_EXTENSIONS = {"jpg", "png", "gif"}
+EXTENSION_ALIASES = {"jpeg": "jpg"}
+# a year: keys are never reused for different content
+MAX_AGE = 365 * 24 * 3600
+
+# original or variant: 3f/a2/<sha256>[_<variant>].<ext>
+_KEY_RE = re.compile(r"[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(_[a-z]+)?\.[a-z0-9]+")
+_files = StoredFile.__table__
+
+# columns holding storage keys (or legacy file names)
+REFERENCES = (Book.image_file, BuyRequest.image_file, User.avatar_file)
+
+
+def is_key(name):
+    return bool(name) and _KEY_RE.fullmatch(name) is not None
+
+
+def extension(filename):
+    """Normalized extension of an uploaded ``filename``, or None if it isn't allowed."""
+    if not filename or "." not in filename:
+        return None
+    ext = filename.rsplit(".", 1)[1].lower()
+    ext = EXTENSION_ALIASES.get(ext, ext)
+    return ext if ext in ALLOWED_EXTENSIONS else None
+
+
+def make_key(digest, ext):
+    return f"{digest[:2]}/{digest[2:4]}/{digest}.{ext}"
+
+
+def _missing(exc):
+    """Whether a backend error means "no such object" (boto3 reports it as a ClientError)."""
+    if isinstance(exc, FileNotFoundError):
+        return True
+    code = getattr(exc, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+# --- backends ----------------------------------------------------------------------
+
+class Storage:
+    """What a storage backend implements. Keys are validated before they get here."""
+
+    def spool(self):
+        """A writable binary file to copy an upload into before ``put_file``."""
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+
+    def discard(self, spooled):
+        spooled.close()
+
+    def put_file(self, key, spooled):
+        """Store ``spooled`` (from ``spool``) under ``key``; takes ownership of it."""
+        raise NotImplementedError
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def open(self, key):
+        """A readable, seekable binary file; raises FileNotFoundError."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove ``key``; a missing key is not an error."""
+        raise NotImplementedError
+
+    def url(self, key):
+        """Public URL of ``key``, or None to serve it through ``/media``."""
+        return None
+
+    def send(self, key):
+        """Response for ``/media/<key>``."""
+        try:
+            f = self.open(key)
+        except FileNotFoundError:
+            abort(404)
+        return send_file(f, mimetype=mimetypes.guess_type(key)[0], max_age=MAX_AGE, conditional=False)
+
+    def sweep(self, cutoff):
+        """Remove temporary files abandoned before ``cutoff`` (a timestamp). Returns how many."""
+        return 0
+
+
+class LocalStorage(Storage):
+    """Files in a directory tree, written atomically through ``<root>/tmp``."""
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, "tmp")
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def spool(self):
+        # on the same filesystem as the tree, so put_file is a rename
+        return tempfile.NamedTemporaryFile(dir=self.tmp, delete=False)
+
+    def discard(self, spooled):
+        spooled.close()
+        try:
+            os.remove(spooled.name)
+        except FileNotFoundError:
+            pass
+
+    def put_file(self, key, spooled):
+        spooled.close()
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(spooled.name, path)
+
+    def put(self, key, data):
+        spooled = self.spool()
+        try:
+            spooled.write(data)
+        except BaseException:
+            self.discard(spooled)
+            raise
+        self.put_file(key, spooled)
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def send(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            abort(404)
+        return send_file(path, max_age=MAX_AGE)
+
+    def sweep(self, cutoff):
+        removed = 0
+        with os.scandir(self.tmp) as it:
+            for entry in it:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+
+class ObjectStorage(Storage):
+    """A bucket behind an S3-style client (``put_object``, ``get_object``, ...)."""
+
+    def __init__(self, client, bucket, public_url=None):
+        self.client = client
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/") if public_url else None
+
+    def _put(self, key, body):
+        self.client.put_object(
+            Bucket=self.bucket, Key=key, Body=body,
+            ContentType=mimetypes.guess_type(key)[0] or "application/octet-stream",
+            CacheControl=f"public, max-age={MAX_AGE}, immutable",
+        )
+
+    def put_file(self, key, spooled):
+        try:
+            spooled.seek(0)
+            self._put(key, spooled)
+        finally:
+            spooled.close()
+
+    def put(self, key, data):
+        self._put(key, data)
+
+    def open(self, key):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        except Exception as exc:
+            if _missing(exc):
+                raise FileNotFoundError(key) from exc
+            raise
+        # uploads are capped by MAX_CONTENT_LENGTH, so reading one whole is fine
+        with body:
+            return io.BytesIO(body.read())
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except Exception as exc:
+            if _missing(exc):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def url(self, key):
+        return f"{self.public_url}/{key}" if self.public_url else None
+
+    def send(self, key):
+        if self.public_url:
+            return redirect(self.url(key), code=301)
+        return super().send(key)
+
+
+class LocalObjectClient:
+    """The parts of the S3 client API that ``ObjectStorage`` uses, over a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            if isinstance(Body, bytes):
+                f.write(Body)
+            else:
+                for chunk in iter(lambda: Body.read(CHUNK_SIZE), b""):
+                    f.write(chunk)
+        os.replace(tmp, path)
+        return {}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": open(self._path(Bucket, Key), "rb")}
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": os.stat(self._path(Bucket, Key)).st_size}
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+
+# --- the store ---------------------------------------------------------------------
+
+class Store:
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        kind = app.config.get("STORAGE_BACKEND", "local")
+        root = app.config.get("STORAGE_ROOT") or os.path.join(app.instance_path, "media")
+        bucket = app.config.get("STORAGE_BUCKET", "uploads")
+        public_url = app.config.get("STORAGE_PUBLIC_URL")
+        if kind == "local":
+            self.backend = LocalStorage(root)
+        elif kind == "s3":
+            if boto3 is None:
+                raise RuntimeError("STORAGE_BACKEND=s3 needs boto3")
+            client = boto3.client("s3", endpoint_url=app.config.get("STORAGE_ENDPOINT_URL"))
+            self.backend = ObjectStorage(client, bucket, public_url)
+        elif kind == "s3-local":
+            self.backend = ObjectStorage(LocalObjectClient(root), bucket, public_url)
+        else:
+            raise ValueError(f"unknown STORAGE_BACKEND {kind!r}")
+        app.add_url_rule("/media/<path:key>", "media", media)
+        app.add_template_global(file_url)
+        app.cli.add_command(storage_cli)
+
+    def save(self, upload):
+        """Store a werkzeug ``FileStorage``. Returns ``(key, new)``; ``new`` is False for a duplicate.
+
+        The key is claimed in the caller's transaction, see ``_claim``.
+        """
+        ext = extension(upload.filename)
+        if ext is None:
+            raise ValueError(f"unsupported file type: {upload.filename!r}")
+        digest = hashlib.sha256()
+        size = 0
+        spooled = self.backend.spool()
+        try:
+            for chunk in iter(lambda: upload.stream.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                spooled.write(chunk)
+                size += len(chunk)
+            key = make_key(digest.hexdigest(), ext)
+            new = _claim(key, size)
+            if new or not self.backend.exists(key):
+                self.backend.put_file(key, spooled)
+                spooled = None
+            return key, new
+        finally:
+            if spooled is not None:
+                self.backend.discard(spooled)
+
+    def url(self, key, external=False):
+        return self.backend.url(key) or url_for("media", key=key, _external=external)
+
+
+store = Store()
+
+
+def _claim(key, size):
+    """Mark ``key`` as just uploaded, adding its row if needed. Returns whether it was new.
+
+    Runs in a savepoint of the caller's transaction and leaves the commit to
+    the caller. Until then the transaction holds the write lock (app.engine),
+    so the garbage collector can't remove the row or its file in between. If
+    the transaction ends any other way -- a rollback, or the session closed at
+    request teardown -- files it added are removed again by ``_discard_uncommitted``.
+    """
+    now = datetime.utcnow()
+    try:
+        with db.session.begin_nested():
+            touched = db.session.execute(
+                _files.update().where(_files.c.key == key).values(touched_at=now)
+            ).rowcount
+            if not touched:
+                db.session.execute(_files.insert().values(key=key, size=size, refs=0, touched_at=now))
+    except IntegrityError:
+        # the same file, uploaded concurrently
+        return False
+    if not touched:
+        db.session.info.setdefault("stored_files", set()).add(key)
+    return not touched
+
+
+@sa.event.listens_for(sa.orm.Session, "after_commit")
+def _keep_committed(session_):
+    session_.info.pop("stored_files", None)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_transaction_end")
+def _discard_uncommitted(session_, transaction):
+    # fires after the connection is released; keys still listed were never committed
+    if transaction.parent is not None:
+        return
+    keys = session_.info.pop("stored_files", None)
+    if not keys:
+        return
+    from app import images
+
+    for key in keys:
+        # like the garbage collector: the files go with the write lock held,
+        # unless another upload has claimed the key since
+        with db.engine.begin() as conn:
+            if conn.execute(sa.select(_files.c.key).where(_files.c.key == key)).first() is None:
+                for victim in [key] + images.variant_names(key):
+                    store.backend.delete(victim)
+
+
+def file_url(folder, name, external=False):
+    """URL of a stored file, or of a legacy upload in ``static/<folder>``; None without a name."""
+    if not name:
+        return None
+    if is_key(name):
+        return store.url(name, external)
+    return url_for("static", filename=f"{folder}/{name}", _external=external)
+
+
+def media(key):
+    if not is_key(key):
+        abort(404)
+    return store.backend.send(key)
+
+
+# --- reference counts ----------------------------------------------------------------
+
+def _adjust(connection, key, delta):
+    if is_key(key):
+        connection.execute(_files.update().where(_files.c.key == key).values(refs=_files.c.refs + delta))
+
+
+def _track(model, attr):
+    @sa.event.listens_for(model, "after_insert")
+    def added(mapper, connection, target):
+        _adjust(connection, getattr(target, attr), 1)
+
+    @sa.event.listens_for(model, "after_delete")
+    def deleted(mapper, connection, target):
+        _adjust(connection, getattr(target, attr), -1)
+
+    @sa.event.listens_for(model, "after_update")
+    def changed(mapper, connection, target):
+        history = sa.inspect(target).attrs[attr].history
+        if not history.has_changes():
+            return
+        for old in history.deleted:
+            _adjust(connection, old, -1)
+        _adjust(connection, getattr(target, attr), 1)
+
+
+for _column in REFERENCES:
+    _track(_column.class_, _column.key)
+
+
+def recount():
+    """Recompute every ``stored_file.refs`` from the referring columns. Returns the number of files."""
+    with db.engine.begin() as conn:
+        conn.execute(_files.update().values(refs=0))
+        for column in REFERENCES:
+            rows = conn.execute(
+                sa.select(column, sa.func.count()).where(column.is_not(None)).group_by(column)
+            ).all()
+            for key, n in rows:
+                _adjust(conn, key, n)
+        return conn.execute(sa.select(sa.func.count()).select_from(_files)).scalar()
+
+
+def import_legacy(static_folder, folders):
+    """Move legacy uploads into the store and point their rows at the new keys.
+
+    ``folders`` maps a static subfolder to the columns naming files in it.
+    Returns ``(moved, missing)``. The old files are left for the upload GC.
+    """
+    from app import images
+
+    moved = missing = 0
+    for folder, columns in folders.items():
+        for column in columns:
+            names = db.session.execute(
+                sa.select(column).distinct().where(column.is_not(None), column.not_like("%/%"))
+            ).scalars().all()
+            for name in names:
+                path = os.path.join(static_folder, folder, name)
+                if not os.path.isfile(path) or extension(name) is None:
+                    missing += 1
+                    continue
+                with open(path, "rb") as f:
+                    key, new = store.save(FileStorage(stream=f, filename=name))
+                if new:
+                    images.enqueue(key)
+                db.session.execute(sa.update(column.table).where(column == name).values({column.key: key}))
+                db.session.commit()
+                moved += 1
+    recount()
+    return moved, missing
+
+
+@storage_cli.command("recount")
+def recount_command():
+    """Recompute the reference counts of stored files."""
+    click.echo(f"Recounted references to {recount()} stored files.")
+
+
+@storage_cli.command("import-legacy")
+def import_legacy_command():
+    """Move uploads named before content-addressed storage into the store."""
+    from app.uploads import FOLDERS
+
+    moved, missing = import_legacy(current_app.static_folder, FOLDERS)
+    click.echo(f"Moved {moved} files into storage; {missing} referenced files were missing or unsupported.")
+
+
+def init_app(app):
+    store.init_app(app)
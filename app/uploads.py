@@ -0,0 +1,140 @@
+"""Garbage collection of uploaded files.
+
+Listings, buy requests and users only store a file name. Deleting a listing or
+replacing an avatar leaves the file -- and its image variants -- behind. The
+``uploads.gc`` job deletes them.
+
+Files in content-addressed storage (app.storage) have a reference count, so
+``collect_store`` only reads the ``stored_file`` rows that dropped to zero.
+Each row is deleted in the same transaction as its files, so a concurrent
+upload of the same bytes either keeps the row alive or writes the file again.
+
+Legacy uploads in ``static/uploads`` and ``static/avatars`` have no count:
+``collect`` lists each folder, asks the database which names are still
+referenced ``GC_BATCH`` at a time, and deletes the rest together with their
+variants. Variants whose original is gone are collected like any other
+unreferenced file.
+
+Either way, files younger than ``UPLOAD_GC_GRACE`` seconds are left alone,
+because an upload is written before the row naming it is committed.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import db, images, jobs, storage
+from app.models import Book, BuyRequest, StoredFile, User
+
+uploads_cli = AppGroup("uploads", help="Uploaded file commands.")
+
+GC_BATCH = 500
+# static subfolder -> columns holding names of legacy uploads in it
+FOLDERS = {
+    "uploads": (Book.image_file, BuyRequest.image_file),
+    "avatars": (User.avatar_file,),
+}
+
+
+def _referenced(columns, names):
+    found = set()
+    for column in columns:
+        found.update(db.session.execute(sa.select(column).where(column.in_(names))).scalars())
+    return found
+
+
+def collect(folder, grace, dry_run=False):
+    """Delete the unreferenced legacy files in ``static/<folder>``. Returns (files, bytes)."""
+    root = os.path.join(current_app.static_folder, folder)
+    if not os.path.isdir(root):
+        return 0, 0
+    with os.scandir(root) as it:
+        files = {e.name: e.stat() for e in it if e.is_file(follow_symlinks=False)}
+    # a variant belongs to its original; one without an original is just another orphan
+    derived = {v for name in files for v in images.variant_names(name)} & files.keys()
+    cutoff = time.time() - grace
+    candidates = sorted(n for n in files.keys() - derived if files[n].st_mtime < cutoff)
+
+    removed = size = 0
+    for start in range(0, len(candidates), GC_BATCH):
+        batch = candidates[start:start + GC_BATCH]
+        referenced = _referenced(FOLDERS[folder], batch)
+        # don't hold the database while touching the disk
+        db.session.commit()
+        for name in batch:
+            if name in referenced:
+                continue
+            for victim in [name] + [v for v in images.variant_names(name) if v in derived]:
+                if not dry_run:
+                    try:
+                        os.remove(os.path.join(root, victim))
+                    except FileNotFoundError:
+                        continue
+                removed += 1
+                size += files[victim].st_size
+    return removed, size
+
+
+def collect_store(grace, dry_run=False):
+    """Delete stored files no row refers to, with their variants. Returns (files, bytes)."""
+    files = StoredFile.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    unreferenced = sa.and_(files.c.refs <= 0, files.c.touched_at < cutoff)
+    if dry_run:
+        count, size = db.session.execute(
+            sa.select(sa.func.count(), sa.func.coalesce(sa.func.sum(files.c.size), 0)).where(unreferenced)
+        ).one()
+        db.session.commit()
+        return count, size
+
+    backend = storage.store.backend
+    removed = size = 0
+    after = ""
+    while True:
+        rows = db.session.execute(
+            sa.select(files.c.key, files.c.size).where(unreferenced, files.c.key > after)
+            .order_by(files.c.key).limit(GC_BATCH)
+        ).all()
+        db.session.commit()
+        for key, n in rows:
+            # holds the write lock while the files go; see the module docstring
+            with db.engine.begin() as conn:
+                if not conn.execute(files.delete().where(files.c.key == key, unreferenced)).rowcount:
+                    continue
+                for victim in [key] + images.variant_names(key):
+                    backend.delete(victim)
+            removed += 1
+            size += n
+        if len(rows) < GC_BATCH:
+            break
+        after = rows[-1][0]
+    backend.sweep(time.time() - grace)
+    return removed, size
+
+
+@jobs.task("uploads.gc")
+def gc(dry_run=False):
+    """Collect the store and every legacy upload folder; the job form of ``flask uploads gc``."""
+    grace = current_app.config.get("UPLOAD_GC_GRACE", 3600)
+    results = {"storage": collect_store(grace, dry_run)}
+    results.update({folder: collect(folder, grace, dry_run) for folder in FOLDERS})
+    for folder, (removed, size) in results.items():
+        current_app.logger.info("uploads.gc: %s files (%s bytes) from %s", removed, size, folder)
+    return results
+
+
+@uploads_cli.command("gc")
+@click.option("--dry-run", is_flag=True, help="Only report what would be deleted.")
+def gc_command(dry_run):
+    """Delete uploaded files that no listing, buy request or user refers to."""
+    verb = "Would delete" if dry_run else "Deleted"
+    for folder, (removed, size) in gc(dry_run=dry_run).items():
+        click.echo(f"{verb} {removed} files ({size / 1024:.0f} KiB) from {folder}.")
+
+
+def init_app(app):
+    app.cli.add_command(uploads_cli)
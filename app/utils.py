@@ -1,9 +1,126 @@
-from flask import request, url_for
+import base64
+import binascii
+import json
+import math
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import abort, request, url_for
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage:
+    """One page of a keyset-paginated query."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token, keys):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError) as exc:
+        raise InvalidCursor(token) from exc
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise InvalidCursor(token)
+    try:
+        return [_cursor_value(col, v) for (col, _), v in zip(keys, values)]
+    except (TypeError, ValueError) as exc:
+        raise InvalidCursor(token) from exc
+
+
+def _cursor_value(col, value):
+    """One decoded cursor value, checked against the type of the key column it is compared with."""
+    if isinstance(col.type, sa.DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(col.type, sa.Integer):
+        if not isinstance(value, int):
+            raise TypeError(value)
+    elif not isinstance(value, (int, float, str)):
+        raise TypeError(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(value)
+    return value
+
+
+def _after(keys, values):
+    """Rows strictly after ``values`` in the order given by ``keys``."""
+    directions = {desc for _, desc in keys}
+    if len(directions) == 1:
+        lhs = sa.tuple_(*(col for col, _ in keys))
+        rhs = sa.tuple_(*values)
+        return lhs < rhs if directions.pop() else lhs > rhs
+
+    clauses = []
+    for i, (col, desc) in enumerate(keys):
+        prefix = [keys[j][0] == values[j] for j in range(i)]
+        step = col < values[i] if desc else col > values[i]
+        clauses.append(sa.and_(*prefix, step))
+    return sa.or_(*clauses)
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=24):
+    """Fetch the page of ``query`` that follows ``cursor``.
+
+    ``keys`` is a list of ``(column, descending)`` pairs that together give a
+    unique, stable order (end with the primary key). The query must not be
+    ordered already. Runs a single LIMIT query -- no OFFSET and no COUNT -- so
+    every page costs the same as the first one.
+    """
+    labelled = [col.label(f"_k{i}") for i, (col, _) in enumerate(keys)]
+    q = query.add_columns(*labelled)
+    if cursor:
+        q = q.filter(_after(keys, decode_cursor(cursor, keys)))
+    q = q.order_by(*(col.desc() if desc else col.asc() for col, desc in keys))
+
+    rows = q.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][1:])
+    return KeysetPage([row[0] for row in rows], next_cursor)
+
+
+def paginate_request(query, keys, per_page=24, cursor_arg="cursor"):
+    """``keyset_paginate`` driven by the cursor in the query string."""
+    try:
+        return keyset_paginate(query, keys, request.args.get(cursor_arg), per_page)
+    except InvalidCursor:
+        abort(400)
+
+
+def next_page_url(page, endpoint, cursor_arg="cursor"):
+    """URL of ``endpoint`` for the page after ``page``, keeping the current filters."""
+    if not page.has_next:
+        return None
+    args = request.args.to_dict()
+    args[cursor_arg] = page.next_cursor
+    return url_for(endpoint, **args)
+
 
-def paginate_query(query, page_arg='page', per_page=12):
-    page = request.args.get(page_arg, 1, type=int)
-    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-    return pagination
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in {"png", "jpg", "jpeg", "gif"}
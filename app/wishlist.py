@@ -0,0 +1,71 @@
+"""Wishlist writes and lookups.
+
+``add`` and ``remove`` are single statements guarded by the
+``(user_id, book_id)`` unique constraint -- ``INSERT .. ON CONFLICT DO
+NOTHING`` and a plain ``DELETE`` -- so repeating either one (a double click,
+a retried request) is harmless and two concurrent requests can't create a
+duplicate row. ``wished_ids`` answers "which of these books has the user
+wishlisted" for a whole page in one query. A change queues the affected
+"also wanted" lists for a refresh (see app.recommend).
+
+The caller commits.
+"""
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from app import db, recommend
+from app.models import Wishlist
+
+
+def add(user_id, book_id):
+    """Wishlist ``book_id`` for ``user_id``. Returns False if it already was."""
+    values = {"user_id": user_id, "book_id": book_id, "created_at": datetime.utcnow()}
+    if db.session.get_bind(Wishlist.__mapper__).dialect.name != "sqlite":
+        # let the unique constraint reject the duplicate
+        try:
+            with db.session.begin_nested():
+                db.session.execute(sa.insert(Wishlist).values(values))
+            added = True
+        except sa.exc.IntegrityError:
+            added = False
+    else:
+        stmt = insert(Wishlist).values(values).on_conflict_do_nothing(index_elements=["user_id", "book_id"])
+        added = db.session.execute(stmt).rowcount > 0
+    if added:
+        recommend.interaction_changed(book_id)
+    return added
+
+
+def remove(user_id, book_id):
+    """Drop ``book_id`` from the user's wishlist. Returns False if it wasn't there."""
+    stmt = sa.delete(Wishlist).where(Wishlist.user_id == user_id, Wishlist.book_id == book_id)
+    removed = db.session.execute(stmt).rowcount > 0
+    if removed:
+        recommend.interaction_changed(book_id)
+    return removed
+
+
+def wished_ids(user_id, book_ids):
+    """The subset of ``book_ids`` the user has wishlisted."""
+    book_ids = list(book_ids)
+    if not book_ids:
+        return set()
+    stmt = sa.select(Wishlist.book_id).where(Wishlist.user_id == user_id, Wishlist.book_id.in_(book_ids))
+    return set(db.session.execute(stmt).scalars())
+
+
+def apply(user_id, book_id, action):
+    """Run a form's ``action`` ("add"/"remove"); anything else toggles. Returns the new state."""
+    if action == "add":
+        add(user_id, book_id)
+        return True
+    if action == "remove":
+        remove(user_id, book_id)
+        return False
+    # toggle: a delete that removes nothing means it wasn't wishlisted
+    if remove(user_id, book_id):
+        return False
+    add(user_id, book_id)
+    return True
@@ -9,4 +9,102 @@ class Config:
     SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-change-me")
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", f"sqlite:///{BASE_DIR / 'instance' / 'book_exchange.sqlite'}")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # applied to every SQLite connection when it is opened, see app/engine.py
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),
+        "cache_size": -int(os.getenv("SQLITE_CACHE_KB", "20000")),
+        "mmap_size": int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024))),
+        "temp_store": "MEMORY",
+    }
+    # separate read-only engine used by GET requests
+    SQLITE_READ_ENGINE = os.getenv("SQLITE_READ_ENGINE", "0") == "1"
     WTF_CSRF_TIME_LIMIT = None
+    # background workers generating thumbnail/card/full image variants (0 = inline)
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+    # background jobs (flask jobs worker): lease length, retry backoff and periodic jobs, in seconds
+    JOBS_VISIBILITY_TIMEOUT = int(os.getenv("JOBS_VISIBILITY_TIMEOUT", "300"))
+    JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "5"))
+    JOBS_BACKOFF_BASE = int(os.getenv("JOBS_BACKOFF_BASE", "10"))
+    JOBS_BACKOFF_MAX = int(os.getenv("JOBS_BACKOFF_MAX", "3600"))
+    JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "2"))
+    JOBS_SCHEDULE = {
+        "uploads.gc": int(os.getenv("UPLOAD_GC_INTERVAL", "86400")),
+        "recommend.refresh": int(os.getenv("RECOMMEND_REFRESH_INTERVAL", "60")),
+    }
+    # uploaded files, see app/storage.py: "local" (under STORAGE_ROOT, default instance/media),
+    # "s3" (needs boto3) or "s3-local" (the object-store backend over a local directory)
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+    STORAGE_ROOT = os.getenv("STORAGE_ROOT")
+    STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "uploads")
+    STORAGE_ENDPOINT_URL = os.getenv("STORAGE_ENDPOINT_URL")
+    STORAGE_PUBLIC_URL = os.getenv("STORAGE_PUBLIC_URL")
+    # largest request body, uploads included; bigger requests get a 413
+    MAX_CONTENT_LENGTH = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+    # uploads younger than this are never garbage collected
+    UPLOAD_GC_GRACE = int(os.getenv("UPLOAD_GC_GRACE", "3600"))
+    # request/SQL instrumentation served at /metrics (Bearer METRICS_TOKEN; without one, debug/testing only)
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+    # request metrics: "memory" (per worker) or "sqlite" (totals over all workers on one box)
+    METRICS_BACKEND = os.getenv("METRICS_BACKEND", "memory")
+    METRICS_SQLITE_PATH = os.getenv("METRICS_SQLITE_PATH")
+    METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+    METRICS_SLOW_QUERY_MS = float(os.getenv("METRICS_SLOW_QUERY_MS", "100"))
+    METRICS_N_PLUS_ONE_THRESHOLD = int(os.getenv("METRICS_N_PLUS_ONE_THRESHOLD", "5"))
+    # compiled templates are kept on disk (default instance/jinja_cache), see app/startup.py
+    JINJA_BYTECODE_CACHE = os.getenv("JINJA_BYTECODE_CACHE", "1") == "1"
+    JINJA_BYTECODE_CACHE_DIR = os.getenv("JINJA_BYTECODE_CACHE_DIR")
+    # prime templates, pooled connections and these pages before serving
+    STARTUP_WARM_UP = os.getenv("STARTUP_WARM_UP", "0") == "1"
+    STARTUP_WARM_CONNECTIONS = int(os.getenv("STARTUP_WARM_CONNECTIONS", "2"))
+    STARTUP_WARM_URLS = ("/", "/books/browse")
+    # page cache: "memory" (per worker), "sqlite" (shared by workers on one box) or "null"
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+    CACHE_DEFAULT_TIMEOUT = int(os.getenv("CACHE_DEFAULT_TIMEOUT", "60"))
+    CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+    CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH")
+    # Flask-Login user snapshots: "memory" (per worker), "sqlite" (shared) or "null"
+    IDENTITY_CACHE_BACKEND = os.getenv("IDENTITY_CACHE_BACKEND", "memory")
+    IDENTITY_CACHE_TIMEOUT = int(os.getenv("IDENTITY_CACHE_TIMEOUT", "60"))
+    IDENTITY_CACHE_MAX_ENTRIES = int(os.getenv("IDENTITY_CACHE_MAX_ENTRIES", "10000"))
+    IDENTITY_CACHE_SQLITE_PATH = os.getenv("IDENTITY_CACHE_SQLITE_PATH")
+    # password hashing: werkzeug method with cost parameters; older hashes are upgraded on login
+    PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+    PASSWORD_SALT_LENGTH = int(os.getenv("PASSWORD_SALT_LENGTH", "16"))
+    # hashing process pool (0 = hash on the request thread), extra queued hashes, seconds to wait for a slot
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+    PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "8"))
+    PASSWORD_HASH_WAIT = float(os.getenv("PASSWORD_HASH_WAIT", "5"))
+    # rate limits: "memory" (per worker), "sqlite" (shared by workers on one box) or "null"
+    RATELIMIT_ENABLED = os.getenv("RATELIMIT_ENABLED", "1") == "1"
+    RATELIMIT_BACKEND = os.getenv("RATELIMIT_BACKEND", "memory")
+    RATELIMIT_SQLITE_PATH = os.getenv("RATELIMIT_SQLITE_PATH")
+
+
+class ProductionConfig(Config):
+    STARTUP_WARM_UP = os.getenv("STARTUP_WARM_UP", "1") == "1"
+    # several gunicorn workers: invalidations and daily quotas must reach (and
+    # outlive) every worker, so these share a file (see serving.check_shared_state);
+    # /metrics reports the totals over all workers
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+    IDENTITY_CACHE_BACKEND = os.getenv("IDENTITY_CACHE_BACKEND", "sqlite")
+    RATELIMIT_BACKEND = os.getenv("RATELIMIT_BACKEND", "sqlite")
+    METRICS_BACKEND = os.getenv("METRICS_BACKEND", "sqlite")
+    SQLITE_READ_ENGINE = os.getenv("SQLITE_READ_ENGINE", "1") == "1"
+    # writers queue on the single SQLite write lock, so a small pool is enough
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "10")),
+    }
+    SQLALCHEMY_READ_ENGINE_OPTIONS = {
+        "pool_size": int(os.getenv("DB_READ_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_READ_MAX_OVERFLOW", "10")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "10")),
+    }
+
+
+configs = {"development": Config, "production": ProductionConfig}
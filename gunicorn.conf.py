@@ -0,0 +1,44 @@
+"""gunicorn settings for ``gunicorn -c gunicorn.conf.py wsgi:app``.
+
+The app is imported and warmed up once in the master (``preload_app``) and
+the workers are forked from it, sharing its memory copy-on-write. Each worker
+runs ``WEB_CONCURRENCY`` x ``GUNICORN_THREADS`` requests at a time, and is
+replaced after ``GUNICORN_MAX_REQUESTS`` requests (plus jitter, so they don't
+all restart together).
+
+Signals:
+    HUP   replace the workers gracefully (same code: they fork from the master)
+    USR2  start a new master with the new code, then QUIT the old one to deploy
+    TERM  stop accepting, finish in-flight requests within graceful_timeout
+    TTIN / TTOU  add / remove a worker
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+# one process per core; requests mostly wait on SQLite and templates, threads cover the waits
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_class = "gthread"
+preload_app = True
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = max_requests // 10
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = os.getenv("GUNICORN_ACCESS_LOG")  # "-" for stdout
+errorlog = "-"
+
+
+def on_starting(server):
+    from app import serving
+    from wsgi import app
+
+    serving.check_shared_state(app, server.cfg.workers)
+
+
+def post_fork(server, worker):
+    from app import serving
+    from wsgi import app
+
+    serving.after_fork(app)
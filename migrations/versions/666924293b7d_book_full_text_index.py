@@ -0,0 +1,45 @@
+"""book full text index
+
+Creates the FTS5 mirror of book listings and fills it from the book table
+(same rows as ``flask search rebuild``; the rowid is the book id).
+
+Revision ID: 666924293b7d
+Revises: 50b5b2b510a9
+Create Date: 2026-10-18 12:53:05.412087
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# frozen copy of app.search.CREATE_FTS as of this revision
+CREATE_FTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5("
+    "title, author, description, category, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+DROP_FTS = "DROP TABLE IF EXISTS book_fts"
+BACKFILL_FTS = (
+    "INSERT INTO book_fts (rowid, title, author, description, category) "
+    "SELECT id, title, coalesce(author, ''), coalesce(description, ''), coalesce(category, '') "
+    "FROM book"
+)
+
+
+# revision identifiers, used by Alembic.
+revision = '666924293b7d'
+down_revision = '50b5b2b510a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    op.execute(CREATE_FTS)
+    op.execute("DELETE FROM book_fts")
+    op.execute(BACKFILL_FTS)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "sqlite":
+        op.execute(DROP_FTS)
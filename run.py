@@ -1,6 +1,10 @@
+import os
+
 from app import create_app
+from config import configs
 
-app = create_app()
+app = create_app(configs[os.getenv("APP_CONFIG", "development")])
 
+# development server; in production run: gunicorn -c gunicorn.conf.py wsgi:app
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,7 @@
+import os
+
+from app import create_app
+from config import configs
+
+# production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+app = create_app(configs[os.getenv("APP_CONFIG", "production")])